@@ -0,0 +1,161 @@
+"""
+Compare the cost of ChatService's Redis write path against the previous
+one-command-per-call implementation.
+
+Usage (from the api directory, against a scratch Redis database):
+
+    python -m benchmarks.bench_chat_writes --redis-url redis://localhost:6379/15 --messages 500
+
+Every key the benchmark writes is under the `bench:` user and is removed
+afterwards.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from datetime import datetime
+
+from redis import Redis
+from redis.client import Pipeline
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.services.chat.crud_chat import ChatService  # noqa: E402
+from src.services.chat.schema import ChatMessage, ChatSession  # noqa: E402
+
+USER_ID = "bench"
+
+
+class CountingPipeline(Pipeline):
+    def execute(self, raise_on_error=True):
+        self.round_trips[0] += 1
+        return super().execute(raise_on_error)
+
+
+class CountingRedis(Redis):
+    """
+    Redis client that counts network round-trips: one per command, one per
+    pipeline execution.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.round_trips = [0]
+
+    def execute_command(self, *args, **options):
+        self.round_trips[0] += 1
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.round_trips = self.round_trips
+        return pipe
+
+
+def legacy_create_session(redis_client, session_id, user_id):
+    session_key = f"{user_id}:{session_id}"
+    now = datetime.utcnow().isoformat()
+    if redis_client.exists(session_key):
+        raise ValueError(f"Session ID {session_id} already exists for user {user_id}.")
+    redis_client.hset(session_key, mapping={
+        "session_id": session_id, "user_id": user_id, "created_at": now,
+        "updated_at": now, "status": "active",
+        "initial_message": "User initiated a chat session."})
+    redis_client.delete(f"message_store:{session_key}")
+
+
+def legacy_store_chat_redis(redis_client, session):
+    message_store_key = f"message_store:{session.user_id}:{session.session_id}"
+    redis_client.delete(message_store_key)
+    for message in session.chat_history:
+        redis_client.rpush(message_store_key, message.to_refined_json())
+    redis_client.hset(f"{session.user_id}:{session.session_id}", mapping={
+        "session_id": session.session_id,
+        "user_id": session.user_id,
+        "created_at": session.created_at.isoformat(),
+        "updated_at": session.updated_at.isoformat(),
+        "status": session.status,
+        "initial_message": session.initial_message})
+
+
+def legacy_delete_chat_redis(redis_client, session_id, user_id):
+    session_key = f"{user_id}:{session_id}"
+    redis_client.delete(session_key)
+    redis_client.delete(f"message_store:{session_key}")
+
+
+def make_session(session_id, messages):
+    history = [ChatMessage(content=f"message {i} " + "lorem ipsum " * 20,
+                           type="human" if i % 2 == 0 else "ai")
+               for i in range(messages)]
+    now = datetime.utcnow()
+    return ChatSession(session_id=session_id, user_id=USER_ID, chat_history=history,
+                       created_at=now, updated_at=now, status="active",
+                       initial_message="User initiated a chat session.")
+
+
+def measure(redis_client, runs, operation, setup=None):
+    timings, trips = [], []
+    for run in range(runs):
+        if setup is not None:
+            setup(f"session-{run}")
+        before = redis_client.round_trips[0]
+        start = time.perf_counter()
+        operation(f"session-{run}")
+        timings.append((time.perf_counter() - start) * 1000)
+        trips.append(redis_client.round_trips[0] - before)
+    return statistics.median(timings), statistics.median(trips)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--redis-url", default=os.environ.get("REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--messages", type=int, default=500, help="messages per restored session")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    redis_client = CountingRedis.from_url(args.redis_url)
+    service = ChatService(mongo_collection=None, redis_client=redis_client)
+    session = make_session("template", args.messages)
+
+    def restore(session_id):
+        return session.model_copy(update={"session_id": session_id})
+
+    def populate(session_id):
+        service.store_chat_redis(restore(session_id))
+
+    cases = [
+        ("create_session", None,
+         lambda sid: legacy_create_session(redis_client, sid, USER_ID),
+         lambda sid: service.create_session(sid, USER_ID)),
+        (f"store_chat_redis ({args.messages} messages)", None,
+         lambda sid: legacy_store_chat_redis(redis_client, restore(sid)),
+         lambda sid: service.store_chat_redis(restore(sid))),
+        ("delete_chat_redis", populate,
+         lambda sid: legacy_delete_chat_redis(redis_client, sid, USER_ID),
+         lambda sid: service.delete_chat_redis(sid, USER_ID)),
+    ]
+
+    print(f"{'operation':<36} {'legacy ms':>10} {'trips':>6} {'new ms':>10} {'trips':>6}")
+    try:
+        for name, setup, legacy, new in cases:
+            legacy_ms, legacy_trips = measure(redis_client, args.runs, legacy, setup)
+            cleanup(redis_client)
+            new_ms, new_trips = measure(redis_client, args.runs, new, setup)
+            cleanup(redis_client)
+            print(f"{name:<36} {legacy_ms:>10.2f} {legacy_trips:>6.0f} {new_ms:>10.2f} {new_trips:>6.0f}")
+    finally:
+        cleanup(redis_client)
+
+
+def cleanup(redis_client):
+    keys = [key for pattern in (f"{USER_ID}:*", f"message_store:{USER_ID}:*",
+                                f"message_summary:{USER_ID}:*", f"user_sessions:{USER_ID}")
+            for key in redis_client.scan_iter(match=pattern, count=1000)]
+    if keys:
+        redis_client.delete(*keys)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Load-test the question endpoints without calling OpenAI or Hugging Face.
+
+Starts the API in a subprocess with the stand-ins of `benchmarks.stand_ins`
+(fake chat model, hash-based embeddings, in-memory vector store), replays a
+workload file against it and reports, per endpoint, the latency
+percentiles, the throughput and the error rate.
+
+Usage (from the api directory, against a scratch Redis database):
+
+    python -m benchmarks.bench_load benchmarks/workload.sample.jsonl --rate 20 --flush
+    python -m benchmarks.bench_load workload.jsonl --latency 1.0 --tokens-per-second 30
+
+The workload is one JSON request per line:
+
+    {"at": 0.25, "endpoint": "question", "question": "..."}
+    {"at": 0.5, "endpoint": "question_aware_history", "question": "...",
+     "user_id": "u1", "conversation_id": "c1"}
+
+`endpoint` is one of question, question_aware_history, socket and
+socket_history. Requests are sent at their recorded `at` offsets (seconds),
+or at a fixed `--rate` per second, whether or not earlier ones have
+finished.
+
+Redis holds the conversations, caches and BM25 index of the run, so the
+database must be empty; `--flush` empties it before and after the run.
+Settings of the app (LLM_MAX_CONCURRENCY, ANSWER_CACHE_ENABLED, ...) are
+read from the environment as usual.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from urllib.parse import urlencode
+
+import httpx
+import websockets
+from redis import Redis
+
+from benchmarks.bench_startup import API_DIR, STUB_ENV
+
+ENDPOINTS = ("question", "question_aware_history", "socket", "socket_history")
+
+
+def serve(args):
+    """
+    Run the app with the stand-ins installed (in the server subprocess).
+    """
+    import uvicorn
+    from src.core import db
+
+    # Before anything creates the Redis client
+    db.REDIS_URL = args.redis_url
+    from benchmarks import stand_ins
+    stand_ins.install(args.latency, args.tokens_per_second, args.documents)
+    from src.main import app
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def load_workload(path):
+    with open(path) as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    unknown = {item["endpoint"] for item in items} - set(ENDPOINTS)
+    if unknown:
+        raise SystemExit(f"Unknown endpoints in {path}: {', '.join(sorted(unknown))}")
+    return items
+
+
+async def send(client, ws_url, item):
+    """
+    Send one request; True when it succeeded.
+    """
+    endpoint = item["endpoint"]
+    if endpoint == "question":
+        response = await client.post("/chat/question", data={"question": item["question"]})
+        return response.status_code < 400
+    if endpoint == "question_aware_history":
+        response = await client.post("/chat/question_aware_history", data={
+            "qusetion": item["question"],
+            "user_id": item.get("user_id", "bench"),
+            "conversation_id": item.get("conversation_id", "bench")})
+        return response.status_code < 400
+
+    if endpoint == "socket":
+        url = f"{ws_url}/socket/chating/ws"
+    else:
+        url = f"{ws_url}/socket/chating_aware_history/ws?" + urlencode({
+            "user_id": item.get("user_id", "bench"),
+            "conversation_id": item.get("conversation_id", "bench")})
+    async with websockets.connect(url) as websocket:
+        await websocket.send(item["question"])
+        while True:
+            message = json.loads(await websocket.recv())
+            if message["type"] in ("end", "error"):
+                return message["type"] == "end"
+
+
+async def replay(base_url, items, rate, timeout):
+    results = defaultdict(list)
+    ws_url = "ws" + base_url[len("http"):]
+
+    async def timed(item):
+        start = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(send(client, ws_url, item), timeout)
+        except Exception:
+            ok = False
+        results[item["endpoint"]].append((time.perf_counter() - start, ok))
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tasks = []
+        for i, item in enumerate(items):
+            delay = start + (i / rate if rate else item.get("at", 0)) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(timed(item)))
+        await asyncio.gather(*tasks)
+        elapsed = loop.time() - start
+    return results, elapsed
+
+
+def percentile(values, pct):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method="inclusive")[pct - 1]
+
+
+def report(results, elapsed):
+    print(f"{'endpoint':<24} {'requests':>8} {'errors':>7} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint in ENDPOINTS:
+        if endpoint not in results:
+            continue
+        samples = results[endpoint]
+        latencies = [latency * 1000 for latency, ok in samples if ok]
+        errors = sum(1 for _, ok in samples if not ok) / len(samples)
+        line = f"{endpoint:<24} {len(samples):>8} {errors:>7.1%} {len(latencies) / elapsed:>7.2f}"
+        if latencies:
+            line += "".join(f" {percentile(latencies, pct):>8.0f}" for pct in (50, 95, 99))
+        print(line)
+    print(f"{sum(len(samples) for samples in results.values())} requests in {elapsed:.1f}s")
+
+
+def wait_until_up(base_url, server, deadline=60):
+    start = time.monotonic()
+    while time.monotonic() - start < deadline:
+        if server.poll() is not None:
+            raise SystemExit("The API exited during startup")
+        try:
+            httpx.get(f"{base_url}/pool-stats", timeout=1).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise SystemExit("The API did not start in time")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("workload", nargs="?", help="JSONL workload file")
+    parser.add_argument("--rate", type=float, default=None, help="requests per second, instead of the recorded timing")
+    parser.add_argument("--redis-url", default=os.environ.get("REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--flush", action="store_true", help="empty the Redis database before and after the run")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before the fake model's first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--documents", type=int, default=500, help="synthetic chunks to index")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds before a request counts as failed")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    if not args.workload:
+        parser.error("a workload file is required")
+
+    items = load_workload(args.workload)
+    redis_client = Redis.from_url(args.redis_url)
+    if args.flush:
+        redis_client.flushdb()
+    elif redis_client.dbsize():
+        raise SystemExit(f"{args.redis_url} is not empty; use a scratch database or pass --flush")
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory() as scratch:
+        env = {**STUB_ENV, **os.environ, "WARM_UP": "false",
+               "EMBEDDING_CACHE_DIR": os.path.join(scratch, "embedding_cache")}
+        command = [sys.executable, "-m", "benchmarks.bench_load", "--serve",
+                   "--port", str(args.port), "--redis-url", args.redis_url,
+                   "--latency", str(args.latency), "--tokens-per-second", str(args.tokens_per_second),
+                   "--documents", str(args.documents)]
+        server = subprocess.Popen(command, cwd=API_DIR, env=env)
+        try:
+            wait_until_up(base_url, server)
+            results, elapsed = asyncio.run(replay(base_url, items, args.rate, args.timeout))
+        finally:
+            server.terminate()
+            server.wait()
+            if args.flush:
+                redis_client.flushdb()
+    report(results, elapsed)
+
+
+if __name__ == "__main__":
+    main()
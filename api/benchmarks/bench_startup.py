@@ -0,0 +1,124 @@
+"""
+Measure how long the API takes to import and to serve its first request,
+with every backend stubbed out.
+
+Each run starts a fresh interpreter that replaces the MongoDB, Weaviate and
+Hugging Face clients with stubs (each one sleeps `--backend-delay` seconds
+when created, standing in for a connection handshake), imports `src.main`,
+starts the app and sends it one request.
+
+Usage (from the api directory):
+
+    python -m benchmarks.bench_startup --runs 5 --backend-delay 0.5
+    python -m benchmarks.bench_startup --no-warm-up
+
+Reported, as the median over the runs:
+
+    import          importing src.main
+    startup         running the lifespan startup
+    first request   from the start of the import to the first response
+    chains ready    from the start of the import until the conversational
+                    chain is built (by the warm-up, or by the first caller)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STUB_ENV = {
+    "OPENAI_API_KEY": "sk-bench",
+    "HUGGINGFACEHUB_API_TOKEN": "hf_bench",
+    "CHUNK_OVERLAP": "50",
+    "CHUNK_SIZE": "500",
+    "STARTUP_PERIOD": "0",
+}
+
+
+def slow_stub(delay):
+    def factory(*args, **kwargs):
+        time.sleep(delay)
+        return mock.MagicMock()
+    return factory
+
+
+def stub_backends(delay):
+    """
+    Patch the client constructors before `src` imports them.
+    """
+    import pymongo
+    import weaviate
+    import langchain_community.embeddings
+
+    pymongo.MongoClient = slow_stub(delay)
+    weaviate.connect_to_local = slow_stub(delay)
+    weaviate.use_async_with_local = slow_stub(delay)
+    langchain_community.embeddings.HuggingFaceHubEmbeddings = slow_stub(delay)
+
+
+def run_once(delay):
+    """
+    One measurement, in the current (fresh) interpreter.
+    """
+    stub_backends(delay)
+    start = time.perf_counter()
+    import src.main
+    imported = time.perf_counter()
+
+    from fastapi.testclient import TestClient
+    from src.utils import rag
+
+    with TestClient(src.main.app) as client:
+        started = time.perf_counter()
+        client.get("/pool-stats").raise_for_status()
+        first_request = time.perf_counter()
+        rag.get_conversational_rag_chain()
+        chains_ready = time.perf_counter()
+
+    return {
+        "import": imported - start,
+        "startup": started - imported,
+        "first request": first_request - start,
+        "chains ready": chains_ready - start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--backend-delay", type=float, default=0.5,
+                        help="seconds each stubbed client takes to be created")
+    parser.add_argument("--no-warm-up", action="store_true", help="start with WARM_UP=false")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_once(args.backend_delay)))
+        return
+
+    with tempfile.TemporaryDirectory() as scratch:
+        env = {**os.environ, **STUB_ENV,
+               "WARM_UP": "false" if args.no_warm_up else "true",
+               "EMBEDDING_CACHE_DIR": os.path.join(scratch, "embedding_cache")}
+        results = []
+        for _ in range(args.runs):
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_startup", "--child",
+                 "--backend-delay", str(args.backend_delay)],
+                cwd=API_DIR, env=env, check=True,
+                capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{'stage':<16} {'median s':>10}")
+    for stage in results[0]:
+        print(f"{stage:<16} {statistics.median(r[stage] for r in results):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measure the search latency and recall of the local vector replica, exact
+and with an IVF index, on synthetic clustered vectors.
+
+Usage (from the api directory, no running stack needed):
+
+    python -m benchmarks.bench_vector_replica --rows 200000 --dim 384 --nlist 256 --nprobe 16
+
+Recall@k is the share of the exact top-k found by the IVF search. The
+replica files are written to a temporary directory and removed afterwards.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.vector_replica import VectorReplica  # noqa: E402
+
+BATCH = 20000
+
+
+def clustered(rng, centers, count, spread):
+    return centers[rng.integers(0, len(centers), count)] + spread * rng.normal(
+        size=(count, centers.shape[1])).astype(np.float32)
+
+
+def timed_searches(replica, queries, k):
+    replica.search(queries[:1], k)
+    latencies, hits = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found = replica.search(query[None], k)[0]
+        latencies.append((time.perf_counter() - start) * 1000)
+        hits.append({doc_id for doc_id, _ in found})
+    return latencies, hits
+
+
+def report(label, latencies):
+    p95 = statistics.quantiles(latencies, n=100, method="inclusive")[94]
+    print(f"{label:<8} p50 {statistics.median(latencies):7.2f} ms   p95 {p95:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--clusters", type=int, default=500, help="clusters the synthetic vectors are drawn around")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(args.clusters, args.dim)).astype(np.float32)
+    queries = clustered(rng, centers, args.queries, 0.5)
+
+    with tempfile.TemporaryDirectory() as directory:
+        replica = VectorReplica(directory, nprobe=args.nprobe)
+        start = time.perf_counter()
+        with replica.writer() as writer:
+            for offset in range(0, args.rows, BATCH):
+                count = min(BATCH, args.rows - offset)
+                writer.add([str(uuid.uuid4()) for _ in range(count)], clustered(rng, centers, count, 0.5))
+            writer.commit("1-0", 1)
+        print(f"loaded {len(replica)} x {args.dim} vectors in {time.perf_counter() - start:.1f}s")
+
+        exact_latencies, exact_hits = timed_searches(replica, queries, args.k)
+        report("exact", exact_latencies)
+
+        start = time.perf_counter()
+        with replica.writer() as writer:
+            writer.train(args.nlist)
+            writer.commit("1-0", 1)
+        print(f"trained {args.nlist} lists in {time.perf_counter() - start:.1f}s")
+
+        ivf_latencies, ivf_hits = timed_searches(replica, queries, args.k)
+        report("ivf", ivf_latencies)
+        recall = statistics.mean(len(found & exact) / len(exact) for found, exact in zip(ivf_hits, exact_hits))
+        print(f"recall@{args.k} {recall:.3f} (nprobe {args.nprobe})")
+
+
+if __name__ == "__main__":
+    main()
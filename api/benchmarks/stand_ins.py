@@ -0,0 +1,134 @@
+"""
+Local stand-ins for the paid and remote backends, for load tests: a
+deterministic chat model with configurable latency and token rate,
+hash-based embeddings, an in-memory vector store and a word tokenizer in
+place of tiktoken, whose encoding would be downloaded on first use.
+
+`install` swaps them into `src` before the app serves its first request;
+the LLM and embedding schedulers still apply.
+"""
+import asyncio
+import hashlib
+import random
+import re
+import time
+from typing import Any, Iterator, AsyncIterator, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.vectorstores import InMemoryVectorStore
+
+from src.utils.scheduler import get_llm_scheduler
+
+WORDS = ("the document describes a method for retrieval augmented answers based on context "
+         "from indexed pages with chunks embeddings and vectors stored in the index").split()
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering with words picked by a hash of the prompt: the same
+    prompt always gets the same answer. The first token comes after
+    `latency` seconds, then `tokens_per_second` follow.
+    """
+    latency: float = 0.5
+    tokens_per_second: float = 50.0
+    answer_tokens: int = 40
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        prompt = "\n".join(str(message.content) for message in messages)
+        rng = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        return [rng.choice(WORDS) + " " for _ in range(self.answer_tokens)]
+
+    def _duration(self, tokens: List[str]) -> float:
+        return self.latency + len(tokens) / self.tokens_per_second
+
+    @staticmethod
+    def _result(tokens: List[str]) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        with get_llm_scheduler().slot():
+            tokens = self._tokens(messages)
+            time.sleep(self._duration(tokens))
+            return self._result(tokens)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        async with get_llm_scheduler().aslot():
+            tokens = self._tokens(messages)
+            await asyncio.sleep(self._duration(tokens))
+            return self._result(tokens)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        with get_llm_scheduler().slot(reentrant=False):
+            time.sleep(self.latency)
+            for token in self._tokens(messages):
+                time.sleep(1 / self.tokens_per_second)
+                if run_manager:
+                    run_manager.on_llm_new_token(token)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async with get_llm_scheduler().aslot(reentrant=False):
+            await asyncio.sleep(self.latency)
+            for token in self._tokens(messages):
+                await asyncio.sleep(1 / self.tokens_per_second)
+                if run_manager:
+                    await run_manager.on_llm_new_token(token)
+                yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+class WordEncoding:
+    """
+    Stand-in for the tiktoken encoding: one token per word and the spacing
+    after it, so decoding a prefix of the tokens gives a prefix of the text.
+    """
+
+    @staticmethod
+    def encode(text: str) -> List[str]:
+        return re.findall(r"\s*\S+\s*", text)
+
+    @staticmethod
+    def decode(tokens: List[str]) -> str:
+        return "".join(tokens)
+
+
+def make_documents(count: int, seed: int = 0) -> List[Document]:
+    rng = random.Random(seed)
+    return [Document(page_content=" ".join(rng.choice(WORDS) for _ in range(120)),
+                     metadata={"source": f"bench-{i // 10}.pdf", "page": i % 10})
+            for i in range(count)]
+
+
+def install(latency: float, tokens_per_second: float, documents: int, embedding_size: int = 384):
+    """
+    Replace the chat model, the embedding model, the vector store and the
+    tokenizer, and index `documents` synthetic chunks in the vector store
+    and BM25 index.
+    """
+    from src.utils import history, rag, weavite
+
+    history._encoding = WordEncoding
+
+    weavite.HuggingFaceHubEmbeddings = lambda: DeterministicFakeEmbedding(size=embedding_size)
+    store = InMemoryVectorStore(embedding=weavite.get_embeddings())
+    llm = FakeChatModel(latency=latency, tokens_per_second=tokens_per_second)
+    rag.get_vector_store = lambda: store
+    rag.get_llm = lambda: llm
+
+    chunks = make_documents(documents)
+    ids = [f"bench-{i}" for i in range(len(chunks))]
+    store.add_documents(chunks, ids=ids)
+    weavite.get_bm25_index().add(ids, chunks)
@@ -0,0 +1,12 @@
+#! /usr/bin/env sh
+
+set -e
+
+# Every process of the prefork pool writes its metrics here and the main
+# worker process serves their sum on CELERY_METRICS_PORT; stale files of a
+# previous run would be counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc_celery}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+exec celery -A src.core.celery_config.celery_app worker --loglevel=info "$@"
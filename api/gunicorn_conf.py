@@ -49,6 +49,13 @@ timeout = int(timeout_str)
 keepalive = int(keepalive_str)
 
 
+def child_exit(server, worker):
+    # Keep the metrics files of a dead worker from being read as live
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
 # For debugging and testing
 log_data = {
     "loglevel": loglevel,
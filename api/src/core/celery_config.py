@@ -1,10 +1,13 @@
+import os
 from celery import Celery
-from src.core.db import REDIS_URL
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+from src.core.db import REDIS_URL, open_connections, close_sync_connections, reset_connections
+from src.core.config import config
 celery_app = Celery(
     'chat_service',
     broker='redis://redis:6379/0',  # Redis database 0 for the broker
     backend='redis://redis:6379/0',  # Redis database 0 for the backend
-    include=['src.services.chat.background_tasks']  # Include your tasks module
+    include=['src.services.chat.background_tasks', 'src.services.file_tasks']  # Include your tasks modules
 )
 
 celery_app.conf.update(
@@ -14,4 +17,35 @@ celery_app.conf.update(
     accept_content=['json'],
     timezone='UTC',
     enable_utc=True,
+    redis_max_connections=config.REDIS_MAX_CONNECTIONS,
+    beat_schedule={
+        'sweep-idle-sessions': {
+            'task': 'src.services.chat.background_tasks.sweep_idle_sessions',
+            'schedule': config.SESSION_SWEEP_INTERVAL,
+        },
+    },
 )
+
+
+@worker_init.connect
+def serve_worker_metrics(**kwargs):
+    """Serve the metrics of the whole pool from the main worker process."""
+    if config.CELERY_METRICS_PORT:
+        from src.utils import metrics
+        metrics.serve(config.CELERY_METRICS_PORT)
+
+
+@worker_process_init.connect
+def init_worker_connections(**kwargs):
+    """Open the pooled clients shared by every task of this worker process."""
+    # Clients created in the prefork parent are not fork-safe
+    reset_connections()
+    open_connections()
+
+
+@worker_process_shutdown.connect
+def close_worker_connections(**kwargs):
+    close_sync_connections()
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
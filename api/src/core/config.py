@@ -13,6 +13,105 @@ class Config(BaseSettings):
     CHUNK_SIZE: str = Field(default=500, env="CHUNK_SIZE")
     WEAVIATE_URL: str = Field(default="langllm_weaviate_1")
     STARTUP_PERIOD: str = Field(default=None, env="STARTUP_PERIOD")
+    # Ingestion pipeline: chunks per embedding/write batch and how many
+    # batches each stage may buffer ahead of the next one
+    INGEST_BATCH_SIZE: int = Field(default=32, env="INGEST_BATCH_SIZE")
+    INGEST_QUEUE_SIZE: int = Field(default=4, env="INGEST_QUEUE_SIZE")
+    # PDF parsing: with more than one worker, page ranges are extracted in as
+    # many processes, started from the Celery worker process
+    PDF_PARSE_WORKERS: int = Field(default=1, env="PDF_PARSE_WORKERS")
+    PDF_PAGES_PER_TASK: int = Field(default=8, env="PDF_PAGES_PER_TASK")
+    # Embedding cache: Redis entries expire after the TTL (seconds), the disk
+    # tier keeps at most EMBEDDING_CACHE_MAX_DISK_ENTRIES vectors
+    EMBEDDING_CACHE_ENABLED: bool = Field(default=True, env="EMBEDDING_CACHE_ENABLED")
+    EMBEDDING_CACHE_DIR: str = Field(default="/app/data/embedding_cache", env="EMBEDDING_CACHE_DIR")
+    EMBEDDING_CACHE_TTL: int = Field(default=30 * 24 * 3600, env="EMBEDDING_CACHE_TTL")
+    EMBEDDING_CACHE_MAX_DISK_ENTRIES: int = Field(default=200000, env="EMBEDDING_CACHE_MAX_DISK_ENTRIES")
+    # Retrieval: "vector" (Weaviate only) or "hybrid" (BM25 + vector fused
+    # with reciprocal rank fusion)
+    RETRIEVAL_MODE: str = Field(default="hybrid", env="RETRIEVAL_MODE")
+    RETRIEVAL_K: int = Field(default=4, env="RETRIEVAL_K")
+    HYBRID_RRF_K: int = Field(default=60, env="HYBRID_RRF_K")
+    LEXICAL_FAST_PATH: bool = Field(default=True, env="LEXICAL_FAST_PATH")
+    # Postings read per query term by BM25, best weighted first
+    BM25_POSTINGS_LIMIT: int = Field(default=1000, env="BM25_POSTINGS_LIMIT")
+    # Context packing between retrieval and the prompt: overlapping chunks of
+    # a page are merged, chunks repeating CONTEXT_DUPLICATE_THRESHOLD of a
+    # kept one dropped, and the context cut at CONTEXT_TOKEN_BUDGET tokens
+    # (0 for no limit); CONTEXT_MMR first selects RETRIEVAL_K of the best
+    # CONTEXT_MMR_FETCH_K retrieved chunks by maximal marginal relevance
+    # (1 = relevance only, 0 = diversity only)
+    CONTEXT_PACKING: bool = Field(default=True, env="CONTEXT_PACKING")
+    CONTEXT_TOKEN_BUDGET: int = Field(default=3000, env="CONTEXT_TOKEN_BUDGET")
+    CONTEXT_DUPLICATE_THRESHOLD: float = Field(default=0.8, env="CONTEXT_DUPLICATE_THRESHOLD")
+    CONTEXT_MMR: bool = Field(default=False, env="CONTEXT_MMR")
+    CONTEXT_MMR_LAMBDA: float = Field(default=0.5, env="CONTEXT_MMR_LAMBDA")
+    CONTEXT_MMR_FETCH_K: int = Field(default=20, env="CONTEXT_MMR_FETCH_K")
+    # Local read replica of the vector index: vectors memory-mapped from
+    # VECTOR_REPLICA_DIR (shared by the workers of a host through the page
+    # cache), synced from the index change log every
+    # VECTOR_REPLICA_SYNC_INTERVAL seconds. VECTOR_REPLICA_NLIST > 0 adds
+    # an approximate (IVF) index searching VECTOR_REPLICA_NPROBE lists.
+    # Must be enabled for the ingestion workers too, they write the log
+    VECTOR_REPLICA_ENABLED: bool = Field(default=False, env="VECTOR_REPLICA_ENABLED")
+    VECTOR_REPLICA_DIR: str = Field(default="/app/data/vector_replica", env="VECTOR_REPLICA_DIR")
+    VECTOR_REPLICA_SYNC_INTERVAL: float = Field(default=5, env="VECTOR_REPLICA_SYNC_INTERVAL")
+    VECTOR_REPLICA_LOG_MAXLEN: int = Field(default=10000, env="VECTOR_REPLICA_LOG_MAXLEN")
+    VECTOR_REPLICA_NLIST: int = Field(default=0, env="VECTOR_REPLICA_NLIST")
+    VECTOR_REPLICA_NPROBE: int = Field(default=16, env="VECTOR_REPLICA_NPROBE")
+    # Answer cache for /chat/question; a similarity of 0 matches exact
+    # (normalized) questions only
+    ANSWER_CACHE_ENABLED: bool = Field(default=True, env="ANSWER_CACHE_ENABLED")
+    ANSWER_CACHE_TTL: int = Field(default=24 * 3600, env="ANSWER_CACHE_TTL")
+    ANSWER_CACHE_MAX_ENTRIES: int = Field(default=1000, env="ANSWER_CACHE_MAX_ENTRIES")
+    ANSWER_CACHE_SIMILARITY: float = Field(default=0.95, env="ANSWER_CACHE_SIMILARITY")
+    # Identical questions asked while their answer is being generated wait
+    # for it, for up to SINGLE_FLIGHT_TIMEOUT seconds, across workers
+    SINGLE_FLIGHT_ENABLED: bool = Field(default=True, env="SINGLE_FLIGHT_ENABLED")
+    SINGLE_FLIGHT_TIMEOUT: int = Field(default=60, env="SINGLE_FLIGHT_TIMEOUT")
+    # Admission control for model calls: at most *_MAX_CONCURRENCY calls run
+    # at once per process, up to SCHEDULER_MAX_QUEUE more wait for up to
+    # SCHEDULER_QUEUE_TIMEOUT seconds, and *_RATE_LIMIT (calls per second,
+    # 0 for none) is shared by every worker through Redis, as is the cap of
+    # *_BACKGROUND_MAX_CONCURRENCY background calls running at once (0 for none)
+    LLM_MAX_CONCURRENCY: int = Field(default=8, env="LLM_MAX_CONCURRENCY")
+    LLM_RATE_LIMIT: float = Field(default=0, env="LLM_RATE_LIMIT")
+    LLM_RATE_BURST: int = Field(default=10, env="LLM_RATE_BURST")
+    LLM_BACKGROUND_MAX_CONCURRENCY: int = Field(default=2, env="LLM_BACKGROUND_MAX_CONCURRENCY")
+    EMBEDDING_MAX_CONCURRENCY: int = Field(default=8, env="EMBEDDING_MAX_CONCURRENCY")
+    EMBEDDING_RATE_LIMIT: float = Field(default=0, env="EMBEDDING_RATE_LIMIT")
+    EMBEDDING_RATE_BURST: int = Field(default=10, env="EMBEDDING_RATE_BURST")
+    EMBEDDING_BACKGROUND_MAX_CONCURRENCY: int = Field(default=2, env="EMBEDDING_BACKGROUND_MAX_CONCURRENCY")
+    SCHEDULER_MAX_QUEUE: int = Field(default=64, env="SCHEDULER_MAX_QUEUE")
+    SCHEDULER_QUEUE_TIMEOUT: float = Field(default=30, env="SCHEDULER_QUEUE_TIMEOUT")
+    # Chat history given to the chain: "full", or "summary" to keep the last
+    # HISTORY_TOKEN_LIMIT tokens verbatim after a running summary
+    HISTORY_MODE: str = Field(default="full", env="HISTORY_MODE")
+    HISTORY_TOKEN_LIMIT: int = Field(default=1000, env="HISTORY_TOKEN_LIMIT")
+    # Format new chat messages are written to Redis in: "json" (readable by
+    # LangChain's RedisChatMessageHistory) or the compact "msgpack"
+    MESSAGE_CODEC: str = Field(default="json", env="MESSAGE_CODEC")
+    # Session tiering: sessions idle for SESSION_IDLE_TTL seconds are archived
+    # to MongoDB by a beat sweep every SESSION_SWEEP_INTERVAL seconds, which
+    # also archives the least recently active ones beyond SESSION_MAX_ACTIVE
+    SESSION_IDLE_TTL: int = Field(default=24 * 3600, env="SESSION_IDLE_TTL")
+    SESSION_MAX_ACTIVE: int = Field(default=10000, env="SESSION_MAX_ACTIVE")
+    SESSION_SWEEP_INTERVAL: int = Field(default=300, env="SESSION_SWEEP_INTERVAL")
+    SESSION_SWEEP_BATCH: int = Field(default=100, env="SESSION_SWEEP_BATCH")
+    # Connection pools, per process: a request waits up to
+    # REDIS_POOL_TIMEOUT seconds for a free Redis connection
+    MONGO_MAX_POOL_SIZE: int = Field(default=100, env="MONGO_MAX_POOL_SIZE")
+    MONGO_MIN_POOL_SIZE: int = Field(default=0, env="MONGO_MIN_POOL_SIZE")
+    REDIS_MAX_CONNECTIONS: int = Field(default=50, env="REDIS_MAX_CONNECTIONS")
+    REDIS_POOL_TIMEOUT: int = Field(default=20, env="REDIS_POOL_TIMEOUT")
+    # Startup: connect the clients and build the chains in the background
+    # right after start; when off everything is built on first use
+    WARM_UP: bool = Field(default=True, env="WARM_UP")
+    # Tracing: chain runs slower than TRACE_SLOW_SECONDS are logged with the
+    # time spent in each stage (0 to log none)
+    TRACE_SLOW_SECONDS: float = Field(default=10, env="TRACE_SLOW_SECONDS")
+    # Port the Celery worker serves the metrics of its pool on (0 for none)
+    CELERY_METRICS_PORT: int = Field(default=9808, env="CELERY_METRICS_PORT")
     
 
     class Config:
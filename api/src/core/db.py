@@ -1,8 +1,16 @@
 import os
-from pymongo import MongoClient
+import logging
+import threading
+from pymongo import ASCENDING, DESCENDING, MongoClient
 from pymongo.collection import Collection
-from redis import Redis
+from pymongo.monitoring import ConnectionPoolListener
+from redis import BlockingConnectionPool, Redis
+from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis
 import weaviate
+from src.core.config import config
+
+logger = logging.getLogger(__name__)
 
 # # # MongoDB configuration
 # MONGO_USER = os.getenv('MONGO_USER', default="username")  # Optional
@@ -22,23 +30,210 @@ def get_mongo_url():
     return mongo_url
 
 
-# Connect to MongoDB
-mongo_url = get_mongo_url()
-client = MongoClient(mongo_url)
-database = client[MONGO_DB_NAME]
+REDIS_URL = "redis://redis:6379"
+
+
+class MongoPoolMonitor(ConnectionPoolListener):
+    '''
+    Counts the connections of this process's MongoDB pools
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(
+            ("created", "closed", "checked_out", "check_out_failures"), 0)
+
+    def _add(self, field, value=1):
+        with self._lock:
+            self.counts[field] += value
+
+    def connection_created(self, event):
+        self._add("created")
+
+    def connection_closed(self, event):
+        self._add("closed")
+
+    def connection_checked_out(self, event):
+        self._add("checked_out")
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def connection_check_out_failed(self, event):
+        self._add("check_out_failures")
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+        return {
+            "max_pool_size": config.MONGO_MAX_POOL_SIZE,
+            "open": counts["created"] - counts["closed"],
+            "in_use": counts["checked_out"],
+            "utilization": counts["checked_out"] / config.MONGO_MAX_POOL_SIZE,
+            "check_out_failures": counts["check_out_failures"],
+        }
+
+
+mongo_pool_monitor = MongoPoolMonitor()
+
+# Clients of this process, created on first use (or by open_connections at
+# startup) and closed by close_connections at shutdown
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def get_mongo_client() -> MongoClient:
+    return _get_client("mongo", lambda: MongoClient(
+        get_mongo_url(),
+        maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+        minPoolSize=config.MONGO_MIN_POOL_SIZE,
+        event_listeners=[mongo_pool_monitor]))
+
 
 def get_collection(collection_name: str) -> Collection:
     '''
     Get a collection from the database
     '''
-    return database[collection_name]
+    return get_mongo_client()[MONGO_DB_NAME][collection_name]
 
 
-REDIS_URL = "redis://redis:6379"
-redis_client = Redis.from_url(REDIS_URL)
+def get_redis() -> Redis:
+    return _get_client("redis", lambda: Redis(connection_pool=BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT)))
+
+
+# Async client for the request path of async endpoints
+def get_async_redis() -> AsyncRedis:
+    return _get_client("async_redis", lambda: AsyncRedis(connection_pool=AsyncBlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT)))
+
+
+def get_weaviate():
+    return _get_client("weaviate", lambda: weaviate.connect_to_local(host="weaviate", port=8080, grpc_port=50051))
+
+
+def open_connections():
+    '''
+    Create every client up front, so the first requests do not pay for it
+    '''
+    get_mongo_client()
+    get_redis()
+    get_async_redis()
+    get_weaviate()
+
+
+def reset_connections():
+    '''
+    Forget the clients inherited from the parent process without closing them,
+    so a forked worker creates its own: their sockets belong to the parent
+    '''
+    with _clients_lock:
+        _clients.clear()
+
+
+async def close_connections():
+    '''
+    Close every client of this process and their pools
+    '''
+    with _clients_lock:
+        clients = dict(_clients)
+        _clients.clear()
+    if "async_redis" in clients:
+        await clients["async_redis"].aclose()
+    close_sync_connections(clients)
+
+
+def close_sync_connections(clients=None):
+    '''
+    Close the synchronous clients; for processes without an event loop
+    '''
+    if clients is None:
+        with _clients_lock:
+            clients = {name: _clients.pop(name) for name in list(_clients) if name != "async_redis"}
+    for name in ("mongo", "redis", "weaviate"):
+        client = clients.get(name)
+        if client is None:
+            continue
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"Error closing the {name} client: {e}")
 
-def get_redis():
-    return redis_client
 
+def _redis_pool_stats(pool) -> dict:
+    if hasattr(pool, "_in_use_connections"):
+        # asyncio pool
+        in_use = len(pool._in_use_connections)
+        idle = len(pool._available_connections)
+    else:
+        # Idle connections wait in the queue, slots never used hold None
+        idle = sum(1 for connection in list(pool.pool.queue) if connection is not None)
+        in_use = len(pool._connections) - idle
+    return {
+        "max_connections": pool.max_connections,
+        "open": in_use + idle,
+        "in_use": in_use,
+        "utilization": in_use / pool.max_connections,
+    }
 
-weaviate_client = weaviate.connect_to_local(host="weaviate",port=8080, grpc_port=50051)
+
+def pool_stats() -> dict:
+    '''
+    Connection pool utilization of this process, to size the pools under load
+    '''
+    stats = {"pid": os.getpid(), "mongo": mongo_pool_monitor.stats()}
+    for name in ("redis", "async_redis"):
+        client = _clients.get(name)
+        if client is not None:
+            stats[name] = _redis_pool_stats(client.connection_pool)
+    return stats
+
+
+def ensure_indexes():
+    '''
+    Create the MongoDB indexes the services query by; safe to run on every start
+    '''
+    indexes = [
+        ("chat_sessions", [("user_id", ASCENDING), ("session_id", ASCENDING)], {}),
+        ("chat_sessions", [("user_id", ASCENDING), ("updated_at", DESCENDING)], {}),
+        ("chat_sessions", [("session_id", ASCENDING)], {}),
+        ("users", [("email", ASCENDING)], {"unique": True}),
+    ]
+    for collection_name, keys, options in indexes:
+        try:
+            get_collection(collection_name).create_index(keys, **options)
+        except Exception as e:
+            # e.g. duplicate emails already stored; the service still works
+            logger.error(f"Could not create index {keys} on {collection_name}: {e}")
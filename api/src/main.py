@@ -1,18 +1,81 @@
-from fastapi import FastAPI
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import RedirectResponse
+from starlette.responses import JSONResponse, RedirectResponse, Response
 
 # Import routers from services
 from src.services.user.user import router as user_router
 from src.services.file import router as file_router
 from src.services.chat.chat import router as chat_router
 from src.services.chat.chat_socket import router as socket_router
+from src.core.config import config
 from src.core.logging_config import setup_logging
+from src.core.db import ensure_indexes, open_connections, close_connections, pool_stats
+from src.utils.weavite import close_async_weaviate_client, sync_vector_replica
+from src.utils import metrics, rag
+from src.utils.scheduler import Overloaded, get_embedding_scheduler, get_llm_scheduler
 
 # Initialize logging
 setup_logging()
+logger = logging.getLogger(__name__)
+
+
+async def warm_up():
+    """
+    Open the connection pools, provision the MongoDB indexes and build the
+    chains. Runs alongside the first requests; anything not ready yet is
+    built by whichever request needs it first.
+    """
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for step in (open_connections, ensure_indexes, rag.warm_up):
+        try:
+            await asyncio.to_thread(step)
+        except Exception as e:
+            logger.error(f"Warm-up step {step.__name__} failed: {e}")
+    logger.info(f"Warm-up finished in {loop.time() - start:.2f}s")
+
+
+async def sync_vector_replica_loop():
+    """
+    Keep the local vector replica in sync with the index. Every worker
+    tries; whichever gets the replica's lock first does the work.
+    """
+    while True:
+        try:
+            result = await asyncio.to_thread(sync_vector_replica)
+            if result and (result["applied"] or result["rebuilt"]):
+                logger.info(f"Vector replica synced: {result}")
+        except Exception as e:
+            logger.error(f"Vector replica sync failed: {e}")
+        await asyncio.sleep(config.VECTOR_REPLICA_SYNC_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Start warming up without holding back the first requests, keep the
+    vector replica in sync, and close every client on shutdown.
+    """
+    tasks = []
+    if config.WARM_UP:
+        tasks.append(asyncio.create_task(warm_up()))
+    if config.VECTOR_REPLICA_ENABLED:
+        tasks.append(asyncio.create_task(sync_vector_replica_loop()))
+    yield
+    for task in tasks:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    await close_async_weaviate_client()
+    await close_connections()
 
 app = FastAPI(
+    lifespan=lifespan,
     debug=True,
     title="LangChain Service",
     description="API server providing various functionalities including user operations, file handling, and chat services."
@@ -27,6 +90,17 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """
+    Turn away requests the model schedulers cannot serve in time.
+    """
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # Redirect root path to API documentation
 @app.get("/", include_in_schema=False)
 def root_redirect():
@@ -35,6 +109,29 @@ def root_redirect():
     """
     return RedirectResponse(url="/docs/")
 
+@app.get("/pool-stats", tags=["Monitoring"])
+def get_pool_stats():
+    """
+    Connection pool utilization of the worker serving the request.
+    """
+    return pool_stats()
+
+@app.get("/scheduler-stats", tags=["Monitoring"])
+def get_scheduler_stats():
+    """
+    Running and queued model calls of the worker serving the request.
+    """
+    return {"llm": get_llm_scheduler().stats(), "embedding": get_embedding_scheduler().stats()}
+
+@app.get("/metrics", tags=["Monitoring"])
+def get_metrics():
+    """
+    Stage latencies and token counts of the RAG chains, and embedding
+    latencies, in the Prometheus text format, for every worker.
+    """
+    data, content_type = metrics.render()
+    return Response(content=data, media_type=content_type)
+
 # Include routers with specific prefixes and tags for API endpoints
 app.include_router(user_router, prefix="/user", tags=["User Operations"])
 app.include_router(file_router, prefix="/data", tags=["Data Operations"])
@@ -1,40 +1,41 @@
 from src.core.celery_config import celery_app
-from src.services.chat.crud_chat import ChatService
-from src.core.db import get_collection, get_redis
+from src.services.chat.chat import get_chat_service
+from src.core.db import get_redis
+from src.core.config import config
+from src.utils.utils import get_summary_history
+from src.utils.rag import summarize_conversation
+from src.utils.scheduler import Overloaded, Priority, request_priority
+from src.utils.single_flight import RELEASE_LOCK_SCRIPT
 import logging
+import uuid
 
 logger = logging.getLogger(__name__)
 
-mongo_collection = get_collection("chat_sessions")
-redis_client = get_redis()
+SWEEP_LOCK_KEY = "session_sweep_lock"
 
-chat_service = ChatService(mongo_collection, redis_client)
+# Pushes back the expiry of a lock only while it still holds our token
+EXTEND_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
 
 
 @celery_app.task
 def move_chat_data_to_mongo(user_id, session_id):
     """Move chat data from Redis to MongoDB when session expires."""
     logger.info(f"Starting to move chat data for user_id={user_id}, session_id={session_id}")
-    chat_data = chat_service.fetch_chat_redis(session_id=session_id, user_id=user_id)
-    if chat_data:
-        existing_chat_data = chat_service.fetch_chat_mongo(session_id=session_id, user_id=user_id)
-        if existing_chat_data:
-            chat_service.update_chat_mongo(chat_data)
-            logger.info(f"Updated chat data in MongoDB for session_id={session_id}")
-        else:
-            chat_service.store_chat_mongo(chat_data)
-            logger.info(f"Stored chat data in MongoDB for session_id={session_id}")
-
-        chat_service.delete_chat_redis(session_id=session_id, user_id=user_id)
-        logger.info(f"Deleted chat data from Redis for session_id={session_id}")
-    else:
-        logger.warning(f"No chat data found for user_id={user_id}, session_id={session_id}")
+    result = get_chat_service().expire_session(session_id=session_id, user_id=user_id)
+    logger.info(result)
+    return result
 
 
 @celery_app.task
 def restore_chat_data_to_redis(user_id: str, session_id: str):
     """Restore chat data from MongoDB to Redis when session is restored."""
     try:
+        chat_service = get_chat_service()
         chat_data = chat_service.fetch_chat_mongo(session_id, user_id)
         if chat_data:
             chat_service.store_chat_redis(chat_data)
@@ -43,3 +44,72 @@ def restore_chat_data_to_redis(user_id: str, session_id: str):
             logger.warning(f"No chat data found for session ID: {session_id} and user ID: {user_id}")
     except Exception as e:
         logger.error(f"Error occurred while restoring chat data for session ID: {session_id} and user ID: {user_id}: {e}")
+
+
+@celery_app.task(bind=True, max_retries=5)
+def summarize_chat_history(self, session_id: str):
+    """Fold messages that left the verbatim history window into the running summary."""
+    # Yields to interactive traffic; retried later when the LLM is saturated
+    try:
+        with request_priority(Priority.BACKGROUND):
+            folded = get_summary_history(session_id).fold_summary(summarize_conversation)
+    except Overloaded as e:
+        raise self.retry(exc=e, countdown=e.retry_after)
+    logger.info(f"Summarized {folded} messages for session {session_id}")
+
+
+@celery_app.task
+def rebuild_session_index():
+    """Index Redis sessions created before the per-user session index existed."""
+    indexed = get_chat_service().rebuild_session_index()
+    logger.info(f"Indexed {indexed} chat sessions")
+    return indexed
+
+
+@celery_app.task
+def archive_chat_sessions(sessions):
+    """Move many [user_id, session_id] sessions from Redis to MongoDB in one batch."""
+    result = get_chat_service().archive_sessions(sessions)
+    logger.info(f"Archived {result['archived']} of {len(sessions)} sessions to MongoDB: {result}")
+    return result
+
+
+@celery_app.task
+def sweep_idle_sessions():
+    """Archive idle sessions, and the least active ones beyond the working-set size, to MongoDB."""
+    # Beat may fire again while a long sweep is still running. The lock holds
+    # a token of this run: it is extended after every batch, and released
+    # only if it was not lost to another run in the meantime
+    redis_client = get_redis()
+    token = uuid.uuid4().hex
+    lock_ttl = max(config.SESSION_SWEEP_INTERVAL, 60)
+    if not redis_client.set(SWEEP_LOCK_KEY, token, nx=True, ex=lock_ttl):
+        logger.info("Session sweep already running, skipping")
+        return 0
+    extend_lock = redis_client.register_script(EXTEND_LOCK_SCRIPT)
+    release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+    archived = 0
+    try:
+        while True:
+            due = get_chat_service().idle_sessions(
+                idle_ttl=config.SESSION_IDLE_TTL,
+                max_active=config.SESSION_MAX_ACTIVE,
+                limit=config.SESSION_SWEEP_BATCH)
+            if not due:
+                break
+            result = archive_chat_sessions(due)
+            archived += result["archived"]
+            # Sessions that could not be archived would come back in the
+            # next batch; leave them for the next sweep
+            left = len(due) - result["missing"] - result["quarantined"]
+            if len(due) < config.SESSION_SWEEP_BATCH or result["archived"] < left:
+                break
+            if not extend_lock(keys=[SWEEP_LOCK_KEY], args=[token, lock_ttl]):
+                logger.warning("Session sweep lost its lock, leaving the rest to the next sweep")
+                break
+    except Exception as e:
+        logger.error(f"Session sweep stopped after archiving {archived} sessions: {e}")
+    finally:
+        release_lock(keys=[SWEEP_LOCK_KEY], args=[token])
+    logger.info(f"Archived {archived} idle sessions to MongoDB")
+    return archived
@@ -1,14 +1,19 @@
 import redis
 import uuid
 import os
-from typing import List, Dict, Tuple , Union
+import json
+from datetime import datetime
+from typing import List, Dict, Tuple , Union, Optional
 from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Depends, Query
-from src.utils.rag import conversational_rag_chain, rag_answer
+from fastapi.responses import StreamingResponse
+from src.utils.rag import get_conversational_rag_chain, aanswer_question, astream_conversational_answer
 from src.utils.utils import get_all_conversations
 from src.core.db import get_collection, get_redis
-from src.services.chat.schema import ChatMessage, ChatSession
+from src.core.config import config
+from src.services.chat.schema import ChatMessage, ChatMessagePage, ChatSession, ChatSessionSummary
 from src.services.chat.crud_chat import ChatService
 from src.core.celery_config import celery_app
+from src.utils.scheduler import Overloaded
 
 router = APIRouter()
 
@@ -19,7 +24,7 @@ def get_chat_service() -> ChatService:
     """
     mongo_collection = get_collection("chat_sessions")
     redis_client = get_redis()
-    return ChatService(mongo_collection, redis_client)
+    return ChatService(mongo_collection, redis_client, codec=config.MESSAGE_CODEC)
 
 
 @router.delete("/clean_redis_db")
@@ -37,15 +42,60 @@ def start_chat_session(user_id: str, service: ChatService = Depends(get_chat_ser
 
 
 @router.get("/session/{user_id}/")
-def get_user_session(user_id: str, service: ChatService = Depends(get_chat_service)) -> List[ChatSession]:
-    """Retrieve chat history from Redis for a specific session."""
-    return service.get_user_chat_sessions(user_id)
+def get_user_session(
+    user_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    before: Optional[datetime] = Query(None, description="updated_at of the last session of the previous page"),
+    before_id: Optional[str] = Query(None, description="session_id of the last session of the previous page"),
+    service: ChatService = Depends(get_chat_service),
+) -> List[ChatSession]:
+    """Retrieve a user's chat sessions, most recently updated first."""
+    return service.get_user_chat_sessions(user_id, limit=limit, before=before, before_id=before_id)
+
+
+@router.get("/session/{user_id}/summary")
+def get_user_session_summaries(
+    user_id: str,
+    limit: Optional[int] = Query(None, ge=1),
+    before: Optional[datetime] = Query(None, description="updated_at of the last session of the previous page"),
+    before_id: Optional[str] = Query(None, description="session_id of the last session of the previous page"),
+    service: ChatService = Depends(get_chat_service),
+) -> List[ChatSessionSummary]:
+    """List a user's chat sessions without their messages, most recently updated first."""
+    return service.get_user_session_summaries(user_id, limit=limit, before=before, before_id=before_id)
 
 
 @router.get("/{user_id}/{session_id}/redis_history")
-def fetch_chat_redis(session_id: str, user_id: str, service: ChatService = Depends(get_chat_service)) -> Union[ChatSession, None]:
+def fetch_chat_redis(
+    session_id: str,
+    user_id: str,
+    limit: Optional[int] = Query(None, ge=1, description="Return one page of the history instead of all of it"),
+    before: Optional[int] = Query(None, ge=0, description="Position of the oldest message of the previous page"),
+    after: Optional[int] = Query(None, ge=0, description="Position of the newest message of the previous page"),
+    service: ChatService = Depends(get_chat_service),
+) -> Union[ChatSession, None]:
     """Retrieve chat history from Redis for a specific session."""
-    return service.fetch_chat_redis(user_id=user_id, session_id=session_id)
+    return service.fetch_chat_redis(user_id=user_id, session_id=session_id,
+                                    limit=limit, before=before, after=after)
+
+
+@router.get("/{user_id}/{session_id}/messages")
+def get_message_page(
+    session_id: str,
+    user_id: str,
+    limit: int = Query(50, ge=1, le=1000),
+    before: Optional[int] = Query(None, ge=0, description="`before` cursor of the page shown, for older messages"),
+    after: Optional[int] = Query(None, ge=0, description="`after` cursor of the page shown, for newer messages"),
+    service: ChatService = Depends(get_chat_service),
+) -> ChatMessagePage:
+    """
+    One page of a session's messages, newest first, from Redis or MongoDB.
+    Without a cursor the newest messages are returned.
+    """
+    page = service.get_message_page(session_id, user_id, limit, before=before, after=after)
+    if page is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return page
 
 
 @router.post("/redis")
@@ -75,9 +125,13 @@ def store_chat_mongo(chat_session: ChatSession, service: ChatService = Depends(g
 
 
 @router.patch("/mongo/")
-def update_chat_mongo(session: ChatSession, service: ChatService = Depends(get_chat_service)) -> ChatSession:
+def update_chat_mongo(
+    session: ChatSession,
+    append: bool = Query(False, description="Push only the messages not stored yet"),
+    service: ChatService = Depends(get_chat_service),
+) -> ChatSession:
     """update chat session from Mongo for a specific session."""
-    return service.update_chat_mongo(session)
+    return service.update_chat_mongo(session, append=append)
 
 
 @router.delete("/mongo/")
@@ -98,12 +152,15 @@ def expire_session(session_id: str, user_id: str, service: ChatService = Depends
     """
     Expire a chat session and move its data from Redis to MongoDB.
     """
-    service.expire_session(session_id, user_id)
-    return {"detail": "Session expired and chat history stored in MongoDB"}
+    try:
+        detail = service.expire_session(session_id, user_id)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error archiving session {session_id}: {e}")
+    return {"detail": detail}
 
 
 @router.post("/question_aware_history")
-def chat_with_memory(
+async def chat_with_memory(
     qusetion: str = Form(..., description="please ask your question"),
     user_id: str = Form(..., description="please ask your question"),
     conversation_id: str = Form(..., description="please ask your question"),
@@ -111,36 +168,78 @@ def chat_with_memory(
     """
     Submit a question  and receive an answer base on conversation history and the RAG model. 
     """
-    return conversational_rag_chain.invoke(
+    result = await get_conversational_rag_chain().ainvoke(
         {"input": qusetion},
         config={
             "configurable": {"user_id": user_id, "conversation_id": conversation_id}
         },
-    )["answer"]
+    )
+    return result["answer"]
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    """
+    Format one Server-Sent Events message.
+    """
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+@router.post("/question_aware_history/stream")
+async def chat_with_memory_stream(
+    qusetion: str = Form(..., description="please ask your question"),
+    user_id: str = Form(..., description="please ask your question"),
+    conversation_id: str = Form(..., description="please ask your question"),
+):
+    """
+    Same as /question_aware_history, but the answer is streamed token by token
+    as Server-Sent Events, followed by an `end` event with the full answer.
+    """
+    async def events():
+        answer = []
+        try:
+            async for token in astream_conversational_answer(qusetion, user_id, conversation_id):
+                answer.append(token)
+                yield sse_event({"token": token})
+        except Overloaded as e:
+            # The response has started, the error can only be an event
+            yield sse_event({"detail": e.detail, "retry_after": e.retry_after}, event="error")
+            return
+        yield sse_event({"answer": "".join(answer)}, event="end")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @router.post("/question")
-def chat(
+async def chat(
     question: str = Form(..., description="please ask your question")
 ):
     """
-    Submit a question and receive an answer from the RAG model.
+    Submit a question and receive an answer from the RAG model, served from
+    the answer cache when the same or a near-identical question was answered
+    since the documents last changed.
     """
-    return rag_answer(question)
+    return await aanswer_question(question)
 
 
 @router.get("/conversations-messages")
 def get_conv(
     user_id: str = Query(..., description="please add your user id"),
     conversation_id: str = Query(...,
-                                 description="please  add conversation id")
+                                 description="please  add conversation id"),
+    limit: Optional[int] = Query(None, ge=1, description="Return one page of the messages instead of all of them"),
+    before: Optional[int] = Query(None, ge=0, description="Position of the oldest message of the previous page"),
+    after: Optional[int] = Query(None, ge=0, description="Position of the newest message of the previous page"),
 ):
     """
-    Retrieve all messages from a specific conversation.
+    Retrieve all messages from a specific conversation, oldest first.
     """
     return get_all_conversations(
         user_id=user_id,
-        conversation_id=conversation_id
+        conversation_id=conversation_id,
+        limit=limit,
+        before=before,
+        after=after,
     )
 
 
@@ -152,9 +251,33 @@ async def move_chat_data(user_id: str, session_id: str):
     return {"task_id": result.id}
 
 
+@router.post("/archive-chat-data/")
+async def archive_chat_data(sessions: List[Tuple[str, str]]):
+    """Endpoint to trigger the archive_chat_sessions task for many (user_id, session_id) pairs."""
+    result = celery_app.send_task(
+        'src.services.chat.background_tasks.archive_chat_sessions', args=[sessions])
+    return {"task_id": result.id}
+
+
 @router.post("/restore-chat-data/")
 async def restore_chat_data(user_id: str, session_id: str):
     """Endpoint to trigger the restore_chat_data_to_redis task."""
     result = celery_app.send_task(
         'src.services.chat.background_tasks.restore_chat_data_to_redis', args=[user_id, session_id])
     return {"task_id": result.id}
+
+
+@router.post("/session-index/rebuild")
+async def rebuild_session_index():
+    """Endpoint to trigger the rebuild_session_index task."""
+    result = celery_app.send_task(
+        'src.services.chat.background_tasks.rebuild_session_index')
+    return {"task_id": result.id}
+
+
+@router.post("/sweep-idle-sessions/")
+async def sweep_idle_sessions():
+    """Endpoint to trigger the sweep_idle_sessions task."""
+    result = celery_app.send_task(
+        'src.services.chat.background_tasks.sweep_idle_sessions')
+    return {"task_id": result.id}
@@ -2,7 +2,8 @@
 from fastapi import APIRouter, WebSocket
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
-from src.utils.rag import conversational_rag_chain, rag_answer
+from src.utils.rag import astream_answer, astream_conversational_answer
+from src.utils.scheduler import Overloaded, Priority, request_priority
 
 router = APIRouter()
 
@@ -21,13 +22,20 @@ html = """
         <ul id='messages'>
         </ul>
         <script>
-            var ws = new WebSocket("ws://localhost:8000/ws");
+            var ws = new WebSocket("ws://localhost:8000/socket/chating/ws");
+            var current = null;
             ws.onmessage = function(event) {
-                var messages = document.getElementById('messages')
-                var message = document.createElement('li')
-                var content = document.createTextNode(event.data)
-                message.appendChild(content)
-                messages.appendChild(message)
+                var data = JSON.parse(event.data)
+                if (data.type === "end") {
+                    current = null
+                    return
+                }
+                if (current === null) {
+                    var messages = document.getElementById('messages')
+                    current = document.createElement('li')
+                    messages.appendChild(current)
+                }
+                current.appendChild(document.createTextNode(data.content))
             };
             function sendMessage(event) {
                 var input = document.getElementById("messageText")
@@ -41,6 +49,25 @@ html = """
 """
 
 
+async def stream_to_socket(websocket: WebSocket, tokens):
+    """
+    Send each token as a {"type": "token"} message as soon as it is produced,
+    then a {"type": "end"} message carrying the full answer. Socket traffic
+    is served ahead of other model calls; when it is turned away anyway, an
+    {"type": "error"} message says when to retry.
+    """
+    answer = []
+    try:
+        with request_priority(Priority.INTERACTIVE):
+            async for token in tokens:
+                answer.append(token)
+                await websocket.send_json({"type": "token", "content": token})
+    except Overloaded as e:
+        await websocket.send_json({"type": "error", "detail": e.detail, "retry_after": e.retry_after})
+        return
+    await websocket.send_json({"type": "end", "answer": "".join(answer)})
+
+
 @router.get("/")
 async def get():
     return HTMLResponse(html)
@@ -51,19 +78,13 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     while True:
         question = await websocket.receive_text()
-        answer = rag_answer(question)  # Call the RAG answer function
-        await websocket.send_text(answer)
+        await stream_to_socket(websocket, astream_answer(question))
 
 
 @router.websocket("/chating_aware_history/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, user_id: str = "888", conversation_id: str = "22"):
     await websocket.accept()
     while True:
         question = await websocket.receive_text()
-        answer = conversational_rag_chain.invoke(
-            {"input": question},
-            config={
-                "configurable": {"user_id": "888", "conversation_id": "22"}
-            },
-        )["answer"]
-        await websocket.send_text(answer)
+        await stream_to_socket(
+            websocket, astream_conversational_answer(question, user_id, conversation_id))
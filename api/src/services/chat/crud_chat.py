@@ -1,40 +1,94 @@
+from pymongo import UpdateOne
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 from redis import Redis
-from typing import List, Optional
+from typing import Iterable, List, Optional, Tuple
 from datetime import datetime
-from src.services.chat.schema import ChatSession, ChatMessage
+from src.services.chat.schema import ChatSession, ChatMessage, ChatMessagePage, ChatSessionSummary
+from src.utils.history import PREVIEW_LENGTH, page_range
+from src.utils.message_codec import encode_message, decode_message, decode_messages
+from src.utils.session_index import (SESSION_ACTIVITY_KEY, user_sessions_key, touch_session,
+                                     mark_active, remove_session, quarantine_session, to_timestamp)
 import json
 import redis
+import time
+
+# Creates the session hash only if it does not exist yet, resets its message
+# list and summary and indexes it, in one atomic round-trip.
+# KEYS: session hash, message list, summary hash, user session index,
+#       session activity set
+# ARGV: session id, index score, then field/value pairs of the hash
+CREATE_SESSION_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('DEL', KEYS[2], KEYS[3])
+redis.call('ZADD', KEYS[4], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[5], ARGV[2], KEYS[1])
+return 1
+"""
+
+# Deletes archived sessions from Redis, skipping any whose message list grew
+# since it was read, so a message written during archival is never lost.
+# KEYS: session activity set, then per session: hash, message list, summary
+#       hash, user session index
+# ARGV: per session: message count when read, session id
+ARCHIVE_DELETE_SCRIPT = """
+local deleted = {}
+for i = 0, (#KEYS - 1) / 4 - 1 do
+    local k = 2 + i * 4
+    if redis.call('LLEN', KEYS[k + 1]) == tonumber(ARGV[i * 2 + 1]) then
+        redis.call('DEL', KEYS[k], KEYS[k + 1], KEYS[k + 2])
+        redis.call('ZREM', KEYS[k + 3], ARGV[i * 2 + 2])
+        redis.call('ZREM', KEYS[1], KEYS[k])
+        deleted[#deleted + 1] = 1
+    else
+        deleted[#deleted + 1] = 0
+    end
+end
+return deleted
+"""
 
 
 class ChatService:
-    def __init__(self, mongo_collection: Collection, redis_client: Redis):
+    def __init__(self, mongo_collection: Collection, redis_client: Redis, codec: str = "json"):
         """
-        Initialize the ChatService with MongoDB and Redis connections.
+        Initialize the ChatService with MongoDB and Redis connections, and the
+        codec messages are written to Redis with (any codec is read).
         """
         self.mongo_collection = mongo_collection
         self.redis_client = redis_client
+        self.codec = codec
+        self._create_session_script = redis_client.register_script(CREATE_SESSION_SCRIPT)
+        self._archive_delete_script = redis_client.register_script(ARCHIVE_DELETE_SCRIPT)
 
     def create_session(self, session_id: str, user_id: str):
         """
         Initialize a new chat session in Redis based on session id and user id
         """
         session_key = f"{user_id}:{session_id}"
+        now = datetime.utcnow()
         session_data = {
             "session_id": session_id,
             "user_id": user_id,
-            "created_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat(),
+            "created_at": now.isoformat(),
+            "updated_at": now.isoformat(),
             "status": "active",
             "initial_message": "User initiated a chat session.",
+            "message_count": 0,
         }
 
         try:
-            if self.redis_client.exists(session_key):
+            fields = [item for pair in session_data.items() for item in pair]
+            created = self._create_session_script(
+                keys=[session_key, f"message_store:{session_key}",
+                      f"message_summary:{session_key}", user_sessions_key(user_id),
+                      SESSION_ACTIVITY_KEY],
+                args=[session_id, to_timestamp(now), *fields])
+            if not created:
                 raise ValueError(
                     f"Session ID {session_id} already exists for user {user_id}.")
-            self.redis_client.hset(session_key, mapping=session_data)
-            self.redis_client.delete(f"message_store:{session_key}")
 
             return (
                 f"Session {session_id} created successfully for user {user_id}.")
@@ -62,41 +116,108 @@ class ChatService:
             print(f"Unexpected error: {e}")
             return None
 
-    def fetch_chat_history_redis(self, session_id: str, user_id: str):
+    def fetch_chat_history_redis(self, session_id: str, user_id: str, limit: Optional[int] = None,
+                                 before: Optional[int] = None, after: Optional[int] = None):
         """
-        Fetch the entire Chat history  for spacfic session object directly from Redis.
+        Fetch the entire Chat history  for spacfic session object directly from Redis,
+        or only one page of it when `limit` is given (see `page_range`).
         """
+        message_range = (0, -1) if limit is None else page_range(limit, before, after)
+        if message_range is None:
+            return []
         messages = self.redis_client.lrange(
-            f"message_store:{user_id}:{session_id}", 0, -1)
-        chat_history = []
-        for msg in messages:
-            try:
-                decoded_msg = json.loads(msg.decode('utf-8'))
-                chat_message = ChatMessage(**decoded_msg.get('data', {}))
-                chat_history.append(chat_message)
-            except json.JSONDecodeError as e:
-                return (f"Error decoding JSON: {e}")
-            except Exception as e:
-                return (f"Unexpected error: {e}")
-        return chat_history
+            f"message_store:{user_id}:{session_id}", *message_range)
+        try:
+            return self._decode_history(messages)
+        except json.JSONDecodeError as e:
+            return (f"Error decoding JSON: {e}")
+        except Exception as e:
+            return (f"Unexpected error: {e}")
 
-    def fetch_chat_redis(self, session_id: str, user_id: str):
+    @staticmethod
+    def _decode_history(items: list) -> List[ChatMessage]:
         """
-        Fetch the entire ChatSession data directly from Redis.
+        Turn a message list read from Redis (JSON or binary entries) into
+        ChatMessages in one pass, skipping per-message validation.
+        """
+        return [ChatMessage.model_construct(**message.get("data", {}))
+                for message in decode_messages(items)]
+
+    def fetch_chat_redis(self, session_id: str, user_id: str, limit: Optional[int] = None,
+                         before: Optional[int] = None, after: Optional[int] = None):
         """
-        chat_history = self.fetch_chat_history_redis(user_id=user_id,session_id=session_id)
+        Fetch the entire ChatSession data directly from Redis, with one page
+        of its history when `limit` is given.
+        """
+        chat_history = self.fetch_chat_history_redis(user_id=user_id, session_id=session_id,
+                                                     limit=limit, before=before, after=after)
         chat_session = self.fetch_chat_session_redis(user_id=user_id, session_id=session_id)
         if chat_session is not None: 
             chat_session.chat_history = chat_history
             return chat_session
         return None
 
+    def get_message_page(self, session_id: str, user_id: str, limit: int,
+                         before: Optional[int] = None, after: Optional[int] = None) -> Optional[ChatMessagePage]:
+        """
+        One page of a session's messages (see `page_range`), read from Redis
+        or, for an archived session, from MongoDB. Only the page is read,
+        along with the message count.
+        """
+        message_range = page_range(limit, before, after)
+        message_store_key = f"message_store:{user_id}:{session_id}"
+        pipe = self.redis_client.pipeline()
+        pipe.exists(f"{user_id}:{session_id}")
+        pipe.llen(message_store_key)
+        if message_range is not None:
+            pipe.lrange(message_store_key, *message_range)
+        exists, total, *items = pipe.execute()
+        if exists or total:
+            messages = self._decode_history(items[0]) if items else []
+        else:
+            archived = self._fetch_message_page_mongo(session_id, user_id, message_range)
+            if archived is None:
+                return None
+            total, messages = archived
+
+        if not messages:
+            return ChatMessagePage(messages=[], total=total)
+        start = message_range[0]
+        newest = total - 1 if start >= 0 else min(-start - 1, total - 1)
+        oldest = newest - len(messages) + 1
+        return ChatMessagePage(
+            messages=messages,
+            total=total,
+            before=oldest if oldest > 0 else None,
+            after=newest if newest < total - 1 else None)
+
+    def _fetch_message_page_mongo(self, session_id: str, user_id: str,
+                                  message_range: Optional[Tuple[int, int]]) -> Optional[Tuple[int, List[ChatMessage]]]:
+        """
+        Message count and one page of an archived session's history, cut
+        out by a `$slice` projection.
+        """
+        projection = {"_id": 0, "total": {"$size": {"$ifNull": ["$chat_history", []]}}}
+        if message_range is not None:
+            start, stop = message_range
+            projection["chat_history"] = {"$slice": [start, stop - start + 1] if start < 0 else stop + 1}
+        session = self.mongo_collection.find_one({"user_id": user_id, "session_id": session_id}, projection)
+        if session is None:
+            return None
+        total = session["total"]
+        chat_history = session.get("chat_history") or []
+        if message_range is not None and message_range[0] < 0:
+            # A slice reaching past the oldest message starts at the newest
+            # one instead of being cut short, drop what is not in the page
+            chat_history = chat_history[:max(total + message_range[1] + 1, 0)]
+        return total, [ChatMessage(**message) for message in chat_history]
+
     def store_chat_redis(self, session) -> str:
         """
         Store chat data in Redis.
         """
         # Convert chat history to a list of dictionaries
-        chat_history_json = [message.to_refined_json()
+        chat_history_json = [encode_message(message.to_refined_dict(), self.codec)
                              for message in session.chat_history]
 
         message_store_key = f"message_store:{session.user_id}:{session.session_id}"
@@ -107,16 +228,27 @@ class ChatService:
             "created_at": session.created_at.isoformat(),
             "updated_at": session.updated_at.isoformat(),
             "status": session.status,
-            "initial_message": session.initial_message}
+            "initial_message": session.initial_message,
+            "message_count": len(chat_history_json)}
+        # History is stored newest first, the preview is the first question
+        first_question = next((message.content for message in reversed(session.chat_history)
+                               if message.type == "human" and message.content), None)
+        if first_question:
+            metadata["preview"] = first_question[:PREVIEW_LENGTH]
+        if session.chat_history:
+            metadata["last_message_at"] = session.updated_at.isoformat()
         try:
-            # Store chat history as a list
-            # Ensure it's empty before pushing
-            self.redis_client.delete(message_store_key)
-            for message_json in chat_history_json:
-                self.redis_client.rpush(message_store_key, message_json)
-
-            # Store metadata as a hash
-            self.redis_client.hset(session_key, mapping=metadata)
+            # Replace the history and metadata in one MULTI/EXEC, so readers
+            # never see a half-written list
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.delete(message_store_key)
+            if chat_history_json:
+                pipe.rpush(message_store_key, *chat_history_json)
+            pipe.hset(session_key, mapping=metadata)
+            touch_session(pipe, session.user_id, session.session_id, session.updated_at)
+            # A restored session counts as active from now on
+            mark_active(pipe, session.user_id, session.session_id, datetime.utcnow())
+            pipe.execute()
 
             return f"Session data for session_id {session.session_id} stored successfully."
         except redis.RedisError as e:
@@ -129,8 +261,11 @@ class ChatService:
         session_key = f"{user_id}:{session_id}"
         message_store_key = f"message_store:{session_key}"
         try:
-            session_deleted = self.redis_client.delete(session_key)
-            message_store_deleted = self.redis_client.delete(message_store_key)
+            pipe = self.redis_client.pipeline(transaction=True)
+            pipe.delete(session_key)
+            pipe.delete(message_store_key, f"message_summary:{session_key}")
+            remove_session(pipe, user_id, session_id)
+            session_deleted, message_store_deleted = pipe.execute()[:2]
             if session_deleted == 0 and message_store_deleted == 0:
                 return f"No session metadata or messages found for session_id: {session_id}"
 
@@ -139,6 +274,117 @@ class ChatService:
         except redis.RedisError as e:
             return f"An error occurred while deleting session {session_id}: {str(e)}"
 
+    def expire_session(self, session_id: str, user_id: str) -> str:
+        """
+        Archive a session: write it to MongoDB, then remove it from Redis.
+        Redis is left untouched if the write is not confirmed.
+        """
+        result = self.archive_sessions([(user_id, session_id)])
+        if result["archived"]:
+            return f"Session {session_id} moved to MongoDB."
+        if result["missing"]:
+            return f"No chat data found in Redis for session_id: {session_id}"
+        if result["changed"]:
+            return f"Session {session_id} received new messages while archiving, kept in Redis."
+        return f"Error archiving session {session_id}, kept in Redis."
+
+    def archive_sessions(self, sessions: Iterable[Tuple[str, str]]) -> dict:
+        """
+        Move many (user_id, session_id) sessions from Redis to MongoDB: one
+        pipelined Redis read, one unordered bulk upsert, and one atomic Redis
+        delete limited to the sessions MongoDB confirmed. Returns how many
+        sessions were archived, missing from Redis, failed to write, or
+        changed while being archived (those stay in Redis), and how many
+        could not be read: those are moved from the activity set to the
+        quarantine set, so they do not come back in every sweep.
+        """
+        sessions = list(dict.fromkeys((user_id, session_id) for user_id, session_id in sessions))
+        result = {"archived": 0, "missing": 0, "failed": 0, "changed": 0, "quarantined": 0}
+        if not sessions:
+            return result
+
+        pipe = self.redis_client.pipeline(transaction=False)
+        for user_id, session_id in sessions:
+            pipe.hgetall(f"{user_id}:{session_id}")
+            pipe.lrange(f"message_store:{user_id}:{session_id}", 0, -1)
+        rows = pipe.execute()
+
+        found, operations, missing, unreadable = [], [], [], []
+        for (user_id, session_id), session_data, messages in zip(sessions, rows[::2], rows[1::2]):
+            if not session_data:
+                missing.append((user_id, session_id))
+                continue
+            try:
+                session_dict = {k.decode("utf-8"): v.decode("utf-8") for k, v in session_data.items()}
+                chat_history = self._decode_history(messages)
+                session = ChatSession(**{**session_dict, "chat_history": chat_history})
+            except Exception as e:
+                print(f"Error reading session {session_id} of user {user_id} for archival, quarantined: {e}")
+                unreadable.append((user_id, session_id))
+                continue
+            found.append((user_id, session_id, len(messages)))
+            operations.append(UpdateOne(
+                {"user_id": user_id, "session_id": session_id},
+                {"$set": session.dict()},
+                upsert=True))
+
+        if missing:
+            # Nothing left in Redis, drop any stale index entries
+            pipe = self.redis_client.pipeline(transaction=True)
+            for user_id, session_id in missing:
+                remove_session(pipe, user_id, session_id)
+            pipe.execute()
+            result["missing"] = len(missing)
+        if unreadable:
+            pipe = self.redis_client.pipeline(transaction=True)
+            for user_id, session_id in unreadable:
+                quarantine_session(pipe, user_id, session_id, time.time())
+            pipe.execute()
+            result["quarantined"] = len(unreadable)
+        if not operations:
+            return result
+
+        failed = set()
+        try:
+            self.mongo_collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                # None of the writes is known to be durable, keep them all
+                failed = set(range(len(found)))
+            else:
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+        result["failed"] += len(failed)
+        confirmed = [session for index, session in enumerate(found) if index not in failed]
+        if not confirmed:
+            return result
+
+        keys, args = [SESSION_ACTIVITY_KEY], []
+        for user_id, session_id, count in confirmed:
+            session_key = f"{user_id}:{session_id}"
+            keys += [session_key, f"message_store:{session_key}",
+                     f"message_summary:{session_key}", user_sessions_key(user_id)]
+            args += [count, session_id]
+        deleted = self._archive_delete_script(keys=keys, args=args)
+        result["archived"] = sum(deleted)
+        result["changed"] = len(deleted) - result["archived"]
+        return result
+
+    def idle_sessions(self, idle_ttl: int, max_active: int, limit: int) -> List[Tuple[str, str]]:
+        """
+        Up to `limit` (user_id, session_id) pairs to archive, least recently
+        active first: every session idle for `idle_ttl` seconds or more, and
+        as many more as needed to bring Redis down to `max_active` sessions.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.zcount(SESSION_ACTIVITY_KEY, "-inf", time.time() - idle_ttl)
+        pipe.zcard(SESSION_ACTIVITY_KEY)
+        expired, active = pipe.execute()
+        due = min(max(expired, active - max_active), limit)
+        if due <= 0:
+            return []
+        members = self.redis_client.zrange(SESSION_ACTIVITY_KEY, 0, due - 1)
+        return [tuple(member.decode("utf-8").rsplit(":", 1)) for member in members]
+
     def fetch_chat_mongo(self, session_id: str, user_id: str):
         """
         Fetch chat session from MongoDB.
@@ -188,7 +434,37 @@ class ChatService:
         except Exception as e:
             return (f"Error storing chat session in MongoDB: {e}")
 
-    def update_chat_mongo(self, session):
+    def update_chat_mongo(self, session, append: bool = False):
+        """
+        Update the chat history of a session in MongoDB.
+
+        By default the whole history is replaced. With `append`, only the
+        messages newer than the stored ones are pushed, so the update costs as
+        much as the new messages; it falls back to replacing the history when
+        the stored one is not a prefix of it (shorter session, concurrent
+        update).
+        """
+        if append:
+            stored = self.mongo_collection.find_one(
+                {"session_id": session.session_id},
+                {"_id": 0, "count": {"$size": {"$ifNull": ["$chat_history", []]}},
+                 "newest": {"$arrayElemAt": ["$chat_history", 0]}})
+            if stored is None:
+                return (f"Session {session.session_id} not found. No update performed.")
+            new_messages = len(session.chat_history) - stored["count"]
+            # The newest stored message must be the one right before the new ones
+            if new_messages >= 0 and (not stored["count"] or
+                                      stored.get("newest") == session.chat_history[new_messages].to_dict()):
+                # History is stored newest first: the new messages go in front
+                result = self.mongo_collection.update_one(
+                    {"session_id": session.session_id, "chat_history": {"$size": stored["count"]}},
+                    {"$push": {"chat_history": {
+                        "$each": [message.to_dict() for message in session.chat_history[:new_messages]],
+                        "$position": 0}},
+                     "$set": {"metadata.updated_at": datetime.utcnow().isoformat()}})
+                if result.matched_count > 0:
+                    return session
+
         chat_history = [message.to_dict() for message in session.chat_history]
         update_fields = {
             "chat_history": chat_history,
@@ -198,9 +474,7 @@ class ChatService:
             {"session_id": session.session_id},
             {"$set": update_fields})
         if result.matched_count > 0:
-            updated_session = self.mongo_collection.find_one(
-                {"session_id": session.session_id})
-            return updated_session
+            return session
         else:
             return (f"Session {session.session_id} not found. No update performed.")
 
@@ -213,52 +487,82 @@ class ChatService:
         """
         messages = self.redis_client.lrange(
             f"message_store:{user_id}:{session_id}", 0, -1)
+        try:
+            return self._decode_history(messages)
+        except Exception as e:
+            print(f"Error decoding chat history, skipping unreadable messages: {e}")
         chat_history = []
         for msg in messages:
             try:
-                decoded_msg = json.loads(msg.decode('utf-8'))
-                chat_message = ChatMessage(
-                    content=decoded_msg.get('data', {}).get('content'),
-                    type=decoded_msg.get('data', {}).get("type"),
-                    additional_kwargs=decoded_msg.get(
-                        'data', {}).get('additional_kwargs'),
-                    response_metadata=decoded_msg.get(
-                        'data', {}).get('response_metadata'),
-                    name=decoded_msg.get('data', {}).get('name'),
-                    id=decoded_msg.get('data', {}).get('id'),
-                    example=decoded_msg.get('data', {}).get('example'),
-                    tool_calls=decoded_msg.get('data', {}).get('tool_calls'),
-                    invalid_tool_calls=decoded_msg.get(
-                        'data', {}).get('invalid_tool_calls'),
-                    usage_metadata=decoded_msg.get(
-                        'data', {}).get('usage_metadata'),
-                )
-
-                # Add the parsed ChatMessage to the chat history list
-                chat_history.append(chat_message)
-            except json.JSONDecodeError as e:
-                print(f"Error decoding JSON: {e}")
+                chat_history.extend(self._decode_history([msg]))
             except Exception as e:
                 print(f"Unexpected error: {e}")
         return chat_history
 
-    def get_user_chat_sessions(self, user_id: str) -> List[ChatSession]:
+    def _indexed_session_ids(self, user_id: str, limit: Optional[int], before: Optional[datetime],
+                             before_id: Optional[str] = None) -> List[str]:
+        """
+        Ids of the user's Redis sessions from the session index, newest first
+        and, at equal times, by descending id. The page starts after session
+        `before_id` updated at `before`, or after every session updated at
+        `before` when no id is given.
+        """
+        key = user_sessions_key(user_id)
+        session_ids = []
+        max_score = "+inf"
+        if before is not None:
+            score = to_timestamp(before)
+            max_score = f"({score}"
+            if before_id is not None:
+                # ZREVRANGEBYSCORE orders equal scores by member, descending
+                cursor = before_id.encode("utf-8")
+                ties = self.redis_client.zrevrangebyscore(key, score, score)
+                session_ids = [session_id for session_id in ties if session_id < cursor][:limit]
+        if limit is None:
+            session_ids += self.redis_client.zrevrangebyscore(key, max_score, "-inf")
+        elif len(session_ids) < limit:
+            session_ids += self.redis_client.zrevrangebyscore(
+                key, max_score, "-inf", start=0, num=limit - len(session_ids))
+        return [session_id.decode("utf-8") for session_id in session_ids]
+
+    @staticmethod
+    def _archived_before(user_id: str, before: Optional[datetime], before_id: Optional[str]) -> dict:
         """
-        Retrieve all chat sessions for a specific user from Redis and MongoDB.
+        MongoDB filter for the user's archived sessions after the page cursor.
+        """
+        query = {"user_id": user_id}
+        if before is not None and before_id is not None:
+            query["$or"] = [{"updated_at": {"$lt": before}},
+                            {"updated_at": before, "session_id": {"$lt": before_id}}]
+        elif before is not None:
+            query["updated_at"] = {"$lt": before}
+        return query
+
+    def get_user_chat_sessions(self, user_id: str, limit: Optional[int] = None, before: Optional[datetime] = None,
+                               before_id: Optional[str] = None) -> List[ChatSession]:
+        """
+        Retrieve chat sessions for a specific user from Redis and MongoDB,
+        most recently updated first.
+
+        Redis sessions come from the per-user session index instead of a
+        keyspace scan. With `limit`, at most that many sessions are returned;
+        pass the `updated_at` and `session_id` of the last one as `before` and
+        `before_id` to get the next page.
         """
         sessions = []
+        redis_session_ids = set()
         try:
-            keys = self.redis_client.keys(f"{user_id}:*")
-            for key in keys:
-                key = key.decode("utf-8")
-                if key.endswith(":messages"):
-                    continue  # Skip message lists
-                session_data = self.redis_client.hgetall(key)
+            session_ids = self._indexed_session_ids(user_id, limit, before, before_id)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for session_id in session_ids:
+                pipe.hgetall(f"{user_id}:{session_id}")
+            for session_id, session_data in zip(session_ids, pipe.execute()):
                 if not session_data:
-                    continue  # Skip if session data is empty
+                    # Session removed without going through the service
+                    remove_session(self.redis_client, user_id, session_id)
+                    continue
+                redis_session_ids.add(session_id)
 
-                session_id = session_data.get(
-                    b"session_id", b"").decode("utf-8")
                 created_at = session_data.get(
                     b"created_at", b"").decode("utf-8")
                 updated_at = session_data.get(b"updated_at", b"").decode(
@@ -286,8 +590,13 @@ class ChatService:
 
         # # Retrieve expired sessions from MongoDB
         try:
-            expired_sessions = self.mongo_collection.find({"user_id": user_id})
+            query = self._archived_before(user_id, before, before_id)
+            expired_sessions = self.mongo_collection.find(query).sort([("updated_at", -1), ("session_id", -1)])
+            if limit is not None:
+                expired_sessions = expired_sessions.limit(limit + len(redis_session_ids))
             for session in expired_sessions:
+                if session.get("session_id") in redis_session_ids:
+                    continue  # Restored to Redis, already listed
                 # Retrieve and process created_at and updated_at
                 created_at = session.get("created_at")
                 updated_at = session.get(
@@ -327,7 +636,108 @@ class ChatService:
         except Exception as e:
             return(f"Error retrieving sessions from MongoDB: {e}")
 
-        return sessions
+        sessions.sort(key=lambda session: (session.updated_at or datetime.min, session.session_id), reverse=True)
+        return sessions[:limit] if limit is not None else sessions
+
+    def get_user_session_summaries(self, user_id: str, limit: Optional[int] = None, before: Optional[datetime] = None,
+                                   before_id: Optional[str] = None) -> List[ChatSessionSummary]:
+        """
+        List a user's chat sessions without their messages: message count,
+        last activity and a preview of the first question, newest first.
+        Paginates like `get_user_chat_sessions`.
+        """
+        fields = ("created_at", "updated_at", "status", "message_count", "last_message_at", "preview")
+        summaries = []
+        redis_session_ids = set()
+        session_ids = self._indexed_session_ids(user_id, limit, before, before_id)
+        pipe = self.redis_client.pipeline(transaction=False)
+        for session_id in session_ids:
+            pipe.hmget(f"{user_id}:{session_id}", *fields)
+        rows = {}
+        for session_id, values in zip(session_ids, pipe.execute()):
+            if values[0] is None:
+                remove_session(self.redis_client, user_id, session_id)
+                continue
+            rows[session_id] = {field: value.decode("utf-8")
+                                for field, value in zip(fields, values) if value is not None}
+
+        # Sessions stored before the counters existed: count the list and
+        # take the oldest message once
+        legacy = [session_id for session_id, row in rows.items() if "message_count" not in row]
+        if legacy:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for session_id in legacy:
+                pipe.llen(f"message_store:{user_id}:{session_id}")
+                pipe.lindex(f"message_store:{user_id}:{session_id}", -1)
+            results = pipe.execute()
+            for session_id, count, oldest in zip(legacy, results[::2], results[1::2]):
+                rows[session_id]["message_count"] = count
+                if oldest:
+                    message = decode_message(oldest)
+                    content = message.get("data", {}).get("content")
+                    if message.get("type") == "human" and content:
+                        rows[session_id]["preview"] = content[:PREVIEW_LENGTH]
+
+        for session_id, row in rows.items():
+            redis_session_ids.add(session_id)
+            summaries.append(ChatSessionSummary(session_id=session_id, user_id=user_id, **row))
+
+        # Archived sessions: count and preview are computed by MongoDB, the
+        # messages themselves are never sent
+        match = self._archived_before(user_id, before, before_id)
+        pipeline = [{"$match": match}, {"$sort": {"updated_at": -1, "session_id": -1}}]
+        if limit is not None:
+            pipeline.append({"$limit": limit + len(redis_session_ids)})
+        history = {"$ifNull": ["$chat_history", []]}
+        pipeline.append({"$project": {
+            "_id": 0, "session_id": 1, "created_at": 1, "updated_at": 1, "status": 1,
+            "message_count": {"$size": history},
+            # Stored newest first, so the first question is the last human message
+            "first_question": {"$arrayElemAt": [
+                {"$filter": {"input": history, "as": "message", "cond": {"$eq": ["$$message.type", "human"]}}}, -1]},
+        }})
+        try:
+            for session in self.mongo_collection.aggregate(pipeline):
+                if session.get("session_id") in redis_session_ids:
+                    continue
+                first_question = (session.get("first_question") or {}).get("content")
+                updated_at = session.get("updated_at")
+                summaries.append(ChatSessionSummary(
+                    session_id=session.get("session_id", ""),
+                    user_id=user_id,
+                    created_at=session.get("created_at"),
+                    updated_at=updated_at,
+                    status=session.get("status", "expired"),
+                    message_count=session.get("message_count", 0),
+                    last_message_at=updated_at if session.get("message_count") else None,
+                    preview=first_question[:PREVIEW_LENGTH] if first_question else None,
+                ))
+        except Exception as e:
+            print(f"Error retrieving session summaries from MongoDB: {e}")
+
+        summaries.sort(key=lambda summary: (summary.updated_at or datetime.min, summary.session_id), reverse=True)
+        return summaries[:limit] if limit is not None else summaries
+
+    def rebuild_session_index(self) -> int:
+        """
+        Index every session hash in Redis; for sessions created before the
+        index existed. Walks the keyspace with SCAN, never KEYS.
+        """
+        indexed = 0
+        for key in self.redis_client.scan_iter(match="*:*", count=1000, _type="hash"):
+            session_id, user_id, updated_at = self.redis_client.hmget(
+                key, "session_id", "user_id", "updated_at")
+            if not (session_id and user_id and updated_at):
+                continue
+            user_id, session_id = user_id.decode("utf-8"), session_id.decode("utf-8")
+            updated_at = datetime.fromisoformat(updated_at.decode("utf-8"))
+            pipe = self.redis_client.pipeline(transaction=False)
+            touch_session(pipe, user_id, session_id, updated_at)
+            mark_active(pipe, user_id, session_id, updated_at, only_new=True)
+            pipe.execute()
+            indexed += 1
+        return indexed
+
 
     def clear_redis_db(self):
         """
@@ -60,3 +60,23 @@ class ChatSession(BaseModel):
     updated_at: datetime
     status: str
     initial_message: Optional[str] = None
+
+
+class ChatSessionSummary(BaseModel):
+    session_id: str
+    user_id: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    status: Optional[str] = None
+    message_count: int = 0
+    last_message_at: Optional[datetime] = None
+    preview: Optional[str] = None
+
+
+class ChatMessagePage(BaseModel):
+    # Newest first, like chat_history; positions count from the oldest
+    # message (0) and are the cursors of the neighbouring pages
+    messages: List[ChatMessage]
+    total: int
+    before: Optional[int] = None
+    after: Optional[int] = None
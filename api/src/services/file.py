@@ -1,9 +1,10 @@
 from fastapi import APIRouter, File, UploadFile, Form, HTTPException, Depends, Query
+from celery.result import AsyncResult
 
-from langchain_core.documents import Document
-from langchain_community.document_loaders import PyPDFLoader
-from src.utils.weavite import weaviate_client , db
+from src.utils.weavite import get_embeddings, get_bm25_index, bump_index_version, log_index_change
 from src.utils.helper import save_file
+from src.core.celery_config import celery_app
+from src.core.db import get_collection, get_weaviate
 
 router = APIRouter()
 
@@ -15,19 +16,66 @@ def clean_db():
     """
     clean weavite db 
     """
-    try:
-        weaviate_client.collections.delete_all()
-        return "weavite db is cleaned"
-    finally : 
-        weaviate_client.close()
+    # The client is shared by the whole process and closed at shutdown
+    get_weaviate().collections.delete_all()
+    # Nothing is indexed anymore, so every file must be ingested in full again
+    get_collection("ingest_manifest").delete_many({})
+    get_bm25_index().clear()
+    log_index_change("clear")
+    bump_index_version()
+    return "weavite db is cleaned"
 
 @router.post("/upload-file/")
 def upload_file(
     file: UploadFile = File(..., description="Upload your document here"),
 ): 
+    """
+    Save the document and queue its ingestion, returning the job id to poll.
+    """
     file_path = save_file(dir=UPLOAD_DIR,file=file)
-    print(file_path)
-    loader = PyPDFLoader(file_path)
-    docs = loader.load_and_split()
-    db.add_documents(documents=docs)
-    return file_path
\ No newline at end of file
+    result = celery_app.send_task(
+        'src.services.file_tasks.ingest_file', args=[file_path])
+    return {"job_id": result.id, "file_path": file_path}
+
+
+@router.get("/upload-file/{job_id}")
+def upload_file_status(job_id: str):
+    """
+    Report the state and progress counters of an ingestion job.
+    """
+    result = AsyncResult(job_id, app=celery_app)
+    status = {
+        "job_id": job_id,
+        "state": result.state,
+        "pages_parsed": 0,
+        "chunks_embedded": 0,
+        "chunks_written": 0,
+        "chunks_failed": 0,
+        "chunks_skipped": 0,
+        "chunks_deleted": 0,
+    }
+    if result.failed():
+        status["error"] = str(result.result)
+    elif isinstance(result.info, dict):
+        status.update(result.info)
+    return status
+
+
+@router.post("/lexical-index/rebuild")
+def rebuild_lexical_index():
+    """
+    Queue a rebuild of the BM25 index from the chunks already in Weaviate.
+    """
+    result = celery_app.send_task('src.services.file_tasks.rebuild_lexical_index')
+    return {"task_id": result.id}
+
+
+@router.get("/embedding-cache/stats")
+def embedding_cache_stats():
+    """
+    Hit/miss counters of the embedding cache.
+    """
+    embeddings = get_embeddings()
+    if not hasattr(embeddings, "stats"):
+        raise HTTPException(status_code=404, detail="Embedding cache is disabled")
+    return embeddings.stats()
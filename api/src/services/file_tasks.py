@@ -0,0 +1,45 @@
+from src.core.celery_config import celery_app
+from src.utils.ingest import ingest_pdf, iter_batches
+from src.core.db import get_weaviate
+from src.utils.weavite import get_bm25_index, INDEX_NAME, TEXT_KEY
+from langchain_core.documents import Document
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+@celery_app.task(bind=True)
+def ingest_file(self, file_path: str):
+    """Parse, embed and index an uploaded PDF, reporting progress on the task state."""
+    logger.info(f"Starting ingestion of {file_path}")
+
+    def report_progress(progress):
+        self.update_state(state="PROGRESS", meta=progress)
+
+    progress = ingest_pdf(file_path, on_progress=report_progress)
+    if progress["chunks_failed"]:
+        # Reported as a failed job; the chunks are retried on the next upload
+        raise RuntimeError(f"{progress['chunks_failed']} chunks of {file_path} could not be written: {progress}")
+    logger.info(f"Finished ingestion of {file_path}")
+    return {"file_path": file_path, **progress}
+
+
+@celery_app.task
+def rebuild_lexical_index(batch_size: int = 500):
+    """Rebuild the BM25 index from every chunk stored in Weaviate."""
+    logger.info("Rebuilding lexical index")
+    bm25_index = get_bm25_index()
+    bm25_index.clear()
+    collection = get_weaviate().collections.get(INDEX_NAME)
+    indexed = 0
+    for batch in iter_batches(collection.iterator(), batch_size):
+        ids = [str(obj.uuid) for obj in batch]
+        documents = []
+        for obj in batch:
+            properties = dict(obj.properties)
+            content = properties.pop(TEXT_KEY, "") or ""
+            documents.append(Document(page_content=content, metadata=properties))
+        bm25_index.add(ids, documents)
+        indexed += len(ids)
+    logger.info(f"Lexical index rebuilt with {indexed} chunks")
+    return {"indexed": indexed}
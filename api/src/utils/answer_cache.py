@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import re
+import time
+from typing import Dict, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from redis import Redis
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercase, collapse whitespace and drop trailing punctuation, so trivial
+    variations of a question share one cache entry.
+    """
+    return re.sub(r"\s+", " ", question).strip().lower().rstrip("?!. ")
+
+
+class AnswerCache:
+    """
+    RAG answers cached in Redis and shared by every worker.
+
+    A lookup first tries the normalized question exactly, then falls back to
+    the most similar cached question by embedding cosine similarity. Entries
+    live in a namespace tied to the document-index version, so adding or
+    removing documents invalidates them all at once; old namespaces simply
+    expire. Each namespace keeps at most `max_entries` answers, evicting the
+    least recently used, and every entry expires after `ttl` seconds.
+
+    Layout under `{namespace}:v{version}`:
+        entry:{hash}  hash  question, answer, vector (float32 bytes)
+        lru           zset  hash -> last access time
+    """
+
+    def __init__(
+        self,
+        redis_client: Redis,
+        embeddings: Optional[Embeddings] = None,
+        ttl: int = 86400,
+        max_entries: int = 1000,
+        similarity_threshold: float = 0.95,
+        namespace: str = "answer_cache",
+    ):
+        self.redis_client = redis_client
+        self.embeddings = embeddings
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.namespace = namespace
+        # Cached question vectors never change, so each process keeps the
+        # ones it has already read
+        self._vectors: Dict[str, Dict[bytes, np.ndarray]] = {}
+
+    def _prefix(self, version) -> str:
+        return f"{self.namespace}:v{version}"
+
+    def _entry_key(self, version, digest) -> str:
+        digest = digest.decode("utf-8") if isinstance(digest, bytes) else digest
+        return f"{self._prefix(version)}:entry:{digest}"
+
+    def _lru_key(self, version) -> str:
+        return f"{self._prefix(version)}:lru"
+
+    @staticmethod
+    def _digest(question: str) -> str:
+        return hashlib.sha256(normalize_question(question).encode("utf-8")).hexdigest()
+
+    @property
+    def semantic(self) -> bool:
+        return self.embeddings is not None and 0 < self.similarity_threshold <= 1
+
+    def _embed(self, question: str) -> np.ndarray:
+        # The question as the retriever embeds it, so with the embedding cache
+        # the lookup, the retrieval and `set` share one model call
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(self, question: str, version) -> Optional[dict]:
+        """
+        Cached answer for `question` under the given index version, or None.
+        """
+        digest = self._digest(question)
+        answer = self.redis_client.hget(self._entry_key(version, digest), "answer")
+        if answer is not None:
+            self.redis_client.zadd(self._lru_key(version), {digest: time.time()})
+            return {"answer": answer.decode("utf-8"), "match": "exact", "similarity": 1.0}
+        if not self.semantic:
+            return None
+
+        cached_ids = self.redis_client.zrange(self._lru_key(version), 0, -1)
+        if not cached_ids:
+            return None
+        known = self._vectors.setdefault(str(version), {})
+        for stale in [k for k in self._vectors if k != str(version)]:
+            del self._vectors[stale]
+        unknown = [cached_id for cached_id in cached_ids if cached_id not in known]
+        if unknown:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for cached_id in unknown:
+                pipe.hget(self._entry_key(version, cached_id), "vector")
+            for cached_id, raw in zip(unknown, pipe.execute()):
+                if raw is not None:
+                    known[cached_id] = np.frombuffer(raw, dtype=np.float32)
+        candidates = [cached_id for cached_id in cached_ids if cached_id in known]
+        if not candidates:
+            return None
+
+        query = self._embed(question)
+        similarities = np.stack([known[cached_id] for cached_id in candidates]) @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            return None
+        best_id = candidates[best]
+        answer = self.redis_client.hget(self._entry_key(version, best_id), "answer")
+        if answer is None:
+            return None
+        self.redis_client.zadd(self._lru_key(version), {best_id: time.time()})
+        return {"answer": answer.decode("utf-8"), "match": "semantic", "similarity": float(similarities[best])}
+
+    def set(self, question: str, answer: str, version):
+        """
+        Cache an answer computed against the given index version.
+        """
+        digest = self._digest(question)
+        entry = {"question": question, "answer": answer}
+        if self.semantic:
+            entry["vector"] = self._embed(question).tobytes()
+        lru_key = self._lru_key(version)
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.hset(self._entry_key(version, digest), mapping=entry)
+        pipe.expire(self._entry_key(version, digest), self.ttl)
+        pipe.zadd(lru_key, {digest: time.time()})
+        pipe.expire(lru_key, self.ttl)
+        pipe.zcard(lru_key)
+        size = pipe.execute()[-1]
+
+        if size > self.max_entries:
+            evicted = self.redis_client.zpopmin(lru_key, size - self.max_entries)
+            if evicted:
+                self.redis_client.delete(*[self._entry_key(version, evicted_id) for evicted_id, _ in evicted])
@@ -0,0 +1,203 @@
+import json
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from redis import Redis
+
+# Keeps identifiers such as part numbers ("AB-1234.5") together as one token
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    "a an and are as at be by for from has have how i in is it its of on or "
+    "that the this to was what when where which who why will with you your".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens without stopwords. Compound identifiers are kept
+    whole and also emitted as their parts, so both "ab-1234" and "1234" match.
+    """
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOPWORDS:
+            continue
+        tokens.append(token)
+        parts = re.split(r"[-_./]", token)
+        if len(parts) > 1:
+            tokens.extend(part for part in parts if part and part not in STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """
+    Okapi BM25 inverted index kept in Redis, so every API worker and the
+    ingestion workers share it and it can be updated chunk by chunk.
+
+    Layout under `namespace`:
+        postings:{term}  sorted set  "{doc id}:{term frequency}:{doc length}"
+                                     scored by the document's BM25 term
+                                     weight (at the average length of the
+                                     time it was indexed)
+        doc:{id}         hash        content, metadata (JSON), length,
+                                     terms (JSON term -> frequency)
+        stats            hash        doc_count, total_length
+
+    A query reads only the `postings_limit` best postings of each term, so
+    a term found in most of the corpus costs as much as a rare one; the
+    documents read are scored exactly.
+    """
+
+    def __init__(self, redis_client: Redis, namespace: str = "bm25", k1: float = 1.5, b: float = 0.75,
+                 postings_limit: int = 1000):
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.k1 = k1
+        self.b = b
+        self.postings_limit = postings_limit
+        self.stats_key = f"{namespace}:stats"
+
+    def _postings_key(self, term: str) -> str:
+        return f"{self.namespace}:postings:{term}"
+
+    def _legacy_term_key(self, term: str) -> str:
+        # Hash postings of indexes built before the sorted sets
+        return f"{self.namespace}:term:{term}"
+
+    def _doc_key(self, doc_id: str) -> str:
+        return f"{self.namespace}:doc:{doc_id}"
+
+    def _weight(self, tf: int, length: int, avg_length: float) -> float:
+        norm = self.k1 * (1 - self.b + self.b * length / avg_length)
+        return tf * (self.k1 + 1) / (tf + norm)
+
+    def add(self, ids: List[str], documents: List[Document]):
+        """
+        Index documents under the given ids, replacing any already indexed.
+        """
+        if not ids:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for doc_id in ids:
+            pipe.exists(self._doc_key(doc_id))
+        pipe.hmget(self.stats_key, "doc_count", "total_length")
+        *found, (doc_count, total_length) = pipe.execute()
+        existing = [doc_id for doc_id, exists in zip(ids, found) if exists]
+        if existing:
+            self.remove(existing)
+
+        tokenized = [tokenize(document.page_content) for document in documents]
+        batch_length = sum(len(tokens) for tokens in tokenized)
+        avg_length = max((int(total_length or 0) + batch_length) / (int(doc_count or 0) + len(ids)), 1.0)
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        for doc_id, document, tokens in zip(ids, documents, tokenized):
+            counts = Counter(tokens)
+            length = len(tokens)
+            for term, tf in counts.items():
+                pipe.zadd(self._postings_key(term),
+                          {f"{doc_id}:{tf}:{length}": self._weight(tf, length, avg_length)})
+            pipe.hset(self._doc_key(doc_id), mapping={
+                "content": document.page_content,
+                "metadata": json.dumps(document.metadata, default=str),
+                "length": length,
+                "terms": json.dumps(counts),
+            })
+        pipe.hincrby(self.stats_key, "doc_count", len(ids))
+        pipe.hincrby(self.stats_key, "total_length", batch_length)
+        pipe.execute()
+
+    def remove(self, ids: Iterable[str]):
+        """
+        Drop documents from the index.
+        """
+        ids = list(ids)
+        if not ids:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for doc_id in ids:
+            pipe.hmget(self._doc_key(doc_id), "length", "terms")
+        rows = pipe.execute()
+
+        pipe = self.redis_client.pipeline(transaction=True)
+        removed = 0
+        removed_length = 0
+        for doc_id, (length, terms) in zip(ids, rows):
+            if terms is None:
+                continue
+            terms = json.loads(terms)
+            if isinstance(terms, dict):
+                for term, tf in terms.items():
+                    pipe.zrem(self._postings_key(term), f"{doc_id}:{tf}:{int(length or 0)}")
+            else:
+                for term in terms:
+                    pipe.hdel(self._legacy_term_key(term), doc_id)
+            pipe.delete(self._doc_key(doc_id))
+            removed += 1
+            removed_length += int(length or 0)
+        if removed:
+            pipe.hincrby(self.stats_key, "doc_count", -removed)
+            pipe.hincrby(self.stats_key, "total_length", -removed_length)
+            pipe.execute()
+
+    def clear(self):
+        """
+        Remove the whole index.
+        """
+        batch = []
+        for key in self.redis_client.scan_iter(match=f"{self.namespace}:*", count=1000):
+            batch.append(key)
+            if len(batch) >= 1000:
+                self.redis_client.unlink(*batch)
+                batch = []
+        if batch:
+            self.redis_client.unlink(*batch)
+
+    def search(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        """
+        Top `k` documents for `query` by BM25 score, best first.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hmget(self.stats_key, "doc_count", "total_length")
+        for term in terms:
+            pipe.zcard(self._postings_key(term))
+            pipe.zrevrange(self._postings_key(term), 0, self.postings_limit - 1)
+        (doc_count, total_length), *rows = pipe.execute()
+        doc_count = int(doc_count or 0)
+        if doc_count <= 0:
+            return []
+        avg_length = max(int(total_length or 0) / doc_count, 1.0)
+
+        scores: Dict[str, float] = {}
+        for df, postings in zip(rows[::2], rows[1::2]):
+            if not df:
+                continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for posting in postings:
+                doc_id, tf, length = posting.decode("utf-8").rsplit(":", 2)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * self._weight(int(tf), int(length), avg_length)
+        if not scores:
+            return []
+
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        documents = self.get_documents([doc_id for doc_id, _ in top])
+        return [(document, score) for document, (_, score) in zip(documents, top) if document is not None]
+
+    def get_documents(self, ids: List[str]) -> List[Optional[Document]]:
+        """
+        The indexed documents with the given ids, None for unknown ones.
+        """
+        pipe = self.redis_client.pipeline(transaction=False)
+        for doc_id in ids:
+            pipe.hmget(self._doc_key(doc_id), "content", "metadata")
+        documents = []
+        for content, metadata in pipe.execute() if ids else []:
+            documents.append(None if content is None else Document(
+                page_content=content.decode("utf-8"),
+                metadata=json.loads(metadata) if metadata else {},
+            ))
+        return documents
@@ -0,0 +1,145 @@
+import re
+from typing import List, Optional, Sequence, Set
+
+import numpy as np
+from langchain_community.vectorstores.utils import maximal_marginal_relevance
+from langchain_core.documents import Document
+
+from src.utils.history import count_tokens, truncate_tokens
+
+WORD_RE = re.compile(r"\w+")
+
+
+def shingles(text: str, size: int = 3) -> Set[tuple]:
+    """
+    The runs of `size` consecutive words of a text, lowercased.
+    """
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def containment(a: Set[tuple], b: Set[tuple]) -> float:
+    """
+    Share of the smaller shingle set found in the other one: 1.0 when one
+    text repeats the other, whatever their lengths.
+    """
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+def overlap(left: str, right: str) -> int:
+    """
+    Length of the longest end of `left` that `right` starts with, as two
+    neighbouring chunks of a splitter with an overlap share.
+    """
+    # Prefix function of right + separator + the end of left
+    text = right + "\0" + left[-len(right):]
+    prefix = [0] * len(text)
+    for i in range(1, len(text)):
+        k = prefix[i - 1]
+        while k and text[i] != text[k]:
+            k = prefix[k - 1]
+        if text[i] == text[k]:
+            k += 1
+        prefix[i] = k
+    return prefix[-1]
+
+
+def _same_page(a: Document, b: Document) -> bool:
+    return (a.metadata.get("source"), a.metadata.get("page")) == (b.metadata.get("source"), b.metadata.get("page"))
+
+
+def merge_overlapping(a: Document, b: Document, min_overlap: int) -> Optional[Document]:
+    """
+    One document for two neighbouring chunks of the same page, with their
+    shared text once; None when they are not neighbours.
+    """
+    if not _same_page(a, b):
+        return None
+    for first, second in ((a, b), (b, a)):
+        # Most pairs share no text at all; skip the full scan for those
+        tail = first.page_content[-len(second.page_content):]
+        if second.page_content[:min_overlap] not in tail:
+            continue
+        length = overlap(first.page_content, second.page_content)
+        if length >= min_overlap:
+            return Document(page_content=first.page_content + second.page_content[length:],
+                            metadata=dict(first.metadata))
+    return None
+
+
+def diversify(query_embedding: List[float], embeddings: List[List[float]], documents: List[Document],
+              lambda_mult: float = 0.5, k: Optional[int] = None) -> List[Document]:
+    """
+    `k` of the `documents` (all by default) picked by maximal marginal
+    relevance: each next one is the most relevant to the query among those
+    least similar to the ones before.
+    """
+    k = len(documents) if k is None else min(k, len(documents))
+    if len(documents) < 2:
+        return documents[:k]
+    order = maximal_marginal_relevance(np.array(query_embedding), embeddings, lambda_mult=lambda_mult, k=k)
+    return [documents[i] for i in order]
+
+
+def pack_documents(
+    documents: Sequence[Document],
+    token_budget: int = 0,
+    duplicate_threshold: float = 0.8,
+    min_overlap: int = 20,
+) -> List[Document]:
+    """
+    Compact the retrieved `documents` (best first) into the context given to
+    the model:
+
+    - chunks overlapping a kept chunk of the same page (its neighbours in
+      the split) are merged into it, so the shared text appears once;
+    - chunks whose words (`duplicate_threshold` of their 3-word shingles)
+      repeat a kept chunk are dropped;
+    - documents are kept in order until `token_budget` tokens (tiktoken),
+      the first one cut to fit if needed; 0 for no budget.
+    """
+    kept: List[Document] = []
+    kept_shingles: List[Set[tuple]] = []
+    for document in documents:
+        merged_into = None
+        for i, other in enumerate(kept):
+            merged = merge_overlapping(other, document, min_overlap)
+            if merged is not None:
+                kept[i], merged_into = merged, i
+                break
+        if merged_into is None:
+            document_shingles = shingles(document.page_content)
+            if any(containment(document_shingles, other) >= duplicate_threshold for other in kept_shingles):
+                continue
+            kept.append(document)
+            kept_shingles.append(document_shingles)
+            continue
+        # The chunk may bridge two kept ones (its neighbours on either side)
+        for j in range(len(kept) - 1, -1, -1):
+            if j == merged_into:
+                continue
+            merged = merge_overlapping(kept[merged_into], kept[j], min_overlap)
+            if merged is not None:
+                kept[merged_into] = merged
+                del kept[j], kept_shingles[j]
+                if j < merged_into:
+                    merged_into -= 1
+        kept_shingles[merged_into] = shingles(kept[merged_into].page_content)
+
+    if not token_budget:
+        return kept
+    packed, used = [], 0
+    for document in kept:
+        tokens = count_tokens(document.page_content)
+        if used + tokens > token_budget:
+            if not packed:
+                packed.append(Document(page_content=truncate_tokens(document.page_content, token_budget),
+                                       metadata=dict(document.metadata)))
+            break
+        packed.append(document)
+        used += tokens
+    return packed
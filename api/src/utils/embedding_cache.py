@@ -0,0 +1,305 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from array import array
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from redis import Redis
+
+from src.utils.metrics import EMBEDDING_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def _pack(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _unpack(raw: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(raw)
+    return vector.tolist()
+
+
+class ScheduledEmbeddings(Embeddings):
+    """
+    Embeddings wrapper whose calls to the model go through a `Scheduler`,
+    timed once they got their slot.
+    """
+
+    def __init__(self, underlying: Embeddings, scheduler):
+        self.underlying = underlying
+        self.scheduler = scheduler
+
+    def __getattr__(self, name):
+        # model, repo_id, ... of the wrapped model
+        if name == "underlying":
+            raise AttributeError(name)
+        return getattr(self.underlying, name)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with self.scheduler.slot(), EMBEDDING_SECONDS.labels("documents").time():
+            return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        with self.scheduler.slot(), EMBEDDING_SECONDS.labels("query").time():
+            return self.underlying.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        async with self.scheduler.aslot():
+            with EMBEDDING_SECONDS.labels("documents").time():
+                return await self.underlying.aembed_documents(texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        async with self.scheduler.aslot():
+            with EMBEDDING_SECONDS.labels("query").time():
+                return await self.underlying.aembed_query(text)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches vectors by a hash of the text and model id.
+
+    Lookups go to Redis first (shared by every worker), then to a local disk
+    directory; whatever is still missing is embedded with one bulk call to the
+    wrapped model and written back to both tiers. Redis entries expire after
+    `ttl` seconds and the disk tier is trimmed to `max_disk_entries` files,
+    least recently used first, on a background thread.
+    """
+
+    STATS_FIELDS = ("redis_hits", "disk_hits", "misses")
+
+    def __init__(
+        self,
+        underlying: Embeddings,
+        redis_client: Optional[Redis] = None,
+        cache_dir: Optional[str] = None,
+        model_id: Optional[str] = None,
+        ttl: Optional[int] = None,
+        max_disk_entries: Optional[int] = None,
+        namespace: str = "embedding_cache",
+    ):
+        self.underlying = underlying
+        self.redis_client = redis_client
+        self.cache_dir = cache_dir
+        self.model_id = model_id or getattr(underlying, "model", None) or getattr(
+            underlying, "repo_id", None) or type(underlying).__name__
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.namespace = namespace
+        self.stats_key = f"{namespace}:stats"
+        self._local_stats = dict.fromkeys(self.STATS_FIELDS, 0)
+        self._disk_writes = 0
+        self._evicting = False
+        self._lock = threading.Lock()
+
+    def _hash(self, text: str, kind: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{kind}\0{text}".encode("utf-8")).hexdigest()
+
+    def _redis_key(self, digest: str) -> str:
+        return f"{self.namespace}:{digest}"
+
+    def _disk_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _read_disk(self, digest: str) -> Optional[bytes]:
+        path = self._disk_path(digest)
+        try:
+            with open(path, "rb") as f:
+                raw = f.read()
+            os.utime(path)  # keep recently used entries away from eviction
+            return raw
+        except OSError:
+            return None
+
+    def _write_disk(self, digest: str, raw: bytes):
+        path = self._disk_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(raw)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write embedding cache entry {digest}: {e}")
+
+    def _lookup(self, texts: List[str], kind: str) -> dict:
+        """
+        Resolve what the cache tiers can; the returned state lists the
+        distinct texts still missing.
+        """
+        digests = [self._hash(text, kind) for text in texts]
+        found: Dict[str, bytes] = {}
+        counts = dict.fromkeys(self.STATS_FIELDS, 0)
+
+        if self.redis_client is not None:
+            unique = list(dict.fromkeys(digests))
+            try:
+                values = self.redis_client.mget([self._redis_key(d) for d in unique])
+                found.update({d: v for d, v in zip(unique, values) if v is not None})
+                counts["redis_hits"] = len(found)
+            except Exception as e:
+                logger.warning(f"Embedding cache Redis lookup failed: {e}")
+
+        promote: Dict[str, bytes] = {}
+        if self.cache_dir:
+            for digest in dict.fromkeys(digests):
+                if digest in found:
+                    continue
+                raw = self._read_disk(digest)
+                if raw is not None:
+                    found[digest] = raw
+                    promote[digest] = raw
+                    counts["disk_hits"] += 1
+
+        missing = {}
+        for text, digest in zip(texts, digests):
+            if digest not in found:
+                missing.setdefault(digest, text)
+        counts["misses"] = len(missing)
+        return {"digests": digests, "found": found, "promote": promote,
+                "counts": counts, "missing": missing}
+
+    def _finish(self, state: dict, vectors: List[List[float]]) -> List[List[float]]:
+        """
+        Write freshly embedded vectors back to both tiers and assemble the
+        result in input order.
+        """
+        found, promote = state["found"], state["promote"]
+        for digest, vector in zip(state["missing"], vectors):
+            raw = _pack(vector)
+            found[digest] = raw
+            promote[digest] = raw
+            if self.cache_dir:
+                self._write_disk(digest, raw)
+        self._store(promote, state["counts"])
+        if self.cache_dir and vectors:
+            self._count_disk_writes(len(vectors))
+
+        return [_unpack(found[digest]) for digest in state["digests"]]
+
+    def _count_disk_writes(self, count: int):
+        """
+        Start an eviction every `max_disk_entries // 10` disk writes, off the
+        embedding call: walking the directory takes as long as it is large.
+        """
+        if not self.max_disk_entries:
+            return
+        with self._lock:
+            self._disk_writes += count
+            if self._evicting or self._disk_writes < max(1, self.max_disk_entries // 10):
+                return
+            self._disk_writes = 0
+            self._evicting = True
+        threading.Thread(target=self._evict_in_background, daemon=True).start()
+
+    def _evict_in_background(self):
+        try:
+            self.evict()
+        except Exception as e:
+            logger.warning(f"Embedding cache eviction failed: {e}")
+        finally:
+            with self._lock:
+                self._evicting = False
+
+    def _embed(self, texts: List[str], kind: str) -> List[List[float]]:
+        state = self._lookup(texts, kind)
+        missing = list(state["missing"].values())
+        vectors = []
+        # Embed every distinct missing text in a single bulk call
+        if missing and kind == "query":
+            vectors = [self.underlying.embed_query(text) for text in missing]
+        elif missing:
+            vectors = self.underlying.embed_documents(missing)
+        return self._finish(state, vectors)
+
+    async def _aembed(self, texts: List[str], kind: str) -> List[List[float]]:
+        state = await asyncio.to_thread(self._lookup, texts, kind)
+        missing = list(state["missing"].values())
+        vectors = []
+        if missing and kind == "query":
+            vectors = [await self.underlying.aembed_query(text) for text in missing]
+        elif missing:
+            vectors = await self.underlying.aembed_documents(missing)
+        return await asyncio.to_thread(self._finish, state, vectors)
+
+    def _store(self, entries: Dict[str, bytes], counts: Dict[str, int]):
+        with self._lock:
+            for field, value in counts.items():
+                self._local_stats[field] += value
+        if self.redis_client is None:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for digest, raw in entries.items():
+                pipe.set(self._redis_key(digest), raw, ex=self.ttl)
+            for field, value in counts.items():
+                if value:
+                    pipe.hincrby(self.stats_key, field, value)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Embedding cache Redis write failed: {e}")
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return self._embed(list(texts), kind="document")
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text], kind="query")[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        return await self._aembed(list(texts), kind="document")
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self._aembed([text], kind="query"))[0]
+
+    def evict(self, max_entries: Optional[int] = None) -> int:
+        """
+        Trim the disk tier to `max_entries` files, removing the least recently
+        used first. Redis entries are bounded by their TTL.
+        """
+        max_entries = max_entries if max_entries is not None else self.max_disk_entries
+        if not self.cache_dir or max_entries is None:
+            return 0
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    continue
+        if len(entries) <= max_entries:
+            return 0
+        entries.sort()
+        removed = 0
+        for _, path in entries[:len(entries) - max_entries]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                continue
+        logger.info(f"Evicted {removed} embedding cache entries from {self.cache_dir}")
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Hit/miss counters for this process and, when Redis is configured,
+        aggregated across every process sharing the cache.
+        """
+        with self._lock:
+            stats = {"model_id": self.model_id, "process": dict(self._local_stats)}
+        if self.redis_client is not None:
+            try:
+                shared = self.redis_client.hgetall(self.stats_key)
+                stats["shared"] = {field: int(shared.get(field.encode(), 0))
+                                   for field in self.STATS_FIELDS}
+            except Exception as e:
+                logger.warning(f"Embedding cache stats unavailable: {e}")
+        return stats
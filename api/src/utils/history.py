@@ -0,0 +1,394 @@
+import asyncio
+import json
+import logging
+import weakref
+from datetime import datetime, timezone
+from functools import lru_cache
+from typing import Callable, List, Optional, Sequence, Tuple, Union
+
+import tiktoken
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage, message_to_dict, messages_from_dict
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from src.utils.message_codec import decode_messages, encode_message
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_LENGTH = 200
+
+# Pushes the messages and, when the metadata hash exists, refreshes its
+# counters (and its score in the activity set, if given) in the same atomic
+# round-trip. Conversations without the hash are never swept, so their keys
+# expire after the idle TTL instead.
+# KEYS: message list, metadata hash, activity sorted set ("" for none), then
+#       keys expiring with the message list
+# ARGV: ttl (0 for none), last_message_at, its epoch seconds, preview ("" for
+#       none), idle ttl (0 for none), messages...
+ADD_MESSAGES_SCRIPT = """
+local ttl = tonumber(ARGV[1])
+redis.call('LPUSH', KEYS[1], unpack(ARGV, 6))
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('HSET', KEYS[2], 'message_count', redis.call('LLEN', KEYS[1]), 'last_message_at', ARGV[2])
+    if ARGV[4] ~= '' then
+        redis.call('HSETNX', KEYS[2], 'preview', ARGV[4])
+    end
+    if KEYS[3] ~= '' then
+        redis.call('ZADD', KEYS[3], ARGV[3], KEYS[2])
+    end
+elseif tonumber(ARGV[5]) > 0 then
+    ttl = tonumber(ARGV[5])
+end
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+    for i = 4, #KEYS do
+        redis.call('EXPIRE', KEYS[i], ttl)
+    end
+end
+"""
+
+# ADD_MESSAGES_SCRIPT registered once per client, sync or async, instead of
+# hashing the script again on every write
+_add_messages_scripts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _add_messages_script(client: Union[Redis, AsyncRedis]):
+    script = _add_messages_scripts.get(client)
+    if script is None:
+        script = _add_messages_scripts[client] = client.register_script(ADD_MESSAGES_SCRIPT)
+    return script
+
+
+def page_range(limit: int, before: Optional[int] = None, after: Optional[int] = None) -> Optional[Tuple[int, int]]:
+    """
+    LRANGE start/stop of one page of a newest-first message list.
+
+    Messages are addressed by their position in the conversation, 0 being
+    the oldest, which new messages never shift. The page holds the `limit`
+    messages right after position `after` (up to `before`, if also given),
+    right before position `before`, or the newest ones. None when the page
+    is empty.
+    """
+    if after is not None:
+        first, last = after + 1, after + limit
+        if before is not None:
+            last = min(last, before - 1)
+    elif before is not None:
+        first, last = max(before - limit, 0), before - 1
+    else:
+        return 0, limit - 1
+    if last < first:
+        return None
+    # Counted from the oldest end of the list
+    return -(last + 1), -(first + 1)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str) -> int:
+    return len(_encoding().encode(text))
+
+
+def truncate_tokens(text: str, token_limit: int) -> str:
+    """
+    The beginning of `text` that fits in `token_limit` tokens.
+    """
+    tokens = _encoding().encode(text)
+    return text if len(tokens) <= token_limit else _encoding().decode(tokens[:token_limit])
+
+
+def count_message_tokens(message: BaseMessage) -> int:
+    """
+    Approximate prompt tokens of a message: its content plus the few tokens
+    of per-message framing chat models add.
+    """
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content)
+    return count_tokens(content) + 4
+
+
+def split_verbatim(newest_first: List[BaseMessage], token_limit: int) -> int:
+    """
+    How many of the newest messages fit in `token_limit` tokens. The newest
+    message is always kept.
+    """
+    tokens = 0
+    for kept, message in enumerate(newest_first):
+        tokens += count_message_tokens(message)
+        if kept and tokens > token_limit:
+            return kept
+    return len(newest_first)
+
+
+class RedisMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history in the same Redis layout as LangChain's
+    `RedisChatMessageHistory` (a list at `{key_prefix}{session_id}`, newest
+    message first, one JSON-encoded message per entry), built on shared
+    clients instead of a new connection pool per instance, and with native
+    async methods so the async chain path never blocks the event loop.
+    With `codec="msgpack"` new messages are written in the compact binary
+    format instead; entries of either format are always read.
+
+    With `metadata_key`, every write also keeps `message_count`,
+    `last_message_at` and `preview` (the first question) up to date in that
+    hash, if it exists, so listings never have to read the messages, and
+    with `activity_key` the hash key is also scored by its last activity in
+    that sorted set. Without the hash, the conversation's keys expire after
+    `idle_ttl` seconds without a new message, if given.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        redis_client: Redis,
+        async_redis_client: Optional[AsyncRedis] = None,
+        key_prefix: str = "message_store:",
+        ttl: Optional[int] = None,
+        metadata_key: Optional[str] = None,
+        activity_key: Optional[str] = None,
+        codec: str = "json",
+        idle_ttl: Optional[int] = None,
+    ):
+        self.session_id = session_id
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+        self.metadata_key = metadata_key
+        self.activity_key = activity_key
+        self.codec = codec
+        self.idle_ttl = idle_ttl
+
+    @property
+    def key(self) -> str:
+        return self.key_prefix + self.session_id
+
+    @staticmethod
+    def _decode(items: list) -> List[BaseMessage]:
+        return messages_from_dict(decode_messages(items[::-1]))
+
+    def _encode(self, message: BaseMessage) -> Union[str, bytes]:
+        return encode_message(message_to_dict(message), self.codec)
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """Retrieve the messages from Redis, oldest first"""
+        return self._decode(self.redis_client.lrange(self.key, 0, -1))
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        if self.async_redis_client is None:
+            return await super().aget_messages()
+        return self._decode(await self.async_redis_client.lrange(self.key, 0, -1))
+
+    def get_page(self, limit: int, before: Optional[int] = None, after: Optional[int] = None) -> List[BaseMessage]:
+        """Retrieve one page of the messages (see `page_range`), oldest first"""
+        message_range = page_range(limit, before, after)
+        if message_range is None:
+            return []
+        return self._decode(self.redis_client.lrange(self.key, *message_range))
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.add_messages([message])
+
+    def _script_args(self, messages: Sequence[BaseMessage]) -> list:
+        preview = next((message.content for message in messages
+                        if message.type == "human" and isinstance(message.content, str)), "")
+        now = datetime.now(timezone.utc)
+        return [self.ttl or 0, now.replace(tzinfo=None).isoformat(), now.timestamp(), preview[:PREVIEW_LENGTH],
+                self.idle_ttl or 0, *[self._encode(message) for message in messages]]
+
+    def _script_keys(self) -> list:
+        return [self.key, self.metadata_key, self.activity_key or ""]
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append the messages to the record in Redis in one round-trip"""
+        if not messages:
+            return
+        if self.metadata_key:
+            script = _add_messages_script(self.redis_client)
+            script(keys=self._script_keys(), args=self._script_args(messages))
+            return
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.lpush(self.key, *[self._encode(message) for message in messages])
+        if self.ttl:
+            pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        if self.async_redis_client is None:
+            return await super().aadd_messages(messages)
+        if not messages:
+            return
+        if self.metadata_key:
+            script = _add_messages_script(self.async_redis_client)
+            await script(keys=self._script_keys(), args=self._script_args(messages))
+            return
+        pipe = self.async_redis_client.pipeline(transaction=True)
+        pipe.lpush(self.key, *[self._encode(message) for message in messages])
+        if self.ttl:
+            pipe.expire(self.key, self.ttl)
+        await pipe.execute()
+
+    def _clear_metadata(self, pipe):
+        if self.metadata_key:
+            pipe.hdel(self.metadata_key, "message_count", "last_message_at", "preview")
+
+    def clear(self) -> None:
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(self.key)
+        self._clear_metadata(pipe)
+        pipe.execute()
+
+    async def aclear(self) -> None:
+        if self.async_redis_client is None:
+            return await super().aclear()
+        pipe = self.async_redis_client.pipeline(transaction=True)
+        pipe.delete(self.key)
+        self._clear_metadata(pipe)
+        await pipe.execute()
+
+
+class SummaryBufferMessageHistory(RedisMessageHistory):
+    """
+    History that hands the chain only the most recent `token_limit` tokens
+    verbatim, preceded by a running summary of everything older.
+
+    Messages that fall out of the verbatim window are folded into the summary
+    off the request path: `schedule_summary` is called (at most once per
+    `lock_ttl` seconds per conversation) and is expected to queue the
+    summarization task, which stores the summary and how many of the oldest
+    messages it covers in a hash next to the message list.
+    """
+
+    def __init__(
+        self,
+        session_id: str,
+        redis_client: Redis,
+        async_redis_client: Optional[AsyncRedis] = None,
+        key_prefix: str = "message_store:",
+        ttl: Optional[int] = None,
+        token_limit: int = 1000,
+        page_size: int = 20,
+        schedule_summary: Optional[Callable[[str], None]] = None,
+        lock_ttl: int = 60,
+        metadata_key: Optional[str] = None,
+        activity_key: Optional[str] = None,
+        codec: str = "json",
+        idle_ttl: Optional[int] = None,
+    ):
+        super().__init__(session_id, redis_client, async_redis_client, key_prefix, ttl,
+                         metadata_key, activity_key, codec, idle_ttl)
+        self.token_limit = token_limit
+        self.page_size = page_size
+        self.schedule_summary = schedule_summary
+        self.lock_ttl = lock_ttl
+
+    @property
+    def summary_key(self) -> str:
+        return f"message_summary:{self.session_id}"
+
+    @property
+    def lock_key(self) -> str:
+        return f"message_summary_lock:{self.session_id}"
+
+    def _script_keys(self) -> list:
+        return super()._script_keys() + [self.summary_key]
+
+    def _assemble(self, summary: Optional[bytes], newest_first: List[BaseMessage], kept: int) -> List[BaseMessage]:
+        messages = list(reversed(newest_first[:kept]))
+        if summary:
+            messages.insert(0, SystemMessage(
+                content=f"Summary of the earlier conversation: {summary.decode('utf-8')}"))
+        return messages
+
+    def _load_window(self):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hmget(self.summary_key, "summary", "summarized_count")
+        pipe.llen(self.key)
+        pipe.lrange(self.key, 0, self.page_size - 1)
+        (summary, summarized), total, items = pipe.execute()
+        unsummarized = max(total - int(summarized or 0), 0)
+        items = items[:unsummarized]
+        # Keep reading pages until the token budget is exhausted
+        while len(items) < unsummarized and split_verbatim(self._decode(items)[::-1], self.token_limit) == len(items):
+            items += self.redis_client.lrange(
+                self.key, len(items), min(len(items) + self.page_size, unsummarized) - 1)
+        return summary, unsummarized, items
+
+    async def _aload_window(self):
+        pipe = self.async_redis_client.pipeline(transaction=False)
+        pipe.hmget(self.summary_key, "summary", "summarized_count")
+        pipe.llen(self.key)
+        pipe.lrange(self.key, 0, self.page_size - 1)
+        (summary, summarized), total, items = await pipe.execute()
+        unsummarized = max(total - int(summarized or 0), 0)
+        items = items[:unsummarized]
+        while len(items) < unsummarized and split_verbatim(self._decode(items)[::-1], self.token_limit) == len(items):
+            items += await self.async_redis_client.lrange(
+                self.key, len(items), min(len(items) + self.page_size, unsummarized) - 1)
+        return summary, unsummarized, items
+
+    def _should_schedule(self, unsummarized: int, kept: int) -> bool:
+        return self.schedule_summary is not None and unsummarized > kept
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        summary, unsummarized, items = self._load_window()
+        newest_first = self._decode(items)[::-1]
+        kept = split_verbatim(newest_first, self.token_limit)
+        if self._should_schedule(unsummarized, kept) and self.redis_client.set(self.lock_key, 1, nx=True, ex=self.lock_ttl):
+            self.schedule_summary(self.session_id)
+        return self._assemble(summary, newest_first, kept)
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        if self.async_redis_client is None:
+            return self.messages
+        summary, unsummarized, items = await self._aload_window()
+        newest_first = self._decode(items)[::-1]
+        kept = split_verbatim(newest_first, self.token_limit)
+        if self._should_schedule(unsummarized, kept) and await self.async_redis_client.set(self.lock_key, 1, nx=True, ex=self.lock_ttl):
+            await asyncio.to_thread(self.schedule_summary, self.session_id)
+        return self._assemble(summary, newest_first, kept)
+
+    def fold_summary(self, summarize: Callable[[str, List[BaseMessage]], str]) -> int:
+        """
+        Fold every message older than the verbatim window into the summary
+        and return how many were folded. Runs in the summarization task.
+        """
+        try:
+            summary, unsummarized, items = self._load_window()
+            kept = split_verbatim(self._decode(items)[::-1], self.token_limit)
+            fold = unsummarized - kept
+            if fold <= 0:
+                return 0
+            summarized = int(self.redis_client.hget(self.summary_key, "summarized_count") or 0)
+            # Index from the tail: new messages are pushed at the head while
+            # the summary is being written
+            older = self.redis_client.lrange(self.key, -(summarized + fold), -(summarized + 1))
+            new_summary = summarize(summary.decode("utf-8") if summary else "", self._decode(older))
+            self.redis_client.hset(self.summary_key, mapping={
+                "summary": new_summary,
+                "summarized_count": summarized + len(older),
+            })
+            logger.info(f"Folded {len(older)} messages into the summary of {self.session_id}")
+            return len(older)
+        finally:
+            self.redis_client.delete(self.lock_key)
+
+    def clear(self) -> None:
+        pipe = self.redis_client.pipeline(transaction=True)
+        pipe.delete(self.key, self.summary_key)
+        self._clear_metadata(pipe)
+        pipe.execute()
+
+    async def aclear(self) -> None:
+        if self.async_redis_client is None:
+            return self.clear()
+        pipe = self.async_redis_client.pipeline(transaction=True)
+        pipe.delete(self.key, self.summary_key)
+        self._clear_metadata(pipe)
+        await pipe.execute()
@@ -0,0 +1,305 @@
+import logging
+import queue
+import threading
+from collections import Counter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import billiard
+import pypdf
+from langchain_core.documents import Document
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_community.document_loaders.parsers.pdf import _merge_text_and_extras, _purge_metadata, _validate_metadata
+from langchain_text_splitters import RecursiveCharacterTextSplitter, TextSplitter
+from pypdf import PdfReader
+
+from src.core.config import config
+from src.core.db import get_collection
+from src.utils.manifest import IngestManifest, file_hash, chunk_hash, chunk_id
+from src.utils.weavite import get_embeddings, add_embedded_documents, delete_documents, delete_documents_by_source
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _StageError:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+def _prefetch(items: Iterable, maxsize: int) -> Iterator:
+    """
+    Drain `items` on a background thread into a bounded queue, so the
+    producing stage keeps working while the consumer handles earlier items.
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except BaseException as exc:
+            put(_StageError(exc))
+        finally:
+            put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _StageError):
+                raise item.exc
+            yield item
+    finally:
+        stop.set()
+
+
+def get_text_splitter() -> TextSplitter:
+    """
+    Splitter used for uploaded documents, the same one `load_and_split` uses.
+    """
+    return RecursiveCharacterTextSplitter()
+
+
+def iter_pages(file_path: str) -> Iterator[Document]:
+    """
+    Lazily parse a PDF one page at a time.
+    """
+    return PyPDFLoader(file_path).lazy_load()
+
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> List[Document]:
+    """
+    Extract pages [start, stop) exactly as `PyPDFLoader` does: same parser
+    settings, text and metadata, so both paths give the same chunks and chunk
+    ids and switching PDF_PARSE_WORKERS does not re-embed anything.
+    """
+    parser = PyPDFLoader(file_path).parser
+    reader = PdfReader(file_path, password=parser.password)
+    doc_metadata = _purge_metadata(
+        {"producer": "PyPDF", "creator": "PyPDF", "creationdate": ""}
+        | dict(reader.metadata or {})
+        | {"source": file_path, "total_pages": len(reader.pages)})
+    documents = []
+    for page_number in range(start, stop):
+        page = reader.pages[page_number]
+        if pypdf.__version__.startswith("3"):
+            text = page.extract_text()
+        else:
+            text = page.extract_text(extraction_mode=parser.extraction_mode, **parser.extraction_kwargs)
+        text = _merge_text_and_extras([parser.extract_images_from_page(page)], text).strip()
+        documents.append(Document(
+            page_content=text,
+            metadata=_validate_metadata(
+                doc_metadata | {"page": page_number, "page_label": reader.page_labels[page_number]}),
+        ))
+    return documents
+
+
+def _extract_ranges(file_path: str, ranges: List[Tuple[int, int, int]], results):
+    """
+    Extract (index, start, stop) page ranges in a parsing process, putting
+    (index, pages, error) on `results`.
+    """
+    for index, start, stop in ranges:
+        try:
+            results.put((index, _extract_page_range(file_path, start, stop), None))
+        except Exception as e:
+            results.put((index, None, repr(e)))
+            return
+
+
+def iter_pages_parallel(file_path: str, workers: int, pages_per_task: int) -> Iterator[Document]:
+    """
+    Parse a PDF in `workers` processes, `pages_per_task` pages per range, and
+    yield the pages in document order as soon as each range is ready.
+
+    The processes are billiard's (Celery's fork of multiprocessing), which
+    unlike the standard library's may be started from a prefork worker
+    process. When they cannot be started the file is parsed sequentially,
+    logged as an error since PDF_PARSE_WORKERS is then not honoured.
+    """
+    page_count = len(PdfReader(file_path).pages)
+    ranges = [(index, start, min(start + pages_per_task, page_count))
+              for index, start in enumerate(range(0, page_count, pages_per_task))]
+    results = billiard.Queue()
+    processes = [billiard.Process(target=_extract_ranges, args=(file_path, ranges[i::workers], results), daemon=True)
+                 for i in range(min(workers, len(ranges)))]
+    try:
+        for process in processes:
+            process.start()
+    except (AssertionError, OSError) as e:
+        logger.error(f"Could not start {workers} PDF parsing processes ({e}), parsing {file_path} sequentially")
+        for process in processes:
+            if process.pid is not None:
+                process.terminate()
+        yield from iter_pages(file_path)
+        return
+
+    try:
+        ready: Dict[int, List[Document]] = {}
+        for index in range(len(ranges)):
+            while index not in ready:
+                try:
+                    done, pages, error = results.get(timeout=1)
+                except queue.Empty:
+                    if not any(process.is_alive() for process in processes):
+                        raise RuntimeError(f"PDF parsing processes exited before parsing all of {file_path}")
+                    continue
+                if error is not None:
+                    raise RuntimeError(f"Could not parse pages of {file_path}: {error}")
+                ready[done] = pages
+            yield from ready.pop(index)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def load_pages(file_path: str, workers: Optional[int] = None, pages_per_task: Optional[int] = None) -> Iterator[Document]:
+    """
+    Pages of a PDF in order, parsed in parallel when more than one worker is
+    configured.
+    """
+    workers = workers or config.PDF_PARSE_WORKERS
+    pages_per_task = pages_per_task or config.PDF_PAGES_PER_TASK
+    if workers > 1:
+        return iter_pages_parallel(file_path, workers, pages_per_task)
+    return iter_pages(file_path)
+
+
+def iter_chunks(pages: Iterable[Document], splitter: TextSplitter, progress: Dict[str, int]) -> Iterator[Document]:
+    """
+    Split pages into chunks as they are parsed.
+    """
+    for page in pages:
+        progress["pages_parsed"] += 1
+        yield from splitter.split_documents([page])
+
+
+def iter_new_chunks(chunks: Iterable[Document], source: str, known_ids: Set[str], entries: List[dict], progress: Dict[str, int]) -> Iterator[Tuple[str, Document]]:
+    """
+    Give every chunk its deterministic id, record it in `entries` and yield
+    only the chunks the index does not already hold.
+    """
+    occurrences = Counter()
+    for chunk in chunks:
+        page = chunk.metadata.get("page")
+        digest = chunk_hash(chunk.page_content)
+        occurrences[(page, digest)] += 1
+        object_id = chunk_id(source, page, digest, occurrences[(page, digest)])
+        entries.append({"id": object_id, "page": page, "hash": digest})
+        if object_id in known_ids:
+            progress["chunks_skipped"] += 1
+            continue
+        yield object_id, chunk
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def iter_embedded_batches(batches: Iterable[List[Tuple[str, Document]]], progress: Dict[str, int]) -> Iterator[Tuple[List[Tuple[str, Document]], List[List[float]]]]:
+    """
+    Embed each batch of chunks with a single bulk call.
+    """
+    for batch in batches:
+        vectors = get_embeddings().embed_documents([chunk.page_content for _, chunk in batch])
+        progress["chunks_embedded"] += len(batch)
+        yield batch, vectors
+
+
+def ingest_pdf(
+    file_path: str,
+    on_progress: Optional[Callable[[Dict[str, int]], None]] = None,
+    batch_size: Optional[int] = None,
+    queue_size: Optional[int] = None,
+    manifest: Optional[IngestManifest] = None,
+) -> Dict[str, int]:
+    """
+    Parse, embed and write a PDF into the vector store as a streaming pipeline.
+
+    Parsing, embedding and writing run concurrently: embedding starts on the
+    first batch while later pages are still being parsed. `on_progress` is
+    called from the calling thread after every written batch with the current
+    counters.
+
+    Re-ingesting a file is incremental. Chunks get ids derived from their
+    source, page and content, so chunks already listed in the manifest are
+    skipped, new or edited ones are embedded and written, and chunks that
+    disappeared from the file are deleted. An unchanged file is skipped
+    without being parsed.
+
+    Chunks Weaviate rejects are counted in `chunks_failed` and left out of
+    the manifest, so the next ingestion of the file retries them; the caller
+    decides whether that fails the ingestion.
+    """
+    batch_size = batch_size or config.INGEST_BATCH_SIZE
+    queue_size = queue_size or config.INGEST_QUEUE_SIZE
+    manifest = manifest or IngestManifest(get_collection("ingest_manifest"))
+    progress = {"pages_parsed": 0, "chunks_embedded": 0, "chunks_written": 0,
+                "chunks_failed": 0, "chunks_skipped": 0, "chunks_deleted": 0}
+
+    digest = file_hash(file_path)
+    previous = manifest.get(file_path)
+    if previous and previous.get("file_hash") == digest:
+        progress["chunks_skipped"] = len(previous.get("chunks", []))
+        logger.info(f"{file_path} is unchanged since its last ingestion, skipping")
+        return progress
+    if previous is None:
+        # Objects written before the manifest existed have random ids, drop
+        # them so the file is not indexed twice
+        delete_documents_by_source(file_path)
+    known_ids = {chunk["id"] for chunk in previous.get("chunks", [])} if previous else set()
+
+    entries: List[dict] = []
+    chunks = iter_chunks(load_pages(file_path), get_text_splitter(), progress)
+    chunk_batches = _prefetch(
+        iter_batches(iter_new_chunks(chunks, file_path, known_ids, entries, progress), batch_size),
+        queue_size)
+    embedded_batches = _prefetch(
+        iter_embedded_batches(chunk_batches, progress), queue_size)
+
+    failed_ids: Set[str] = set()
+    for batch, vectors in embedded_batches:
+        ids = [object_id for object_id, _ in batch]
+        written = add_embedded_documents([chunk for _, chunk in batch], vectors, ids=ids)
+        failed_ids.update(set(ids) - set(written))
+        progress["chunks_written"] += len(written)
+        progress["chunks_failed"] += len(batch) - len(written)
+        if on_progress:
+            on_progress(dict(progress))
+
+    stale_ids = known_ids - {entry["id"] for entry in entries}
+    delete_documents(list(stale_ids))
+    progress["chunks_deleted"] = len(stale_ids)
+    # Without the file hash an unchanged file is not skipped next time
+    manifest.save(file_path, None if failed_ids else digest,
+                  [entry for entry in entries if entry["id"] not in failed_ids])
+
+    logger.info(f"Ingested {file_path}: {progress}")
+    if on_progress:
+        on_progress(dict(progress))
+    return progress
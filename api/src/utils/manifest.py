@@ -0,0 +1,59 @@
+import hashlib
+import uuid
+from datetime import datetime
+from typing import List, Optional
+from pymongo.collection import Collection
+
+# Namespace for deterministic chunk ids, so an unchanged chunk always maps to
+# the same Weaviate object
+CHUNK_NAMESPACE = uuid.UUID("6f1d3c56-2b7e-4c1a-9a53-0f6c2d8e4b17")
+
+
+def file_hash(file_path: str) -> str:
+    """
+    sha256 of a file's bytes, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def chunk_id(source: str, page, digest: str, occurrence: int) -> str:
+    """
+    Deterministic object id for a chunk; `occurrence` tells apart identical
+    chunks on the same page.
+    """
+    return str(uuid.uuid5(CHUNK_NAMESPACE, f"{source}:{page}:{digest}:{occurrence}"))
+
+
+class IngestManifest:
+    """
+    Record of every ingested source file: its content hash and the id, page
+    and content hash of each chunk written for it.
+    """
+
+    def __init__(self, collection: Collection):
+        self.collection = collection
+
+    def get(self, source: str) -> Optional[dict]:
+        return self.collection.find_one({"source": source}, {"_id": 0})
+
+    def save(self, source: str, digest: Optional[str], chunks: List[dict]):
+        self.collection.update_one(
+            {"source": source},
+            {"$set": {
+                "source": source,
+                "file_hash": digest,
+                "chunks": chunks,
+                "updated_at": datetime.utcnow(),
+            }},
+            upsert=True)
+
+    def delete(self, source: str):
+        self.collection.delete_one({"source": source})
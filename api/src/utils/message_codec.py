@@ -0,0 +1,69 @@
+import json
+from typing import Iterable, List, Union
+
+import msgpack
+
+# Binary entries start with a byte JSON can never start with, followed by the
+# format version, so both kinds can live in the same list
+MAGIC = b"\x00"
+VERSION = 1
+
+# Short keys for the message data fields; fields other than content that are
+# None or empty are left out entirely
+FIELDS = {
+    "content": "c",
+    "additional_kwargs": "k",
+    "response_metadata": "r",
+    "name": "n",
+    "id": "i",
+    "example": "e",
+    "tool_calls": "tc",
+    "invalid_tool_calls": "itc",
+    "usage_metadata": "u",
+    "tool_call_id": "ti",
+}
+SHORT_FIELDS = {short: field for field, short in FIELDS.items()}
+CODECS = ("json", "msgpack")
+
+
+def encode_message(message: dict, codec: str = "json") -> Union[str, bytes]:
+    """
+    Encode a message dict in LangChain's `{"type": ..., "data": {...}}` form.
+
+    "json" writes exactly what LangChain's `RedisChatMessageHistory` writes.
+    "msgpack" writes the compact versioned binary format, which only this
+    module can read back.
+    """
+    if codec == "json":
+        return json.dumps(message)
+    if codec != "msgpack":
+        raise ValueError(f"Unknown message codec: {codec}")
+    packed = {"t": message.get("type")}
+    for field, value in message.get("data", {}).items():
+        if field == "type" or (field != "content" and value in (None, {}, [])):
+            continue
+        packed[FIELDS.get(field, field)] = value
+    return MAGIC + bytes([VERSION]) + msgpack.packb(packed, use_bin_type=True)
+
+
+def decode_message(raw: Union[str, bytes]) -> dict:
+    """
+    Decode one stored entry, binary or JSON, into LangChain's message dict.
+    """
+    if isinstance(raw, bytes) and raw[:1] == MAGIC:
+        version = raw[1]
+        if version != VERSION:
+            raise ValueError(f"Unsupported message format version: {version}")
+        packed = msgpack.unpackb(raw[2:], raw=False)
+        message_type = packed.pop("t")
+        data = {SHORT_FIELDS.get(key, key): value for key, value in packed.items()}
+        data["type"] = message_type
+        return {"type": message_type, "data": data}
+    return json.loads(raw)
+
+
+def decode_messages(items: Iterable[Union[str, bytes]]) -> List[dict]:
+    """
+    Decode an LRANGE result; entries keep their order.
+    """
+    return [decode_message(raw) for raw in items]
@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client import multiprocess, start_http_server
+
+logger = logging.getLogger(__name__)
+
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+# (set by start.sh before the workers start) and /metrics sums them all; the
+# Celery pool does the same (celery_start.sh) and its main process serves
+# the sum on CELERY_METRICS_PORT
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "askdocs_chain_stage_seconds",
+    "Time spent in each stage of a RAG chain run",
+    ["chain", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "askdocs_llm_tokens",
+    "Tokens sent to and generated by the chat model",
+    ["chain", "stage", "kind"],
+)
+EMBEDDING_SECONDS = Histogram(
+    "askdocs_embedding_seconds",
+    "Time spent in the embedding model, cache hits excluded",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+
+# Run names of the chains built by langchain's create_* helpers; an LLM
+# call inside the retrieval side of the chain rewrites the question
+# (create_retrieval_chain renames the history-aware retriever)
+CONTEXTUALIZE_CHAINS = ("chat_retriever_chain", "retrieve_documents")
+LOAD_HISTORY = "load_history"
+# The two searches of the hybrid retriever (hybrid mode), by class name;
+# other wrapped retrievers (packing, replica fallback) are part of retrieve
+HYBRID_RETRIEVER = "HybridRetriever"
+NESTED_RETRIEVERS = {"VectorStoreRetriever": "vector_search", "ReplicaRetriever": "vector_search",
+                     "BM25Retriever": "bm25_search"}
+
+
+class _Run:
+    __slots__ = ("root", "parent", "name", "kind", "stage", "start", "streamed")
+
+    def __init__(self, root: UUID, parent: Optional["_Run"], name: str, kind: str, stage: Optional[str]):
+        self.root = root
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.streamed = 0
+
+    def ancestors(self):
+        run = self.parent
+        while run is not None:
+            yield run
+            run = run.parent
+
+
+class StageTimer(BaseCallbackHandler):
+    """
+    Callback handler recording how long each stage of a chain run takes:
+
+        total          the whole run
+        load_history   reading the conversation history
+        contextualize  the LLM call rewriting the question from the history
+        retrieve       the retriever (query embedding and vector search);
+                       in hybrid mode also vector_search and bm25_search
+        generate       the LLM call writing the answer
+
+    and the prompt and completion tokens of each LLM call. A run slower than
+    `slow_seconds` is logged with its breakdown.
+    """
+    # Only bookkeeping here, no need for a thread per event in async runs
+    run_inline = True
+
+    def __init__(self, chain: str, slow_seconds: float = 0.0):
+        self.chain = chain
+        self.slow_seconds = slow_seconds
+        self._lock = threading.Lock()
+        self._runs: Dict[UUID, _Run] = {}
+        self._breakdowns: Dict[UUID, Dict[str, float]] = {}
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, kind: str) -> _Run:
+        with self._lock:
+            parent = self._runs.get(parent_run_id)
+            if parent is None:
+                run = _Run(run_id, None, name, kind, "total")
+                self._breakdowns[run_id] = defaultdict(float)
+            else:
+                run = _Run(parent.root, parent, name, kind, None)
+            self._runs[run_id] = run
+            return run
+
+    def _end(self, run_id: UUID) -> Optional[_Run]:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+            if run is None or run.stage is None:
+                return run
+            duration = time.perf_counter() - run.start
+            breakdown = self._breakdowns.get(run.root)
+            if run.root == run_id:
+                self._breakdowns.pop(run_id, None)
+            elif breakdown is not None:
+                breakdown[run.stage] += duration
+        STAGE_SECONDS.labels(self.chain, run.stage).observe(duration)
+        if run.root == run_id and self.slow_seconds and duration >= self.slow_seconds:
+            stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in breakdown.items())
+            logger.warning(f"Slow {self.chain} run: {duration:.2f}s ({stages})")
+        return run
+
+    def on_chain_start(self, serialized: Dict[str, Any], inputs: Dict[str, Any], *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        name = kwargs.get("name") or (serialized or {}).get("name", "")
+        run = self._start(run_id, parent_run_id, name, "chain")
+        if name == LOAD_HISTORY:
+            run.stage = "load_history"
+
+    def on_chain_end(self, outputs: Dict[str, Any], *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        run = self._start(run_id, parent_run_id, kwargs.get("name", ""), "llm")
+        if run.parent is not None:
+            contextualizing = any(ancestor.name in CONTEXTUALIZE_CHAINS for ancestor in run.ancestors())
+            run.stage = "contextualize" if contextualizing else "generate"
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self.on_llm_start(serialized, [], run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        run = self._runs.get(run_id)
+        if run is not None:
+            run.streamed += 1
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self._end(run_id)
+        if run is None:
+            return
+        prompt_tokens, completion_tokens = token_usage(response)
+        if completion_tokens is None:
+            # Streamed without usage reported: one chunk is about one token
+            completion_tokens = run.streamed
+        stage = run.stage or "llm"
+        if prompt_tokens:
+            LLM_TOKENS.labels(self.chain, stage, "prompt").inc(prompt_tokens)
+        if completion_tokens:
+            LLM_TOKENS.labels(self.chain, stage, "completion").inc(completion_tokens)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_retriever_start(self, serialized: Dict[str, Any], query: str, *, run_id: UUID,
+                           parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        name = kwargs.get("name") or (serialized or {}).get("name", "")
+        run = self._start(run_id, parent_run_id, name, "retriever")
+        if run.parent is None:
+            return
+        if not any(ancestor.kind == "retriever" for ancestor in run.ancestors()):
+            run.stage = "retrieve"
+        elif run.parent.kind == "retriever" and run.parent.name == HYBRID_RETRIEVER:
+            run.stage = NESTED_RETRIEVERS.get(name)
+
+    def on_retriever_end(self, documents: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_retriever_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+
+def token_usage(response: LLMResult) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Prompt and completion tokens of an LLM call, None when not reported.
+    """
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                return metadata.get("input_tokens"), metadata.get("output_tokens")
+    return None, None
+
+
+def _registry() -> CollectorRegistry:
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render() -> Tuple[bytes, str]:
+    """
+    The metrics in the Prometheus text format, summed over every worker when
+    running under gunicorn, and their content type.
+    """
+    return generate_latest(_registry()), CONTENT_TYPE_LATEST
+
+
+def serve(port: int):
+    """
+    Serve the metrics over HTTP on `port` from a background thread, summed
+    over every process of a Celery worker's pool.
+    """
+    start_http_server(port, registry=_registry())
+    logger.info(f"Serving metrics on port {port}")
@@ -1,8 +1,18 @@
+import asyncio
+from functools import lru_cache
+from typing import Any, AsyncIterator, Iterator
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_community.chat_models import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
-from src.utils.weavite import db
+from src.utils.weavite import get_vector_store, get_bm25_index, get_embeddings, get_index_version, get_vector_replica
+from src.utils.answer_cache import AnswerCache, normalize_question
+from src.utils.single_flight import SingleFlight
+from src.utils.scheduler import get_llm_scheduler
+from src.utils.metrics import StageTimer
+from src.core.db import get_redis, get_async_redis
+from src.utils.retrievers import BM25Retriever, HybridRetriever, PackingRetriever, ReplicaRetriever
+from src.core.config import config
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_core.runnables import ConfigurableFieldSpec
 from langchain.chains.combine_documents import create_stuff_documents_chain
@@ -11,8 +21,79 @@ from langchain.chains import create_history_aware_retriever, create_retrieval_ch
 from src.utils.utils import get_message_history
 
 
-llm = ChatOpenAI(model="gpt-3.5-turbo", temperature=0)
-retriever = db.as_retriever()
+# The model, the retriever and the chains are built on first use (or by
+# warm_up), so importing this module opens no connection
+
+
+def traced(chain, name: str):
+    """
+    `chain` with the latency of its stages and its token counts recorded
+    under `name` (see `src.utils.metrics`).
+    """
+    return chain.with_config(callbacks=[StageTimer(name, slow_seconds=config.TRACE_SLOW_SECONDS)])
+
+
+class ScheduledChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI whose requests go through the LLM scheduler. A streamed
+    answer holds its slot until the stream ends.
+    """
+
+    def _generate(self, *args: Any, **kwargs: Any):
+        with get_llm_scheduler().slot():
+            return super()._generate(*args, **kwargs)
+
+    async def _agenerate(self, *args: Any, **kwargs: Any):
+        async with get_llm_scheduler().aslot():
+            return await super()._agenerate(*args, **kwargs)
+
+    def _stream(self, *args: Any, **kwargs: Any) -> Iterator:
+        with get_llm_scheduler().slot(reentrant=False):
+            yield from super()._stream(*args, **kwargs)
+
+    async def _astream(self, *args: Any, **kwargs: Any) -> AsyncIterator:
+        async with get_llm_scheduler().aslot(reentrant=False):
+            async for chunk in super()._astream(*args, **kwargs):
+                yield chunk
+
+
+@lru_cache(maxsize=None)
+def get_llm():
+    return ScheduledChatOpenAI(model="gpt-3.5-turbo", temperature=0)
+
+
+@lru_cache(maxsize=None)
+def get_retriever():
+    # MMR picks RETRIEVAL_K chunks out of a larger pool of candidates
+    mmr = config.CONTEXT_PACKING and config.CONTEXT_MMR
+    k = max(config.RETRIEVAL_K, config.CONTEXT_MMR_FETCH_K) if mmr else config.RETRIEVAL_K
+    retriever = get_vector_store().as_retriever(search_kwargs={"k": k})
+    if config.VECTOR_REPLICA_ENABLED:
+        retriever = ReplicaRetriever(
+            replica=get_vector_replica(),
+            embeddings=get_embeddings(),
+            documents=get_bm25_index().get_documents,
+            fallback=retriever,
+            k=k,
+        )
+    if config.RETRIEVAL_MODE == "hybrid":
+        retriever = HybridRetriever(
+            vector_retriever=retriever,
+            lexical_retriever=BM25Retriever(index=get_bm25_index(), k=k),
+            k=k,
+            rrf_k=config.HYBRID_RRF_K,
+            lexical_fast_path=config.LEXICAL_FAST_PATH,
+        )
+    if config.CONTEXT_PACKING:
+        retriever = PackingRetriever(
+            retriever=retriever,
+            token_budget=config.CONTEXT_TOKEN_BUDGET,
+            duplicate_threshold=config.CONTEXT_DUPLICATE_THRESHOLD,
+            embeddings=get_embeddings() if mmr else None,
+            mmr_lambda=config.CONTEXT_MMR_LAMBDA,
+            mmr_k=config.RETRIEVAL_K,
+        )
+    return retriever
 
 template = """You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.
 Question: {question}
@@ -22,15 +103,107 @@ Answer:
 prompt = ChatPromptTemplate.from_template(template)
 
 
-def rag_answer(question):
-    rag_chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
+
+@lru_cache(maxsize=None)
+def get_simple_rag_chain():
+    return traced(
+        {"context": get_retriever(), "question": RunnablePassthrough()}
         | prompt
-        | llm
-        | StrOutputParser()
+        | get_llm()
+        | StrOutputParser(),
+        "rag_answer",
+    )
+
+
+@lru_cache(maxsize=None)
+def get_answer_cache():
+    if not config.ANSWER_CACHE_ENABLED:
+        return None
+    return AnswerCache(
+        get_redis(),
+        embeddings=get_embeddings(),
+        ttl=config.ANSWER_CACHE_TTL,
+        max_entries=config.ANSWER_CACHE_MAX_ENTRIES,
+        similarity_threshold=config.ANSWER_CACHE_SIMILARITY,
     )
 
-    return rag_chain.invoke(question)
+
+@lru_cache(maxsize=None)
+def get_single_flight():
+    if not config.SINGLE_FLIGHT_ENABLED:
+        return None
+    return SingleFlight(get_async_redis(), timeout=config.SINGLE_FLIGHT_TIMEOUT)
+
+
+def rag_answer(question):
+    return get_simple_rag_chain().invoke(question)
+
+
+def answer_question(question: str) -> dict:
+    """
+    Answer a question through the answer cache, falling back to the RAG chain.
+    """
+    answer_cache = get_answer_cache()
+    if answer_cache is None:
+        return {"answer": rag_answer(question), "cached": False}
+    version = get_index_version()
+    hit = answer_cache.get(question, version)
+    if hit:
+        return {"answer": hit["answer"], "cached": True, "match": hit["match"]}
+    answer = rag_answer(question)
+    answer_cache.set(question, answer, version)
+    return {"answer": answer, "cached": False}
+
+
+async def aanswer_question(question: str) -> dict:
+    """
+    Async variant of `answer_question`. A question asked again, in any
+    worker, while its answer is being generated waits for that answer
+    instead of running the chain a second time.
+    """
+    answer_cache = get_answer_cache()
+    single_flight = get_single_flight()
+    simple_rag_chain = get_simple_rag_chain()
+    if answer_cache is None and single_flight is None:
+        return {"answer": await simple_rag_chain.ainvoke(question), "cached": False}
+    version = await asyncio.to_thread(get_index_version)
+    if answer_cache is not None:
+        hit = await asyncio.to_thread(answer_cache.get, question, version)
+        if hit:
+            return {"answer": hit["answer"], "cached": True, "match": hit["match"]}
+
+    async def generate():
+        answer = await simple_rag_chain.ainvoke(question)
+        if answer_cache is not None:
+            await asyncio.to_thread(answer_cache.set, question, answer, version)
+        return answer
+
+    if single_flight is None:
+        return {"answer": await generate(), "cached": False}
+    answer, coalesced = await single_flight.run(f"v{version}:{normalize_question(question)}", generate)
+    return {"answer": answer, "cached": False, "coalesced": coalesced}
+
+
+async def astream_answer(question: str) -> AsyncIterator[str]:
+    """
+    Stream the answer to a question token by token. A cached answer is
+    yielded as a single chunk; a freshly generated one is cached once the
+    stream completes.
+    """
+    answer_cache = get_answer_cache()
+    version = None
+    if answer_cache is not None:
+        version = await asyncio.to_thread(get_index_version)
+        hit = await asyncio.to_thread(answer_cache.get, question, version)
+        if hit:
+            yield hit["answer"]
+            return
+    tokens = []
+    async for token in get_simple_rag_chain().astream(question):
+        tokens.append(token)
+        yield token
+    if answer_cache is not None:
+        await asyncio.to_thread(answer_cache.set, question, "".join(tokens), version)
 
 
 ### Contextualize question ###
@@ -48,9 +221,6 @@ contextualize_q_prompt = ChatPromptTemplate.from_messages(
         ("human", "{input}"),
     ]
 )
-history_aware_retriever = create_history_aware_retriever(
-    llm, retriever, contextualize_q_prompt
-)
 
 ### Answer question ###
 system_prompt = (
@@ -69,32 +239,97 @@ qa_prompt = ChatPromptTemplate.from_messages(
         ("human", "{input}"),
     ]
 )
-question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-rag_chain = create_retrieval_chain(
-    history_aware_retriever, question_answer_chain)
-
-conversational_rag_chain = RunnableWithMessageHistory(
-    rag_chain,
-    get_message_history,
-    input_messages_key="input",
-    history_messages_key="chat_history",
-    output_messages_key="answer",
-    history_factory_config=[
-        ConfigurableFieldSpec(
-            id="user_id",
-            annotation=str,
-            name="User ID",
-            description="Unique identifier for the user.",
-            default="",
-            is_shared=True,
-        ),
-        ConfigurableFieldSpec(
-            id="conversation_id",
-            annotation=str,
-            name="Conversation ID",
-            description="Unique identifier for the conversation.",
-            default="",
-            is_shared=True,
-        ),
-    ],
+
+
+@lru_cache(maxsize=None)
+def get_rag_chain():
+    history_aware_retriever = create_history_aware_retriever(
+        get_llm(), get_retriever(), contextualize_q_prompt
+    )
+    question_answer_chain = create_stuff_documents_chain(get_llm(), qa_prompt)
+    return create_retrieval_chain(
+        history_aware_retriever, question_answer_chain)
+
+### Summarize history ###
+summary_system_prompt = (
+    "Progressively summarize the lines of conversation provided, "
+    "adding onto the previous summary and returning a new summary. "
+    "Keep names, figures and open questions; be concise."
 )
+summary_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", summary_system_prompt),
+        ("human", "Current summary:\n{summary}\n\nNew lines of conversation:\n{conversation}\n\nNew summary:"),
+    ]
+)
+
+
+@lru_cache(maxsize=None)
+def get_summary_chain():
+    return traced(summary_prompt | get_llm() | StrOutputParser(), "summary")
+
+
+def summarize_conversation(summary: str, messages) -> str:
+    """
+    Fold `messages` into the running `summary` of a conversation.
+    """
+    conversation = "\n".join(f"{message.type}: {message.content}" for message in messages)
+    return get_summary_chain().invoke({"summary": summary or "(none)", "conversation": conversation})
+
+
+@lru_cache(maxsize=None)
+def get_conversational_rag_chain():
+    return traced(RunnableWithMessageHistory(
+        get_rag_chain(),
+        get_message_history,
+        input_messages_key="input",
+        history_messages_key="chat_history",
+        output_messages_key="answer",
+        history_factory_config=[
+            ConfigurableFieldSpec(
+                id="user_id",
+                annotation=str,
+                name="User ID",
+                description="Unique identifier for the user.",
+                default="",
+                is_shared=True,
+            ),
+            ConfigurableFieldSpec(
+                id="conversation_id",
+                annotation=str,
+                name="Conversation ID",
+                description="Unique identifier for the conversation.",
+                default="",
+                is_shared=True,
+            ),
+        ],
+    ), "conversational_rag_chain")
+
+
+async def astream_conversational_answer(question: str, user_id: str, conversation_id: str) -> AsyncIterator[str]:
+    """
+    Stream the history-aware answer token by token. The question and the full
+    answer are appended to the conversation history once the stream finishes.
+    """
+    async for chunk in get_conversational_rag_chain().astream(
+        {"input": question},
+        config={
+            "configurable": {"user_id": user_id, "conversation_id": conversation_id}
+        },
+    ):
+        token = chunk.get("answer")
+        if token:
+            yield token
+
+
+def warm_up():
+    """
+    Build the embedding model, the vector store and every chain ahead of the
+    first request.
+    """
+    get_embeddings()
+    get_answer_cache()
+    get_single_flight()
+    get_simple_rag_chain()
+    get_summary_chain()
+    get_conversational_rag_chain()
@@ -0,0 +1,160 @@
+import asyncio
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from src.utils.context_packing import diversify, pack_documents
+
+QUESTION_RE = re.compile(r"\?|^\s*(what|why|how|when|where|who|which|can|could|does|do|is|are|explain|describe)\b", re.IGNORECASE)
+
+
+def is_keyword_query(query: str, max_terms: int = 4) -> bool:
+    """
+    Whether a query looks like a keyword lookup (a part number, a name, a
+    couple of terms) rather than a natural-language question.
+    """
+    if QUESTION_RE.search(query):
+        return False
+    terms = query.split()
+    if not terms or len(terms) > max_terms:
+        return False
+    return len(terms) <= 2 or any(char.isdigit() for char in query)
+
+
+class BM25Retriever(BaseRetriever):
+    """
+    Retriever over the local BM25 index; needs no embedding call.
+    """
+    index: Any
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [document for document, _ in self.index.search(query, k=self.k)]
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        results = await asyncio.to_thread(self.index.search, query, self.k)
+        return [document for document, _ in results]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses the lexical (BM25) and vector rankings with reciprocal rank fusion.
+
+    Keyword-like queries first try the lexical index alone and return its
+    hits without calling the embedding model or the vector store; the full
+    fusion runs only when that finds nothing.
+    """
+    vector_retriever: BaseRetriever
+    lexical_retriever: BM25Retriever
+    k: int = 4
+    rrf_k: int = 60
+    lexical_fast_path: bool = True
+
+    @staticmethod
+    def _key(document: Document) -> tuple:
+        return (document.metadata.get("source"), document.metadata.get("page"), document.page_content)
+
+    def fuse(self, rankings: List[List[Document]]) -> List[Document]:
+        scores: Dict[tuple, float] = {}
+        documents: Dict[tuple, Document] = {}
+        for ranking in rankings:
+            for rank, document in enumerate(ranking):
+                key = self._key(document)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+                documents.setdefault(key, document)
+        ordered = sorted(scores, key=scores.get, reverse=True)
+        return [documents[key] for key in ordered[:self.k]]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        lexical = self.lexical_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if self.lexical_fast_path and lexical and is_keyword_query(query):
+            return lexical[:self.k]
+        vector = self.vector_retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self.fuse([lexical, vector])
+
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        config = {"callbacks": run_manager.get_child()}
+        if self.lexical_fast_path and is_keyword_query(query):
+            lexical = await self.lexical_retriever.ainvoke(query, config=config)
+            if lexical:
+                return lexical[:self.k]
+            vector = await self.vector_retriever.ainvoke(query, config=config)
+        else:
+            # Both rankings are needed, fetch them concurrently
+            lexical, vector = await asyncio.gather(
+                self.lexical_retriever.ainvoke(query, config=config),
+                self.vector_retriever.ainvoke(query, config=config))
+        return self.fuse([lexical, vector])
+
+
+class ReplicaRetriever(BaseRetriever):
+    """
+    Vector search on the local replica of the index (see
+    `src.utils.vector_replica`), the documents read by id with `documents`.
+    Queries go to `fallback` (Weaviate) while the replica is empty, before
+    its first sync.
+    """
+    replica: Any
+    embeddings: Any
+    documents: Callable[[List[str]], List[Optional[Document]]]
+    fallback: Optional[BaseRetriever] = None
+    k: int = 4
+
+    def _search(self, vector: List[float]) -> List[Document]:
+        hits = self.replica.search([vector], self.k)[0]
+        documents = self.documents([object_id for object_id, _ in hits])
+        return [document for document in documents if document is not None]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        self.replica.refresh()
+        if not len(self.replica) and self.fallback is not None:
+            return self.fallback.invoke(query, config={"callbacks": run_manager.get_child()})
+        return self._search(self.embeddings.embed_query(query))
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        self.replica.refresh()
+        if not len(self.replica) and self.fallback is not None:
+            return await self.fallback.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        vector = await self.embeddings.aembed_query(query)
+        return await asyncio.to_thread(self._search, vector)
+
+
+class PackingRetriever(BaseRetriever):
+    """
+    Packs the documents of another retriever into a compact context for the
+    prompt (see `pack_documents`): overlapping chunks of a page merged,
+    near-duplicates dropped, cut at `token_budget` tokens. With `embeddings`
+    the documents are first reordered by maximal marginal relevance, keeping
+    the first `mmr_k` (all when None), so the wrapped retriever should fetch
+    a larger pool; the chunk vectors usually come from the embedding cache.
+    """
+    retriever: BaseRetriever
+    token_budget: int = 3000
+    duplicate_threshold: float = 0.8
+    embeddings: Optional[Any] = None
+    mmr_lambda: float = 0.5
+    mmr_k: Optional[int] = None
+
+    def _pack(self, documents: List[Document]) -> List[Document]:
+        return pack_documents(documents, token_budget=self.token_budget, duplicate_threshold=self.duplicate_threshold)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        documents = self.retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+        if self.embeddings is not None and len(documents) > 1:
+            query_embedding = self.embeddings.embed_query(query)
+            embeddings = self.embeddings.embed_documents([document.page_content for document in documents])
+            documents = diversify(query_embedding, embeddings, documents, self.mmr_lambda, self.mmr_k)
+        return self._pack(documents)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun) -> List[Document]:
+        documents = await self.retriever.ainvoke(query, config={"callbacks": run_manager.get_child()})
+        if self.embeddings is not None and len(documents) > 1:
+            query_embedding, embeddings = await asyncio.gather(
+                self.embeddings.aembed_query(query),
+                self.embeddings.aembed_documents([document.page_content for document in documents]))
+            documents = diversify(query_embedding, embeddings, documents, self.mmr_lambda, self.mmr_k)
+        return await asyncio.to_thread(self._pack, documents)
@@ -0,0 +1,397 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from functools import lru_cache
+from typing import Optional
+
+from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
+
+from src.core.config import config
+from src.core.db import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Takes one token from a bucket refilled at `rate` tokens per second up to
+# `burst`. A caller may take a token up to `max_wait` seconds before it is
+# refilled, and is told how long to wait for it; beyond that nothing is
+# taken. The bucket is read with the server clock, so every worker agrees.
+# KEYS: bucket hash
+# ARGV: rate, burst, max wait
+# Returns: {1 if taken else 0, seconds to wait as a string}
+TOKEN_BUCKET_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local rate, burst, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens') or burst)
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated') or now)
+tokens = math.min(burst, tokens + (now - updated) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+if wait > max_wait then
+    return {0, tostring(wait)}
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate + max_wait) + 1)
+return {1, tostring(wait)}
+"""
+
+# Takes one of `limit` leases in a semaphore shared by every worker. Leases
+# of callers that died without releasing them lapse after `lease` seconds.
+# KEYS: lease sorted set (token -> expiry)
+# ARGV: token, limit, lease seconds
+# Returns: 1 if taken else 0
+ACQUIRE_LEASE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], math.ceil(tonumber(ARGV[3])) + 1)
+return 1
+"""
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    NORMAL = 1
+    BACKGROUND = 2
+
+
+_priority: ContextVar[Priority] = ContextVar("scheduler_priority", default=Priority.NORMAL)
+# Schedulers whose slot the current call already holds; a model that calls
+# itself (a generate that streams) must not queue behind its own slot
+_held: ContextVar[frozenset] = ContextVar("scheduler_held", default=frozenset())
+
+
+@contextmanager
+def request_priority(priority: Priority):
+    """
+    Queue the model calls made inside the block with `priority`.
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class Overloaded(Exception):
+    """
+    A call was turned away: the wait queue is full (503), or the shared rate
+    limit would make it wait too long (429).
+    """
+
+    def __init__(self, detail: str, retry_after: int, status_code: int = 503):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted", "abandoned")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.abandoned = False
+
+
+def _set_result(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Scheduler:
+    """
+    Admission control around a model client.
+
+    At most `max_concurrency` calls run at once in this process; the others
+    wait in a queue of at most `max_queue`, served by priority, then in
+    arrival order, for up to `queue_timeout` seconds. With a `rate_limit`
+    (calls per second, bursting to `rate_burst`) each call also takes a token
+    from a bucket in Redis shared by every worker; background calls only get
+    tokens nobody else is waiting for. With `background_concurrency`, at most
+    that many background calls run at once across every worker, through a
+    semaphore in Redis: the queue of each process only orders its own
+    callers, and background work (Celery tasks) mostly runs in processes
+    with no interactive traffic to yield to. Calls that cannot be served in
+    time raise `Overloaded` right away instead of piling up.
+
+    Works for threads (`slot`) and coroutines (`aslot`) alike.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queue: int = 64,
+        queue_timeout: float = 30.0,
+        rate_limit: float = 0.0,
+        rate_burst: int = 1,
+        redis_client: Optional[Redis] = None,
+        async_redis_client: Optional[AsyncRedis] = None,
+        namespace: str = "scheduler",
+        background_concurrency: int = 0,
+        background_lease: float = 300.0,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.bucket_key = f"{namespace}:{name}:bucket"
+        self._token_bucket = redis_client.register_script(TOKEN_BUCKET_SCRIPT) if redis_client is not None else None
+        self._atoken_bucket = (async_redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+                               if async_redis_client is not None else None)
+        self.background_concurrency = background_concurrency
+        self.background_lease = background_lease
+        self.lease_key = f"{namespace}:{name}:background"
+        self.redis_client = redis_client
+        self.async_redis_client = async_redis_client
+        self._acquire_lease = (redis_client.register_script(ACQUIRE_LEASE_SCRIPT)
+                               if redis_client is not None else None)
+        self._aacquire_lease = (async_redis_client.register_script(ACQUIRE_LEASE_SCRIPT)
+                                if async_redis_client is not None else None)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queue = []
+        self._queued = 0
+        self._order = itertools.count()
+        # Moving average of how long a call holds its slot, for Retry-After
+        self._duration = 1.0
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._duration * (self._queued + 1) / self.max_concurrency))
+
+    def _enqueue(self, wake) -> Optional[_Waiter]:
+        """
+        Take a free slot (None) or join the queue (the waiter to wait on).
+        """
+        with self._lock:
+            if self._active < self.max_concurrency and not self._queued:
+                self._active += 1
+                return None
+            if self._queued >= self.max_queue:
+                raise Overloaded(f"Too many {self.name} calls waiting", retry_after=self._retry_after())
+            waiter = _Waiter(wake)
+            heapq.heappush(self._queue, (_priority.get(), next(self._order), waiter))
+            self._queued += 1
+            return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """
+        Leave the queue; False when the slot was handed over meanwhile, and
+        the caller now holds it.
+        """
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.abandoned = True
+            self._queued -= 1
+            return True
+
+    def _release(self, duration: float):
+        with self._lock:
+            self._duration = 0.9 * self._duration + 0.1 * duration
+            # Hand the slot straight to the next waiter
+            while self._queue:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.abandoned:
+                    continue
+                waiter.granted = True
+                self._queued -= 1
+                waiter.wake()
+                return
+            self._active -= 1
+
+    def _timed_out(self) -> Overloaded:
+        return Overloaded(f"Timed out waiting for a {self.name} slot", retry_after=self._retry_after())
+
+    def _rate_limited(self, wait: float) -> Overloaded:
+        return Overloaded(f"{self.name} rate limit reached", retry_after=max(1, math.ceil(wait)), status_code=429)
+
+    def _lease_token(self) -> Optional[str]:
+        """
+        Token for a background lease when this call needs one, else None.
+        """
+        if self.background_concurrency <= 0 or _priority.get() < Priority.BACKGROUND:
+            return None
+        return uuid.uuid4().hex
+
+    def _background_busy(self) -> Overloaded:
+        return Overloaded(f"Too many background {self.name} calls running",
+                          retry_after=max(1, math.ceil(self._duration)))
+
+    def _take_lease(self) -> Optional[str]:
+        token = self._lease_token()
+        if token is None or self._acquire_lease is None:
+            return None
+        if not self._acquire_lease(keys=[self.lease_key],
+                                   args=[token, self.background_concurrency, self.background_lease]):
+            raise self._background_busy()
+        return token
+
+    async def _atake_lease(self) -> Optional[str]:
+        token = self._lease_token()
+        if token is None or self._aacquire_lease is None:
+            return None
+        if not await self._aacquire_lease(keys=[self.lease_key],
+                                          args=[token, self.background_concurrency, self.background_lease]):
+            raise self._background_busy()
+        return token
+
+    def _bucket_args(self) -> tuple:
+        # Background calls never book tokens ahead, so the others always
+        # get the next ones, in every worker
+        background = _priority.get() >= Priority.BACKGROUND
+        return background, [self.rate_limit, self.rate_burst, 0 if background else self.queue_timeout]
+
+    def _take_token(self):
+        if self._token_bucket is None or self.rate_limit <= 0:
+            return
+        background, args = self._bucket_args()
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            taken, wait = self._token_bucket(keys=[self.bucket_key], args=args)
+            wait = float(wait)
+            if not taken and (not background or time.monotonic() + wait > deadline):
+                raise self._rate_limited(wait)
+            if wait > 0:
+                time.sleep(wait)
+            if taken:
+                return
+
+    async def _atake_token(self):
+        if self._atoken_bucket is None or self.rate_limit <= 0:
+            return
+        background, args = self._bucket_args()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        while True:
+            taken, wait = await self._atoken_bucket(keys=[self.bucket_key], args=args)
+            wait = float(wait)
+            if not taken and (not background or loop.time() + wait > deadline):
+                raise self._rate_limited(wait)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if taken:
+                return
+
+    @contextmanager
+    def slot(self, reentrant: bool = True):
+        """
+        Hold one slot for the duration of the block. With `reentrant`, calls
+        made inside the block run in the same slot.
+        """
+        if self.name in _held.get():
+            yield
+            return
+        lease = self._take_lease()
+        try:
+            event = threading.Event()
+            waiter = self._enqueue(event.set)
+            if waiter is not None and not event.wait(self.queue_timeout) and self._abandon(waiter):
+                raise self._timed_out()
+            start = time.monotonic()
+            token = _held.set(_held.get() | {self.name}) if reentrant else None
+            try:
+                self._take_token()
+                yield
+            finally:
+                if token is not None:
+                    _held.reset(token)
+                self._release(time.monotonic() - start)
+        finally:
+            if lease is not None:
+                self.redis_client.zrem(self.lease_key, lease)
+
+    @asynccontextmanager
+    async def aslot(self, reentrant: bool = True):
+        """
+        Async variant of `slot`.
+        """
+        if self.name in _held.get():
+            yield
+            return
+        lease = await self._atake_lease()
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            waiter = self._enqueue(lambda: loop.call_soon_threadsafe(_set_result, future))
+            if waiter is not None:
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+                except asyncio.TimeoutError:
+                    if self._abandon(waiter):
+                        raise self._timed_out()
+                except asyncio.CancelledError:
+                    if not self._abandon(waiter):
+                        self._release(0.0)
+                    raise
+            start = time.monotonic()
+            token = _held.set(_held.get() | {self.name}) if reentrant else None
+            try:
+                await self._atake_token()
+                yield
+            finally:
+                if token is not None:
+                    _held.reset(token)
+                self._release(time.monotonic() - start)
+        finally:
+            if lease is not None:
+                await self.async_redis_client.zrem(self.lease_key, lease)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency,
+                "active": self._active,
+                "queued": self._queued,
+                "max_queue": self.max_queue,
+                "rate_limit": self.rate_limit,
+                "background_concurrency": self.background_concurrency,
+                "average_duration": round(self._duration, 3),
+            }
+
+
+def _build(name: str, max_concurrency: int, rate_limit: float, rate_burst: int,
+           background_concurrency: int) -> Scheduler:
+    shared = rate_limit > 0 or background_concurrency > 0
+    return Scheduler(
+        name,
+        max_concurrency=max_concurrency,
+        max_queue=config.SCHEDULER_MAX_QUEUE,
+        queue_timeout=config.SCHEDULER_QUEUE_TIMEOUT,
+        rate_limit=rate_limit,
+        rate_burst=rate_burst,
+        redis_client=get_redis() if shared else None,
+        async_redis_client=get_async_redis() if shared else None,
+        background_concurrency=background_concurrency,
+    )
+
+
+@lru_cache(maxsize=None)
+def get_llm_scheduler() -> Scheduler:
+    return _build("llm", config.LLM_MAX_CONCURRENCY, config.LLM_RATE_LIMIT, config.LLM_RATE_BURST,
+                  config.LLM_BACKGROUND_MAX_CONCURRENCY)
+
+
+@lru_cache(maxsize=None)
+def get_embedding_scheduler() -> Scheduler:
+    return _build("embedding", config.EMBEDDING_MAX_CONCURRENCY, config.EMBEDDING_RATE_LIMIT,
+                  config.EMBEDDING_RATE_BURST, config.EMBEDDING_BACKGROUND_MAX_CONCURRENCY)
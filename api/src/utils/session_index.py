@@ -0,0 +1,52 @@
+from datetime import datetime, timezone
+
+# Per-user sorted set of session ids scored by their last update time
+USER_SESSIONS_PREFIX = "user_sessions:"
+# Sorted set of every session in Redis ("{user_id}:{session_id}") scored by
+# its last activity; drives the idle-session sweep
+SESSION_ACTIVITY_KEY = "session_activity"
+# Sorted set of the sessions the sweep could not read, scored by when they
+# were taken out of the activity set; left in Redis for inspection
+SESSION_QUARANTINE_KEY = "session_quarantine"
+
+
+def user_sessions_key(user_id: str) -> str:
+    return f"{USER_SESSIONS_PREFIX}{user_id}"
+
+
+def to_timestamp(value: datetime) -> float:
+    """
+    Epoch seconds of a naive UTC (or aware) datetime, used as index score.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def touch_session(pipe, user_id: str, session_id: str, updated_at: datetime):
+    """
+    Queue the index update for a session on a Redis client or pipeline.
+    """
+    pipe.zadd(user_sessions_key(user_id), {session_id: to_timestamp(updated_at)})
+
+
+def mark_active(pipe, user_id: str, session_id: str, when: datetime, only_new: bool = False):
+    """
+    Queue an activity update for a session; with `only_new`, sessions that
+    already have one keep it.
+    """
+    pipe.zadd(SESSION_ACTIVITY_KEY, {f"{user_id}:{session_id}": to_timestamp(when)}, nx=only_new)
+
+
+def remove_session(pipe, user_id: str, session_id: str):
+    pipe.zrem(user_sessions_key(user_id), session_id)
+    pipe.zrem(SESSION_ACTIVITY_KEY, f"{user_id}:{session_id}")
+
+
+def quarantine_session(pipe, user_id: str, session_id: str, when: float):
+    """
+    Queue moving an unreadable session out of the sweep.
+    """
+    member = f"{user_id}:{session_id}"
+    pipe.zrem(SESSION_ACTIVITY_KEY, member)
+    pipe.zadd(SESSION_QUARANTINE_KEY, {member: when})
@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, Tuple
+
+from redis.asyncio import Redis as AsyncRedis
+
+logger = logging.getLogger(__name__)
+
+# Deletes the lock only if it still holds the caller's token, so a worker
+# whose lock expired never releases the one another worker took since.
+# KEYS: lock key
+# ARGV: token
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces identical computations running at the same time.
+
+    Within a worker, callers with the same key share one task. Across
+    workers, the first to take the key's Redis lock computes the result and
+    publishes it for `result_ttl` seconds; the others poll for it instead of
+    computing their own. A caller computes it anyway when the lock is
+    released without a result (the computing worker failed) and nobody else
+    takes over, or after waiting `timeout` seconds.
+
+    Layout under `{namespace}`:
+        lock:{hash}    string  token of the worker computing the result
+        result:{hash}  string  the result
+    """
+
+    def __init__(
+        self,
+        redis_client: AsyncRedis,
+        timeout: int = 60,
+        result_ttl: int = 10,
+        poll_interval: float = 0.1,
+        namespace: str = "single_flight",
+    ):
+        self.redis_client = redis_client
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.namespace = namespace
+        self._release_lock = redis_client.register_script(RELEASE_LOCK_SCRIPT)
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    def _lock_key(self, digest: str) -> str:
+        return f"{self.namespace}:lock:{digest}"
+
+    def _result_key(self, digest: str) -> str:
+        return f"{self.namespace}:result:{digest}"
+
+    async def run(self, key: str, compute: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        """
+        Result of `compute()` for `key`, and whether it was computed for
+        another caller.
+        """
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        task = self._inflight.get(digest)
+        joined = task is not None
+        if task is None:
+            task = asyncio.ensure_future(self._run_shared(digest, compute))
+            self._inflight[digest] = task
+            task.add_done_callback(lambda done: self._forget(digest, done))
+        # A caller that goes away does not cancel the computation the
+        # others are waiting for
+        result, shared = await asyncio.shield(task)
+        return result, joined or shared
+
+    def _forget(self, digest: str, task: asyncio.Task):
+        if self._inflight.get(digest) is task:
+            del self._inflight[digest]
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Shared computation {digest} failed: {task.exception()}")
+
+    async def _unlock(self, lock_key: str, token: str):
+        # The lock expires on its own, so a failed release must not lose
+        # the result just computed
+        try:
+            await self._release_lock(keys=[lock_key], args=[token])
+        except Exception as e:
+            logger.warning(f"Could not release {lock_key}: {e}")
+
+    async def _publish(self, result_key: str, result: str):
+        # Other workers then compute it themselves, the result is still ours
+        try:
+            await self.redis_client.set(result_key, result, ex=self.result_ttl)
+        except Exception as e:
+            logger.warning(f"Could not publish {result_key}: {e}")
+
+    async def _run_shared(self, digest: str, compute: Callable[[], Awaitable[str]]) -> Tuple[str, bool]:
+        lock_key, result_key = self._lock_key(digest), self._result_key(digest)
+        token = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while loop.time() < deadline:
+            if await self.redis_client.set(lock_key, token, nx=True, ex=self.timeout):
+                try:
+                    # The previous holder may have just published it
+                    result = await self.redis_client.get(result_key)
+                    if result is not None:
+                        return result.decode("utf-8"), True
+                    result = await compute()
+                    await self._publish(result_key, result)
+                    return result, False
+                finally:
+                    await self._unlock(lock_key, token)
+
+            # Another worker is computing it
+            while loop.time() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.get(result_key)
+                pipe.exists(lock_key)
+                result, locked = await pipe.execute()
+                if result is not None:
+                    return result.decode("utf-8"), True
+                if not locked:
+                    break
+
+        logger.warning(f"Gave up waiting for shared computation {digest}")
+        return await compute(), False
@@ -1,17 +1,58 @@
-from langchain_community.chat_message_histories import RedisChatMessageHistory
+from typing import Optional
+from src.core.db import get_redis, get_async_redis
+from src.core.config import config
+from src.core.celery_config import celery_app
+from src.utils.history import RedisMessageHistory, SummaryBufferMessageHistory
+from src.utils.session_index import SESSION_ACTIVITY_KEY
 
-REDIS_URL = "redis://redis:6379"
 
-def get_message_history(user_id: str, conversation_id: str) -> RedisChatMessageHistory:
-    return RedisChatMessageHistory(
+def schedule_summary(session_id: str):
+    celery_app.send_task(
+        'src.services.chat.background_tasks.summarize_chat_history', args=[session_id])
+
+
+def get_summary_history(session_id: str) -> SummaryBufferMessageHistory:
+    return SummaryBufferMessageHistory(
+        session_id=session_id,
+        redis_client=get_redis(),
+        async_redis_client=get_async_redis(),
+        key_prefix="message_store:",
+        token_limit=config.HISTORY_TOKEN_LIMIT,
+        schedule_summary=schedule_summary,
+        # The chat session hash shares the conversation's key
+        metadata_key=session_id,
+        activity_key=SESSION_ACTIVITY_KEY,
+        codec=config.MESSAGE_CODEC,
+        idle_ttl=config.SESSION_IDLE_TTL)
+
+
+def get_message_history(user_id: str, conversation_id: str) -> RedisMessageHistory:
+    if config.HISTORY_MODE == "summary":
+        return get_summary_history(f"{user_id}:{conversation_id}")
+    return RedisMessageHistory(
         session_id=f"{user_id}:{conversation_id}", 
+        redis_client=get_redis(),
+        async_redis_client=get_async_redis(),
         key_prefix="message_store:",
-        url=REDIS_URL)
+        metadata_key=f"{user_id}:{conversation_id}",
+        activity_key=SESSION_ACTIVITY_KEY,
+        codec=config.MESSAGE_CODEC,
+        idle_ttl=config.SESSION_IDLE_TTL)
 
 
-def get_all_conversations(user_id: str, conversation_id: str) -> list:
-    chat_history = get_message_history(user_id , conversation_id)
+def get_all_conversations(user_id: str, conversation_id: str, limit: Optional[int] = None,
+                          before: Optional[int] = None, after: Optional[int] = None) -> list:
+    # Always the full history, whatever the chain is given, unless a page
+    # is asked for
+    chat_history = RedisMessageHistory(
+        session_id=f"{user_id}:{conversation_id}",
+        redis_client=get_redis(),
+        key_prefix="message_store:")
+    if limit is None:
+        messages = chat_history.messages
+    else:
+        messages = chat_history.get_page(limit, before=before, after=after)
     conversation_output = []
-    for message in chat_history.messages:
+    for message in messages:
         conversation_output.append(f"{message.type}: {message.content}")
     return conversation_output
\ No newline at end of file
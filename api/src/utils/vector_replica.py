@@ -0,0 +1,457 @@
+import fcntl
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from redis import Redis
+from redis.exceptions import ResponseError
+
+logger = logging.getLogger(__name__)
+
+# Object ids are UUID strings
+ID_WIDTH = 36
+# Rows scored per matrix product, bounds the memory of a search
+BLOCK_ROWS = 65536
+# An approximate index is trained once there are this many rows per list
+MIN_ROWS_PER_LIST = 40
+
+
+def normalize(vectors) -> np.ndarray:
+    """
+    Rows scaled to unit length as float32, so a dot product is the cosine
+    similarity.
+    """
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _stream_id(entry_id: str) -> Tuple[int, int]:
+    milliseconds, sequence = entry_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+class ChangeLog:
+    """
+    Redis stream of the changes made to the vector index, replayed by the
+    replicas: ids added, ids deleted, index cleared. Only ids are logged,
+    replicas read the vectors back from the index. The stream keeps about
+    `maxlen` entries; a replica that fell further behind rebuilds.
+
+    A replica's position is the id of the last entry it applied and the
+    number of entries added to the stream up to it (Redis 7 counts them).
+    """
+
+    def __init__(self, redis_client: Redis, key: str, maxlen: int = 10000):
+        self.redis_client = redis_client
+        self.key = key
+        self.maxlen = maxlen
+
+    def append(self, op: str, ids: Sequence[str] = ()):
+        self.redis_client.xadd(self.key, {"op": op, "ids": json.dumps(list(ids))},
+                               maxlen=self.maxlen, approximate=True)
+
+    def _info(self) -> Optional[dict]:
+        try:
+            return self.redis_client.xinfo_stream(self.key)
+        except ResponseError:
+            # Nothing logged yet
+            return None
+
+    def position(self) -> Tuple[str, int]:
+        """
+        The position after the last entry logged so far.
+        """
+        info = self._info()
+        if info is None:
+            return "0-0", 0
+        return info["last-generated-id"].decode("utf-8"), info["entries-added"]
+
+    def missed(self, after: Optional[str], added: int) -> bool:
+        """
+        Whether entries following position (`after`, `added`) were trimmed
+        before being read.
+        """
+        if after is None:
+            return True
+        info = self._info()
+        if info is None:
+            return added > 0
+        first = info.get("first-entry")
+        if first and _stream_id(first[0].decode("utf-8")) <= _stream_id(after):
+            return False
+        return info["entries-added"] - added > info["length"]
+
+    def read(self, after: str, count: int = 100) -> List[Tuple[str, str, List[str]]]:
+        """
+        Up to `count` entries following `after`: (entry id, op, ids).
+        """
+        entries = self.redis_client.xrange(self.key, min=f"({after}", count=count)
+        return [(entry_id.decode("utf-8"), fields[b"op"].decode("utf-8"), json.loads(fields[b"ids"]))
+                for entry_id, fields in entries]
+
+
+class _Maps:
+    """
+    The memory-mapped arrays of one generation of the replica.
+    """
+
+    def __init__(self, directory: str, state: dict, mode: str):
+        generation, capacity, dim = state["generation"], state["capacity"], state["dim"]
+        path = lambda name: os.path.join(directory, f"{name}.{generation}")
+        self.vectors = np.memmap(path("vectors"), dtype=np.float32, mode=mode, shape=(capacity, dim))
+        self.ids = np.memmap(path("ids"), dtype=f"S{ID_WIDTH}", mode=mode, shape=(capacity,))
+        self.alive = np.memmap(path("alive"), dtype=np.uint8, mode=mode, shape=(capacity,))
+        self.lists = self.centroids = None
+        if state.get("nlist"):
+            self.lists = np.memmap(path("lists"), dtype=np.int32, mode=mode, shape=(capacity,))
+            self.centroids = np.load(path("centroids") + ".npy")
+
+    def flush(self):
+        for array in (self.vectors, self.ids, self.alive, self.lists):
+            if array is not None:
+                array.flush()
+
+
+def _create_files(directory: str, state: dict):
+    generation, capacity, dim = state["generation"], state["capacity"], state["dim"]
+    for name, size in (("vectors", capacity * dim * 4), ("ids", capacity * ID_WIDTH), ("alive", capacity),
+                       ("lists", capacity * 4)):
+        with open(os.path.join(directory, f"{name}.{generation}"), "wb") as f:
+            f.truncate(size)
+
+
+def _remove_files(directory: str, generation: int):
+    for name in ("vectors", "ids", "alive", "lists", "centroids"):
+        for path in (os.path.join(directory, f"{name}.{generation}"),
+                     os.path.join(directory, f"{name}.{generation}.npy")):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class VectorReplica:
+    """
+    Read replica of the vector index in memory-mapped files: every worker of
+    a host maps the same files, so the vectors sit in the page cache once.
+    Searches are exact, by blocks of rows, or approximate (IVF: rows are
+    grouped around `nlist` centroids and only the lists of the `nprobe`
+    centroids nearest the query are scored) once an approximate index has
+    been trained.
+
+    A single process writes at a time (see `writer`); readers pick up its
+    changes on their next search.
+
+    Layout under `directory`:
+        state.json           generation, dim, rows, capacity, deleted,
+                             nlist, trained_rows, log_id and log_added
+                             (change log position)
+        vectors.{gen}        capacity x dim float32, unit-length rows
+        ids.{gen}            capacity x 36 bytes, object id of each row
+        alive.{gen}          capacity bytes, 0 once the row is deleted
+        lists.{gen}          capacity int32, IVF list of each row
+        centroids.{gen}.npy  nlist x dim float32
+        lock                 held by the writer
+    """
+
+    def __init__(self, directory: str, nprobe: int = 8):
+        self.directory = directory
+        self.nprobe = nprobe
+        # State and arrays together, searches running in other threads
+        # never mix two generations
+        self._view: Tuple[dict, Optional[_Maps]] = ({}, None)
+        self._stamp = None
+
+    @property
+    def state(self) -> dict:
+        return self._view[0]
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "state.json")
+
+    def _read_state(self) -> Tuple[Optional[tuple], dict]:
+        try:
+            with open(self.state_path) as f:
+                stat = os.fstat(f.fileno())
+                return (stat.st_ino, stat.st_mtime_ns), json.load(f)
+        except FileNotFoundError:
+            return None, {}
+
+    def refresh(self):
+        """
+        Map the latest state written by the writer, if it changed.
+        """
+        try:
+            stat = os.stat(self.state_path)
+        except FileNotFoundError:
+            self._view, self._stamp = ({}, None), None
+            return
+        if (stat.st_ino, stat.st_mtime_ns) == self._stamp:
+            return
+        for _ in range(3):
+            stamp, state = self._read_state()
+            try:
+                maps = _Maps(self.directory, state, "r") if state.get("capacity") else None
+            except FileNotFoundError:
+                # Replaced by a newer generation meanwhile
+                continue
+            self._view, self._stamp = (state, maps), stamp
+            return
+
+    def __len__(self) -> int:
+        return self.state.get("rows", 0) - self.state.get("deleted", 0)
+
+    def search(self, queries, k: int = 4) -> List[List[Tuple[str, float]]]:
+        """
+        The `k` ids most similar (cosine) to each query vector, best first,
+        with their similarity.
+        """
+        self.refresh()
+        queries = normalize(queries)
+        state, maps = self._view
+        rows = state.get("rows", 0)
+        if maps is None or not rows:
+            return [[] for _ in queries]
+        if maps.centroids is not None and self.nprobe < len(maps.centroids):
+            found = [self._search_ivf(maps, rows, query, k) for query in queries]
+        else:
+            found = self._search_exact(maps, rows, queries, k)
+        return [[(maps.ids[row].decode("utf-8"), float(score)) for row, score in hits] for hits in found]
+
+    @staticmethod
+    def _top(scores: np.ndarray, rows: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        keep = np.isfinite(scores)
+        scores, rows = scores[keep], rows[keep]
+        if len(scores) > k:
+            part = np.argpartition(-scores, k - 1)[:k]
+            scores, rows = scores[part], rows[part]
+        order = np.argsort(-scores)
+        return list(zip(rows[order].tolist(), scores[order].tolist()))
+
+    def _search_exact(self, maps: _Maps, rows: int, queries: np.ndarray, k: int) -> List[List[Tuple[int, float]]]:
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, rows, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, rows)
+            scores = queries @ maps.vectors[start:end].T
+            scores[:, maps.alive[start:end] == 0] = -np.inf
+            block_rows = np.broadcast_to(np.arange(start, end), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            block_rows = np.concatenate([best_rows, block_rows], axis=1)
+            if scores.shape[1] > k:
+                part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, part, axis=1)
+                block_rows = np.take_along_axis(block_rows, part, axis=1)
+            best_scores, best_rows = scores, block_rows
+        return [self._top(scores, found, k) for scores, found in zip(best_scores, best_rows)]
+
+    def _search_ivf(self, maps: _Maps, rows: int, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        probed = np.zeros(len(maps.centroids), dtype=bool)
+        probed[np.argpartition(-(maps.centroids @ query), self.nprobe - 1)[:self.nprobe]] = True
+        candidates = np.flatnonzero(probed[maps.lists[:rows]] & (maps.alive[:rows] != 0))
+        if not len(candidates):
+            return []
+        return self._top(maps.vectors[candidates] @ query, candidates, k)
+
+    @contextmanager
+    def writer(self):
+        """
+        A `ReplicaWriter`, or None when another process is writing.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, "lock"), "a+") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+            try:
+                yield ReplicaWriter(self)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class ReplicaWriter:
+    """
+    Applies changes to a `VectorReplica`; they become visible to readers on
+    `commit`, deletions right away. Rows are appended in place while they
+    fit, otherwise (or once half the rows are deleted) the live rows are
+    copied to a new, larger generation of files.
+    """
+
+    def __init__(self, replica: VectorReplica):
+        self.replica = replica
+        self.directory = replica.directory
+        _, state = replica._read_state()
+        self.state = state or self._empty_state(0)
+        self._maps = _Maps(self.directory, self.state, "r+") if self.state["capacity"] else None
+        self._row_of: Optional[Dict[str, int]] = None
+        self._retired: List[int] = []
+        self.dirty = False
+
+    @staticmethod
+    def _empty_state(generation: int) -> dict:
+        return {"generation": generation, "dim": 0, "rows": 0, "capacity": 0, "deleted": 0,
+                "nlist": 0, "trained_rows": 0, "log_id": None, "log_added": 0}
+
+    @property
+    def log_position(self) -> Tuple[Optional[str], int]:
+        return self.state["log_id"], self.state.get("log_added", 0)
+
+    @property
+    def row_of(self) -> Dict[str, int]:
+        if self._row_of is None:
+            rows = self.state["rows"]
+            self._row_of = {} if self._maps is None else {
+                object_id.decode("utf-8"): row
+                for row, (object_id, alive) in enumerate(zip(self._maps.ids[:rows], self._maps.alive[:rows]))
+                if alive}
+        return self._row_of
+
+    def _retire(self):
+        self._retired.append(self.state["generation"])
+
+    def reset(self):
+        """
+        Drop every row.
+        """
+        log_id, log_added = self.log_position
+        self._retire()
+        self.state = self._empty_state(self.state["generation"] + 1)
+        self.state.update(log_id=log_id, log_added=log_added)
+        self._maps, self._row_of = None, {}
+        self.dirty = True
+
+    def _reallocate(self, capacity: int, centroids: Optional[np.ndarray] = None):
+        """
+        Move the live rows to a new generation of `capacity` rows, assigned
+        to new `centroids` if given.
+        """
+        old, old_state = self._maps, self.state
+        self._retire()
+        state = dict(old_state, generation=old_state["generation"] + 1, capacity=capacity, rows=0, deleted=0)
+        if centroids is None and old is not None:
+            centroids = old.centroids
+        else:
+            state["nlist"] = len(centroids) if centroids is not None else 0
+        _create_files(self.directory, state)
+        if state["nlist"]:
+            np.save(os.path.join(self.directory, f"centroids.{state['generation']}.npy"), centroids)
+        self.state, self._maps, self._row_of = state, _Maps(self.directory, state, "r+"), {}
+        if old is None:
+            return
+        reassign = old.lists is None or centroids is not old.centroids
+        for start in range(0, old_state["rows"], BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, old_state["rows"])
+            live = np.flatnonzero(old.alive[start:end]) + start
+            self._append_rows(old.ids[live], old.vectors[live], None if reassign else old.lists[live])
+
+    def _append_rows(self, ids: np.ndarray, vectors: np.ndarray, lists: Optional[np.ndarray]):
+        start = self.state["rows"]
+        end = start + len(ids)
+        self._maps.vectors[start:end] = vectors
+        self._maps.ids[start:end] = ids
+        self._maps.alive[start:end] = 1
+        if self._maps.lists is not None:
+            self._maps.lists[start:end] = lists if lists is not None else self._assign(vectors)
+        for row, object_id in enumerate(ids, start):
+            self.row_of[object_id.decode("utf-8")] = row
+        self.state["rows"] = end
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self._maps.centroids.T, axis=1).astype(np.int32)
+
+    def add(self, ids: Sequence[str], vectors):
+        """
+        Add or replace the vectors of `ids`.
+        """
+        if not len(ids):
+            return
+        vectors = normalize(vectors)
+        if not self.state["dim"]:
+            self.state["dim"] = vectors.shape[1]
+        elif vectors.shape[1] != self.state["dim"]:
+            raise ValueError(f"Expected vectors of {self.state['dim']} dimensions, got {vectors.shape[1]}")
+        if any(len(object_id) > ID_WIDTH for object_id in ids):
+            raise ValueError(f"Object ids longer than {ID_WIDTH} characters")
+        self.delete(ids)
+        needed = self.state["rows"] + len(ids)
+        if needed > self.state["capacity"]:
+            self._reallocate(max(needed, 2 * self.state["capacity"], 1024))
+        self._append_rows(np.array([object_id.encode("utf-8") for object_id in ids], dtype=f"S{ID_WIDTH}"),
+                          vectors, None)
+        self.dirty = True
+
+    def delete(self, ids: Sequence[str]):
+        for object_id in ids:
+            row = self.row_of.pop(object_id, None)
+            if row is not None:
+                self._maps.alive[row] = 0
+                self.state["deleted"] += 1
+                self.dirty = True
+
+    def train(self, nlist: int, iterations: int = 10, sample_size: int = 50000, seed: int = 0):
+        """
+        Train the approximate index: `nlist` centroids by spherical k-means
+        on a sample of the live rows, then assign every row to one.
+        """
+        rng = np.random.default_rng(seed)
+        live = np.flatnonzero(self._maps.alive[:self.state["rows"]])
+        sample = normalize(self._maps.vectors[np.sort(rng.choice(live, min(sample_size, len(live)), replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+
+        # In a new generation, so readers never see centroids and lists
+        # that do not match
+        self._reallocate(self.state["capacity"], centroids)
+        self.state["trained_rows"] = len(self)
+        self.dirty = True
+
+    def maybe_train(self, nlist: int):
+        """
+        Train the approximate index when there are enough rows, and again
+        each time their number doubled.
+        """
+        if nlist and len(self) >= nlist * MIN_ROWS_PER_LIST and len(self) >= 2 * self.state["trained_rows"]:
+            self.train(nlist)
+
+    def __len__(self) -> int:
+        return self.state["rows"] - self.state["deleted"]
+
+    def commit(self, log_id: Optional[str], log_added: int = 0):
+        """
+        Publish the changes, up to change log position (`log_id`,
+        `log_added`).
+        """
+        if not self.dirty and (log_id, log_added) == self.log_position:
+            return
+        if self.state["deleted"] and self.state["deleted"] * 2 >= self.state["rows"]:
+            self._reallocate(self.state["capacity"])
+        if self._maps is not None:
+            self._maps.flush()
+        self.state.update(log_id=log_id, log_added=log_added)
+        path = self.replica.state_path
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        # Readers still mapping them keep the data until they remap
+        for generation in self._retired:
+            if generation != self.state["generation"]:
+                _remove_files(self.directory, generation)
+        self._retired = []
+        self.dirty = False
+        self.replica.refresh()
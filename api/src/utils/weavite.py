@@ -1,18 +1,281 @@
 import os
+import uuid
+import asyncio
+import logging
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Iterable, List, Optional
+import weaviate
+from weaviate.classes.query import Filter
+from langchain_core.documents import Document
 from src.core.config import config
 from langchain_weaviate.vectorstores import WeaviateVectorStore
 from langchain_community.embeddings import HuggingFaceHubEmbeddings
-from src.core.db import weaviate_client
+from src.core.db import get_weaviate, get_redis
+from src.utils.embedding_cache import CachedEmbeddings, ScheduledEmbeddings
+from src.utils.scheduler import get_embedding_scheduler
+from src.utils.bm25 import BM25Index
+from src.utils.vector_replica import ChangeLog, VectorReplica
 
 os.environ["HUGGINGFACEHUB_API_TOKEN"] = config.HUGGINGFACEHUB_API_TOKEN
 
+logger = logging.getLogger(__name__)
 
-embeddings = HuggingFaceHubEmbeddings()
+INDEX_NAME = "paper"
+TEXT_KEY = "content"
 
 
-db = WeaviateVectorStore(
-    index_name="paper",
-    text_key="content",
-    embedding=embeddings,
-    client=weaviate_client
-    )
+@lru_cache(maxsize=None)
+def get_embeddings():
+    """
+    Embedding model of this process, built on first use. Cache hits never
+    wait for the scheduler.
+    """
+    embeddings = ScheduledEmbeddings(HuggingFaceHubEmbeddings(), get_embedding_scheduler())
+    if config.EMBEDDING_CACHE_ENABLED:
+        embeddings = CachedEmbeddings(
+            embeddings,
+            redis_client=get_redis(),
+            cache_dir=config.EMBEDDING_CACHE_DIR,
+            ttl=config.EMBEDDING_CACHE_TTL,
+            max_disk_entries=config.EMBEDDING_CACHE_MAX_DISK_ENTRIES,
+        )
+    return embeddings
+
+
+_async_weaviate_client = None
+_async_weaviate_lock = asyncio.Lock()
+
+
+async def get_async_weaviate_client():
+    """
+    Async Weaviate client of this process, connected on first use.
+    """
+    global _async_weaviate_client
+    if _async_weaviate_client is None:
+        async with _async_weaviate_lock:
+            if _async_weaviate_client is None:
+                client = weaviate.use_async_with_local(host="weaviate", port=8080, grpc_port=50051)
+                await client.connect()
+                _async_weaviate_client = client
+    return _async_weaviate_client
+
+
+async def close_async_weaviate_client():
+    global _async_weaviate_client
+    if _async_weaviate_client is not None:
+        await _async_weaviate_client.close()
+        _async_weaviate_client = None
+
+
+class AsyncWeaviateVectorStore(WeaviateVectorStore):
+    """
+    WeaviateVectorStore whose async search runs on the async Weaviate client
+    and async embeddings instead of the sync search in a thread pool.
+    """
+
+    async def asimilarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        # Same keyword handling and metadata as the sync `_perform_search`
+        kwargs["return_metadata"] = list(dict.fromkeys([*kwargs.get("return_metadata", []), "score"]))
+        if "return_properties" in kwargs and self._text_key not in kwargs["return_properties"]:
+            kwargs["return_properties"] = [*kwargs["return_properties"], self._text_key]
+        tenant = kwargs.pop("tenant", None)
+        return_uuids = kwargs.pop("return_uuids", False)
+        vector = kwargs.pop("vector", None)
+        if vector is None:
+            vector = await self._embedding.aembed_query(query)
+        client = await get_async_weaviate_client()
+        collection = client.collections.get(self._index_name)
+        if tenant is not None:
+            collection = collection.with_tenant(tenant)
+        result = await collection.query.hybrid(query=query, vector=vector, limit=k, **kwargs)
+        documents = []
+        for obj in result.objects:
+            properties = dict(obj.properties)
+            text = properties.pop(self._text_key, "")
+            metadata = {key: value for key, value in obj.metadata.__dict__.items()
+                        if value is not None and key != "score"}
+            documents.append(Document(page_content=text, metadata={
+                **properties,
+                **metadata,
+                **({"vector": obj.vector["default"]} if obj.vector else {}),
+                **({"uuid": str(obj.uuid)} if return_uuids else {}),
+            }))
+        return documents
+
+
+@lru_cache(maxsize=None)
+def get_vector_store() -> AsyncWeaviateVectorStore:
+    """
+    Vector store over the document index, connected on first use.
+    """
+    return AsyncWeaviateVectorStore(
+        index_name=INDEX_NAME,
+        text_key=TEXT_KEY,
+        embedding=get_embeddings(),
+        client=get_weaviate()
+        )
+
+
+@lru_cache(maxsize=None)
+def get_bm25_index() -> BM25Index:
+    """
+    Lexical index over the same chunks, kept in sync by the helpers below.
+    """
+    return BM25Index(get_redis(), namespace=f"bm25:{INDEX_NAME}", postings_limit=config.BM25_POSTINGS_LIMIT)
+
+
+@lru_cache(maxsize=None)
+def get_index_changes() -> ChangeLog:
+    """
+    Changes to the index, replayed by the local vector replicas.
+    """
+    return ChangeLog(get_redis(), key=f"{INDEX_NAME}:changes", maxlen=config.VECTOR_REPLICA_LOG_MAXLEN)
+
+
+def log_index_change(op: str, ids: Iterable[str] = ()):
+    """
+    Record a change to the index ("add", "delete" or "clear") for the vector
+    replicas, when they are enabled.
+    """
+    if config.VECTOR_REPLICA_ENABLED:
+        get_index_changes().append(op, list(ids))
+
+# Bumped whenever documents are added to or removed from the index, so
+# anything derived from its contents (cached answers) can be invalidated
+INDEX_VERSION_KEY = f"{INDEX_NAME}:index_version"
+
+
+def get_index_version() -> int:
+    """
+    Current version of the document index.
+    """
+    version = get_redis().get(INDEX_VERSION_KEY)
+    return int(version) if version else 0
+
+
+def bump_index_version() -> int:
+    """
+    Mark the document index as changed.
+    """
+    return get_redis().incr(INDEX_VERSION_KEY)
+
+
+def add_embedded_documents(documents: List[Document], vectors: List[List[float]], ids: Optional[List[str]] = None) -> List[str]:
+    """
+    Write documents whose vectors were already computed, so the batch goes
+    straight to Weaviate without the embedding call `add_documents` makes.
+    Objects are stored the same way `WeaviateVectorStore.add_texts` stores them
+    and are added to the lexical index as well. Returns the ids of the objects
+    Weaviate accepted; rejected ones are logged and left out.
+    """
+    ids = ids or [str(uuid.uuid4()) for _ in documents]
+    weaviate_client = get_weaviate()
+    with weaviate_client.batch.dynamic() as batch:
+        for document, vector, object_id in zip(documents, vectors, ids):
+            properties = {TEXT_KEY: document.page_content, **document.metadata}
+            batch.add_object(
+                collection=INDEX_NAME,
+                properties=properties,
+                uuid=object_id,
+                vector=vector,
+            )
+    failed_ids = set()
+    for failed in weaviate_client.batch.failed_objects:
+        logger.error(f"Failed to add object {failed.original_uuid}: {failed.message}")
+        failed_ids.add(str(failed.original_uuid))
+    written = [(object_id, document) for object_id, document in zip(ids, documents) if object_id not in failed_ids]
+    ids = [object_id for object_id, _ in written]
+    if ids:
+        get_bm25_index().add(ids, [document for _, document in written])
+        log_index_change("add", ids)
+        bump_index_version()
+    return ids
+
+
+def delete_documents(ids: List[str]):
+    """
+    Remove objects from the index by id.
+    """
+    if ids:
+        get_vector_store().delete(ids=ids)
+        get_bm25_index().remove(ids)
+        log_index_change("delete", ids)
+        bump_index_version()
+
+
+def delete_documents_by_source(source: str):
+    """
+    Remove every object that was ingested from `source`.
+    """
+    try:
+        result = get_weaviate().collections.get(INDEX_NAME).data.delete_many(
+            where=Filter.by_property("source").equal(source), verbose=True)
+        ids = [str(obj.uuid) for obj in result.objects or []]
+        get_bm25_index().remove(ids)
+        log_index_change("delete", ids)
+        bump_index_version()
+    except Exception as e:
+        logger.warning(f"Could not delete objects for source {source}: {e}")
+
+
+@lru_cache(maxsize=None)
+def get_vector_replica() -> VectorReplica:
+    return VectorReplica(config.VECTOR_REPLICA_DIR, nprobe=config.VECTOR_REPLICA_NPROBE)
+
+
+def _object_vector(obj) -> List[float]:
+    # A dict of named vectors in recent clients
+    vector = obj.vector
+    return vector.get("default") if isinstance(vector, dict) else vector
+
+
+def sync_vector_replica(batch_size: int = 500) -> Optional[dict]:
+    """
+    Bring the local vector replica up to date: replay the changes logged
+    since its last sync, reading the added vectors back from Weaviate, or
+    rebuild it from the whole collection when it is new or the log no longer
+    holds every change it missed. None when another worker is syncing it.
+    """
+    replica = get_vector_replica()
+    with replica.writer() as writer:
+        if writer is None:
+            return None
+        collection = get_weaviate().collections.get(INDEX_NAME)
+        index_changes = get_index_changes()
+        last, added = writer.log_position
+        rebuilt = index_changes.missed(last, added)
+        if rebuilt:
+            # Changes logged while the collection is read are replayed below
+            last, added = index_changes.position()
+            writer.reset()
+            objects = collection.iterator(include_vector=True)
+            while True:
+                batch = list(islice(objects, batch_size))
+                if not batch:
+                    break
+                writer.add([str(obj.uuid) for obj in batch], [_object_vector(obj) for obj in batch])
+
+        applied = 0
+        while True:
+            entries = index_changes.read(after=last)
+            if not entries:
+                break
+            for entry_id, op, ids in entries:
+                if op == "clear":
+                    writer.reset()
+                elif op == "delete":
+                    writer.delete(ids)
+                elif op == "add" and ids:
+                    # Objects deleted since are simply not found
+                    result = collection.query.fetch_objects(
+                        filters=Filter.by_id().contains_any(ids), include_vector=True, limit=len(ids))
+                    if result.objects:
+                        writer.add([str(obj.uuid) for obj in result.objects],
+                                   [_object_vector(obj) for obj in result.objects])
+                last, added = entry_id, added + 1
+                applied += 1
+
+        writer.maybe_train(config.VECTOR_REPLICA_NLIST)
+        writer.commit(last, added)
+        return {"rows": len(writer), "applied": applied, "rebuilt": rebuilt}
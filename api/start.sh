@@ -21,5 +21,11 @@ else
     echo "There is no prestart script $PRE_START_PATH"
 fi
 
+# Workers write their metrics here for /metrics to sum; stale files of a
+# previous run would be counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_multiproc}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 # Start Gunicorn
 exec gunicorn -k "$WORKER_CLASS" -c "$GUNICORN_CONF" "$APP_MODULE" --reload
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+
+# Settings the config requires; the tests never reach the services
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("HUGGINGFACEHUB_API_TOKEN", "test")
+os.environ.setdefault("CHUNK_OVERLAP", "50")
+os.environ.setdefault("CHUNK_SIZE", "500")
+os.environ.setdefault("STARTUP_PERIOD", "0")
@@ -0,0 +1,228 @@
+import asyncio
+import threading
+import time
+
+import fakeredis
+import pytest
+from fakeredis import aioredis
+
+from src.utils.scheduler import Overloaded, Priority, Scheduler, request_priority
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not reached"
+        time.sleep(0.005)
+
+
+def hold_slot(scheduler, release, started=None, priority=Priority.NORMAL):
+    def run():
+        with request_priority(priority), scheduler.slot():
+            if started is not None:
+                started.append(priority)
+            release.wait(2)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_release_hands_the_slot_to_the_next_waiter():
+    scheduler = Scheduler("test", max_concurrency=1, queue_timeout=2)
+    release = threading.Event()
+    holder = hold_slot(scheduler, release)
+    wait_until(lambda: scheduler.stats()["active"] == 1)
+
+    started = []
+    waiter = hold_slot(scheduler, threading.Event(), started)
+    wait_until(lambda: scheduler.stats()["queued"] == 1)
+    release.set()
+    holder.join()
+    waiter.join()
+
+    assert started == [Priority.NORMAL]
+    assert scheduler.stats()["active"] == 0
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_waiters_are_served_by_priority():
+    scheduler = Scheduler("test", max_concurrency=1, queue_timeout=2)
+    release = threading.Event()
+    holder = hold_slot(scheduler, release)
+    wait_until(lambda: scheduler.stats()["active"] == 1)
+
+    started, go = [], threading.Event()
+    go.set()
+    background = hold_slot(scheduler, go, started, Priority.BACKGROUND)
+    wait_until(lambda: scheduler.stats()["queued"] == 1)
+    interactive = hold_slot(scheduler, go, started, Priority.INTERACTIVE)
+    wait_until(lambda: scheduler.stats()["queued"] == 2)
+    release.set()
+    for thread in (holder, background, interactive):
+        thread.join()
+
+    assert started == [Priority.INTERACTIVE, Priority.BACKGROUND]
+
+
+def test_full_queue_turns_calls_away():
+    scheduler = Scheduler("test", max_concurrency=1, max_queue=0, queue_timeout=2)
+    release = threading.Event()
+    holder = hold_slot(scheduler, release)
+    wait_until(lambda: scheduler.stats()["active"] == 1)
+    try:
+        with pytest.raises(Overloaded) as error:
+            with scheduler.slot():
+                pass
+        assert error.value.status_code == 503
+        assert error.value.retry_after >= 1
+    finally:
+        release.set()
+        holder.join()
+
+
+def test_timed_out_waiter_leaves_the_queue():
+    scheduler = Scheduler("test", max_concurrency=1, queue_timeout=0.05)
+    release = threading.Event()
+    holder = hold_slot(scheduler, release)
+    wait_until(lambda: scheduler.stats()["active"] == 1)
+    try:
+        with pytest.raises(Overloaded):
+            with scheduler.slot():
+                pass
+        assert scheduler.stats()["queued"] == 0
+    finally:
+        release.set()
+        holder.join()
+    assert scheduler.stats()["active"] == 0
+
+
+def test_abandoning_after_the_slot_was_granted_keeps_it():
+    scheduler = Scheduler("test", max_concurrency=1)
+    assert scheduler._enqueue(lambda: None) is None
+    woken = []
+    waiter = scheduler._enqueue(lambda: woken.append(True))
+
+    # The holder releases right as the waiter gives up
+    scheduler._release(0.1)
+    assert woken == [True]
+    assert scheduler._abandon(waiter) is False
+    assert scheduler.stats()["active"] == 1
+
+    scheduler._release(0.1)
+    assert scheduler.stats()["active"] == 0
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_abandoned_waiter_is_skipped_on_release():
+    scheduler = Scheduler("test", max_concurrency=1)
+    scheduler._enqueue(lambda: None)
+    woken = []
+    waiter = scheduler._enqueue(lambda: woken.append(True))
+    assert scheduler._abandon(waiter) is True
+
+    scheduler._release(0.1)
+    assert woken == []
+    assert scheduler.stats()["active"] == 0
+    assert scheduler.stats()["queued"] == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1, queue_timeout=2)
+        # Not reentrant: tasks started inside a slot inherit it
+        async with scheduler.aslot(reentrant=False):
+            waiting = asyncio.create_task(scheduler.aslot().__aenter__())
+            await asyncio.sleep(0.01)
+            assert scheduler.stats()["queued"] == 1
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            assert scheduler.stats()["queued"] == 0
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["active"] == 0
+
+
+def test_waiter_cancelled_after_the_grant_gives_the_slot_back():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1, queue_timeout=2)
+        holder = scheduler.aslot(reentrant=False)
+        await holder.__aenter__()
+        waiting = asyncio.create_task(scheduler.aslot().__aenter__())
+        await asyncio.sleep(0.01)
+        # Granted and cancelled before the waiter gets to run again
+        await holder.__aexit__(None, None, None)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["active"] == 0
+    assert stats["queued"] == 0
+
+
+def test_nested_calls_reuse_the_slot():
+    scheduler = Scheduler("test", max_concurrency=1, queue_timeout=0.05)
+    with scheduler.slot():
+        with scheduler.slot():
+            assert scheduler.stats()["active"] == 1
+    assert scheduler.stats()["active"] == 0
+
+
+def test_non_reentrant_slot_queues_nested_calls():
+    scheduler = Scheduler("test", max_concurrency=1, queue_timeout=0.05)
+    with scheduler.slot(reentrant=False):
+        with pytest.raises(Overloaded):
+            with scheduler.slot():
+                pass
+    assert scheduler.stats()["active"] == 0
+
+
+def test_nested_async_calls_reuse_the_slot():
+    async def run():
+        scheduler = Scheduler("test", max_concurrency=1, queue_timeout=0.05)
+        async with scheduler.aslot():
+            async with scheduler.aslot():
+                assert scheduler.stats()["active"] == 1
+        return scheduler.stats()
+
+    assert asyncio.run(run())["active"] == 0
+
+
+def test_background_calls_are_capped_across_workers():
+    server = fakeredis.FakeServer()
+    workers = [Scheduler("test", max_concurrency=4, redis_client=fakeredis.FakeRedis(server=server),
+                         background_concurrency=1) for _ in range(2)]
+
+    # Not reentrant, as both workers live in this one process
+    with request_priority(Priority.BACKGROUND):
+        with workers[0].slot(reentrant=False):
+            with pytest.raises(Overloaded):
+                with workers[1].slot():
+                    pass
+            # Other priorities are not capped
+            with request_priority(Priority.NORMAL), workers[1].slot():
+                pass
+        with workers[1].slot():
+            pass
+    assert fakeredis.FakeRedis(server=server).zcard(workers[0].lease_key) == 0
+
+
+def test_async_background_calls_are_capped_across_workers():
+    async def run():
+        server = fakeredis.FakeServer()
+        workers = [Scheduler("test", max_concurrency=4, async_redis_client=aioredis.FakeRedis(server=server),
+                             background_concurrency=1) for _ in range(2)]
+        with request_priority(Priority.BACKGROUND):
+            async with workers[0].aslot(reentrant=False):
+                with pytest.raises(Overloaded):
+                    async with workers[1].aslot():
+                        pass
+            async with workers[1].aslot():
+                pass
+        return await aioredis.FakeRedis(server=server).zcard(workers[0].lease_key)
+
+    assert asyncio.run(run()) == 0
@@ -0,0 +1,329 @@
+import os
+import types
+import uuid
+
+import fakeredis
+import numpy as np
+import pytest
+
+from src.utils import weavite
+from src.utils.vector_replica import ChangeLog, ReplicaWriter, VectorReplica, normalize
+
+
+def new_ids(count):
+    return [str(uuid.uuid4()) for _ in range(count)]
+
+
+def clustered(rng, count, dim=16, clusters=8):
+    centers = np.random.default_rng(0).normal(size=(clusters, dim))
+    return (centers[rng.integers(0, clusters, count)] + 0.1 * rng.normal(size=(count, dim))).astype(np.float32)
+
+
+def files(directory, name):
+    return sorted(path for path in os.listdir(directory) if path.startswith(f"{name}."))
+
+
+@pytest.fixture
+def replica(tmp_path):
+    return VectorReplica(str(tmp_path), nprobe=2)
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1)
+
+
+def fill(replica, ids, vectors, log_id="1-0", log_added=1):
+    with replica.writer() as writer:
+        writer.add(ids, vectors)
+        writer.commit(log_id, log_added)
+
+
+def test_search_returns_the_nearest_rows_best_first(replica, rng):
+    ids, vectors = new_ids(50), clustered(rng, 50)
+    fill(replica, ids, vectors)
+
+    hits = replica.search(vectors[[7, 21]], k=3)
+    assert [found[0][0] for found in hits] == [ids[7], ids[21]]
+    assert hits[0][0][1] == pytest.approx(1.0, abs=1e-5)
+    scores = [score for _, score in hits[0]]
+    assert scores == sorted(scores, reverse=True)
+
+    # Another process maps the same files
+    assert VectorReplica(replica.directory).search(vectors[7], k=1)[0][0][0] == ids[7]
+
+
+def test_empty_replica_finds_nothing(replica):
+    assert replica.search(np.ones((2, 4)), k=3) == [[], []]
+    assert len(replica) == 0
+
+
+def test_changes_are_invisible_until_commit(replica, rng):
+    ids, vectors = new_ids(10), clustered(rng, 10)
+    fill(replica, ids[:5], vectors[:5])
+    with replica.writer() as writer:
+        writer.add(ids[5:], vectors[5:])
+        assert len(replica) == 5
+        assert replica.search(vectors[8], k=1)[0][0][0] != ids[8]
+        writer.commit("2-0", 2)
+    assert len(replica) == 10
+    assert replica.search(vectors[8], k=1)[0][0][0] == ids[8]
+
+
+def test_writer_crash_before_commit_keeps_the_committed_replica(replica, rng):
+    ids, vectors = new_ids(10), clustered(rng, 10)
+    fill(replica, ids[:5], vectors[:5], "1-0", 1)
+
+    with pytest.raises(RuntimeError):
+        with replica.writer() as writer:
+            writer.add(ids[5:], vectors[5:])
+            raise RuntimeError("killed")
+
+    reader = VectorReplica(replica.directory)
+    reader.refresh()
+    assert len(reader) == 5
+    assert {found[0][0] for found in reader.search(vectors[5:], k=1)} <= set(ids[:5])
+    with replica.writer() as writer:
+        # The next sync replays the log from the committed position
+        assert writer.log_position == ("1-0", 1)
+        assert len(writer) == 5
+        writer.add(ids[5:], vectors[5:])
+        writer.commit("2-0", 2)
+    assert replica.search(vectors[9], k=1)[0][0][0] == ids[9]
+    assert len(replica) == 10
+
+
+def test_only_one_writer_at_a_time(replica):
+    with replica.writer() as writer:
+        assert writer is not None
+        with VectorReplica(replica.directory).writer() as other:
+            assert other is None
+
+
+def test_deletes_apply_in_place(replica, rng):
+    ids, vectors = new_ids(20), clustered(rng, 20)
+    fill(replica, ids, vectors)
+    generation = replica.state["generation"]
+    with replica.writer() as writer:
+        writer.delete(ids[:3])
+        # Visible to readers right away, through the shared alive flags
+        assert ids[0] not in {object_id for object_id, _ in replica.search(vectors[0], k=20)[0]}
+        writer.commit("2-0", 2)
+    assert len(replica) == 17
+    assert replica.state["generation"] == generation
+    assert replica.state["deleted"] == 3
+
+
+def test_replacing_an_id_keeps_one_row(replica, rng):
+    ids, vectors = new_ids(5), clustered(rng, 6)
+    fill(replica, ids, vectors[:5])
+    fill(replica, ids[:1], vectors[5:], "2-0", 2)
+    assert len(replica) == 5
+    assert replica.search(vectors[5], k=1)[0][0][0] == ids[0]
+    assert [object_id for object_id, _ in replica.search(vectors[5], k=5)[0]].count(ids[0]) == 1
+
+
+def test_growing_past_capacity_moves_to_a_new_generation(replica, rng):
+    ids, vectors = new_ids(1500), clustered(rng, 1500)
+    fill(replica, ids[:1000], vectors[:1000])
+    old_reader = VectorReplica(replica.directory)
+    old_reader.refresh()
+    assert replica.state["capacity"] == 1024
+
+    fill(replica, ids[1000:], vectors[1000:], "2-0", 2)
+    assert replica.state["generation"] == old_reader.state["generation"] + 1
+    assert replica.state["capacity"] >= 1500
+    assert len(replica) == 1500
+    assert files(replica.directory, "vectors") == [f"vectors.{replica.state['generation']}"]
+    assert replica.search(vectors[1200], k=1)[0][0][0] == ids[1200]
+
+    # A reader of the old generation moves to the new one
+    assert old_reader.search(vectors[1200], k=1)[0][0][0] == ids[1200]
+
+
+def test_commit_compacts_once_half_the_rows_are_deleted(replica, rng):
+    ids, vectors = new_ids(40), clustered(rng, 40)
+    fill(replica, ids, vectors)
+    generation = replica.state["generation"]
+    with replica.writer() as writer:
+        writer.delete(ids[:20])
+        writer.commit("2-0", 2)
+    assert replica.state["generation"] == generation + 1
+    assert replica.state["rows"] == 20
+    assert replica.state["deleted"] == 0
+    assert replica.search(vectors[30], k=1)[0][0][0] == ids[30]
+
+
+def test_trained_index_finds_what_the_exact_search_finds(replica, rng):
+    ids, vectors = new_ids(800), clustered(rng, 800)
+    fill(replica, ids, vectors)
+    exact = [found[0][0] for found in replica.search(vectors[:20], k=1)]
+
+    with replica.writer() as writer:
+        writer.train(8)
+        writer.commit("1-0", 1)
+    assert replica.state["nlist"] == 8
+    assert files(replica.directory, "centroids") == [f"centroids.{replica.state['generation']}.npy"]
+    assert [found[0][0] for found in replica.search(vectors[:20], k=1)] == exact
+
+    # Rows added later are assigned to the existing lists
+    more_ids, more_vectors = new_ids(10), clustered(rng, 10)
+    fill(replica, more_ids, more_vectors, "2-0", 2)
+    assert [found[0][0] for found in replica.search(more_vectors, k=1)] == more_ids
+
+
+def test_index_is_retrained_when_the_rows_double(replica, rng):
+    nlist = 4
+    ids, vectors = new_ids(400), clustered(rng, 400)
+    with replica.writer() as writer:
+        writer.add(ids[:100], vectors[:100])
+        writer.maybe_train(nlist)
+        assert writer.state["nlist"] == 0
+        writer.add(ids[100:200], vectors[100:200])
+        writer.maybe_train(nlist)
+        assert writer.state["trained_rows"] == 200
+        generation = writer.state["generation"]
+        writer.add(ids[200:399], vectors[200:399])
+        writer.maybe_train(nlist)
+        assert writer.state["generation"] == generation
+        writer.add(ids[399:], vectors[399:])
+        writer.maybe_train(nlist)
+        assert writer.state["trained_rows"] == 400
+        writer.commit("1-0", 1)
+    assert replica.search(vectors[399], k=1)[0][0][0] == ids[399]
+
+
+def test_vectors_are_stored_unit_length(replica):
+    ids = new_ids(2)
+    fill(replica, ids, [[3.0, 4.0], [0.0, 0.0]])
+    assert replica.search([[6.0, 8.0]], k=1)[0][0] == (ids[0], pytest.approx(1.0))
+    assert normalize([[0.0, 0.0]]).tolist() == [[0.0, 0.0]]
+
+
+def test_dimension_mismatch_is_rejected(replica):
+    with replica.writer() as writer:
+        writer.add(new_ids(1), [[1.0, 0.0]])
+        with pytest.raises(ValueError):
+            writer.add(new_ids(1), [[1.0, 0.0, 0.0]])
+
+
+@pytest.fixture
+def change_log():
+    return ChangeLog(fakeredis.FakeRedis(), key="test:changes", maxlen=3)
+
+
+def test_change_log_reads_entries_after_a_position(change_log):
+    assert change_log.position() == ("0-0", 0)
+    change_log.append("add", ["a", "b"])
+    change_log.append("delete", ["a"])
+    entries = change_log.read(after="0-0")
+    assert [(op, ids) for _, op, ids in entries] == [("add", ["a", "b"]), ("delete", ["a"])]
+    assert change_log.read(after=entries[0][0]) == entries[1:]
+    assert change_log.position() == (entries[-1][0], 2)
+
+
+def test_change_log_detects_trimmed_entries(change_log):
+    assert change_log.missed(None, 0)
+    assert not change_log.missed("0-0", 0)
+    # The stream is gone but the replica had read entries of it
+    assert change_log.missed("1-0", 1)
+
+    for n in range(2):
+        change_log.append("add", [str(n)])
+    position = change_log.position()
+    assert not change_log.missed("0-0", 0)
+
+    for n in range(2, 10):
+        change_log.append("add", [str(n)])
+    change_log.redis_client.xtrim(change_log.key, maxlen=3, approximate=False)
+    assert change_log.missed(*position)
+    assert not change_log.missed(*change_log.position())
+    last = change_log.read(after="0-0")[-2][0]
+    assert not change_log.missed(last, 9)
+
+
+class FakeCollection:
+    """
+    The Weaviate collection calls made by `sync_vector_replica`.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.query = types.SimpleNamespace(fetch_objects=self.fetch_objects)
+
+    @staticmethod
+    def _object(object_id, vector):
+        return types.SimpleNamespace(uuid=uuid.UUID(object_id), vector={"default": vector})
+
+    def iterator(self, include_vector=False):
+        return iter([self._object(object_id, vector) for object_id, vector in list(self.objects.items())])
+
+    def fetch_objects(self, filters, include_vector, limit):
+        return types.SimpleNamespace(objects=[self._object(object_id, self.objects[object_id])
+                                              for object_id in filters.value if object_id in self.objects])
+
+
+@pytest.fixture
+def synced(tmp_path, monkeypatch, change_log):
+    collection = FakeCollection()
+    replica = VectorReplica(str(tmp_path))
+    client = types.SimpleNamespace(collections=types.SimpleNamespace(get=lambda name: collection))
+    monkeypatch.setattr(weavite, "get_weaviate", lambda: client)
+    monkeypatch.setattr(weavite, "get_index_changes", lambda: change_log)
+    monkeypatch.setattr(weavite, "get_vector_replica", lambda: replica)
+    monkeypatch.setattr(weavite.config, "VECTOR_REPLICA_NLIST", 0)
+
+    def add(count, rng=np.random.default_rng(2)):
+        ids = new_ids(count)
+        for object_id, vector in zip(ids, clustered(rng, count)):
+            collection.objects[object_id] = vector.tolist()
+        change_log.append("add", ids)
+        return ids
+
+    return types.SimpleNamespace(collection=collection, replica=replica, log=change_log, add=add)
+
+
+def test_sync_replays_the_change_log(synced):
+    ids = synced.add(2)
+    assert weavite.sync_vector_replica() == {"rows": 2, "applied": 0, "rebuilt": True}
+    more = synced.add(1)
+    for object_id in ids[:1]:
+        del synced.collection.objects[object_id]
+    synced.log.append("delete", ids[:1])
+    assert weavite.sync_vector_replica() == {"rows": 2, "applied": 2, "rebuilt": False}
+    assert weavite.sync_vector_replica() == {"rows": 2, "applied": 0, "rebuilt": False}
+    vector = synced.collection.objects[more[0]]
+    assert synced.replica.search(vector, k=1)[0][0][0] == more[0]
+
+
+def test_sync_rebuilds_when_the_log_was_trimmed_past_the_replica(synced):
+    synced.add(1)
+    weavite.sync_vector_replica()
+    # More changes than the stream keeps, while the replica is not syncing
+    for _ in range(6):
+        synced.add(1)
+    synced.log.redis_client.xtrim(synced.log.key, maxlen=3, approximate=False)
+
+    result = weavite.sync_vector_replica()
+    assert result["rebuilt"]
+    assert len(synced.replica) == len(synced.collection.objects) == 7
+    assert weavite.sync_vector_replica()["rebuilt"] is False
+
+
+def test_sync_after_a_writer_crash_replays_from_the_committed_position(synced, monkeypatch):
+    synced.add(2)
+    weavite.sync_vector_replica()
+    ids = synced.add(3)
+
+    def crash(self, *args):
+        raise RuntimeError("killed")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ReplicaWriter, "commit", crash)
+        with pytest.raises(RuntimeError):
+            weavite.sync_vector_replica()
+    assert len(synced.replica) == 2
+
+    assert weavite.sync_vector_replica() == {"rows": 5, "applied": 1, "rebuilt": False}
+    vector = synced.collection.objects[ids[2]]
+    assert synced.replica.search(vector, k=1)[0][0][0] == ids[2]